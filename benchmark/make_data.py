@@ -0,0 +1,273 @@
+#!/usr/bin/python
+"""
+Generates a synthetic dataset for benchmarking the pipelines: a random
+genome (FASTA plus a bowtie index if bowtie-build is on the path), a GFF of
+genes, a BED file of regions to filter out, and one FASTQ per sample.  Some
+reads run into an adapter so that clipping has work to do.  With --sam, the
+true alignment of every read is written as a SAM file too, for benchmarking
+counting or filtering on their own.
+
+Reads are generated in batches with NumPy, so even 100M-read samples only
+take a few minutes and constant memory.
+
+Example::
+
+    ./make_data.py --reads 1000000 --samples 4 --out data/1M
+"""
+import os
+import sys
+import json
+import subprocess
+from argparse import ArgumentParser
+import numpy as np
+
+ADAPTER = 'TCGTATGCCGTCTTCTGCTTG'
+BASES = np.frombuffer('ACGT', dtype=np.uint8)
+COMPLEMENT = np.arange(256, dtype=np.uint8)
+COMPLEMENT[np.frombuffer('ACGT', dtype=np.uint8)] = np.frombuffer(
+        'TGCA', dtype=np.uint8)
+
+# Phred+64 ("--solexa1.3-quals") quality characters, as in the example data
+QUALITIES = np.frombuffer('ZZ^^bbddfhh', dtype=np.uint8)
+
+
+def make_genome(fasta, chroms, size, rng):
+    """
+    Writes `chroms` random chromosomes of `size` bases each to `fasta` and
+    returns them as a dictionary of name -> uint8 array.
+    """
+    genome = {}
+    fout = open(fasta, 'w')
+    for i in range(chroms):
+        name = 'chr%d' % (i + 1)
+        seq = BASES[rng.randint(0, 4, size)]
+        genome[name] = seq
+        fout.write('>%s\n' % name)
+        text = seq.tostring()
+        for start in xrange(0, size, 60):
+            fout.write(text[start:start + 60] + '\n')
+    fout.close()
+    return genome
+
+
+def make_gff(gff, genome, rng, min_len=500, max_len=5000, mean_gap=2000):
+    """
+    Writes genes of random length, strand and spacing along each chromosome
+    in `genome` to `gff`.  Returns the number of genes.
+    """
+    n = 0
+    fout = open(gff, 'w')
+    for chrom in sorted(genome):
+        size = len(genome[chrom])
+        pos = 1 + rng.randint(0, mean_gap)
+        while True:
+            end = pos + rng.randint(min_len, max_len)
+            if end > size:
+                break
+            n += 1
+            fout.write('%s\tbench\tgene\t%d\t%d\t.\t%s\t.\tID=gene%d;\n' % (
+                chrom, pos, end, '+-'[rng.randint(0, 2)], n))
+            pos = end + 1 + rng.randint(0, 2 * mean_gap)
+    fout.close()
+    return n
+
+
+def make_bed(bed, genome, rng, fraction=0.05, length=1000):
+    """
+    Writes random regions covering about `fraction` of each chromosome in
+    `genome` to `bed`.
+    """
+    fout = open(bed, 'w')
+    for chrom in sorted(genome):
+        size = len(genome[chrom])
+        n = max(1, int(size * fraction / length))
+        for start in sorted(rng.randint(0, size - length, n)):
+            fout.write('%s\t%d\t%d\n' % (chrom, start, start + length))
+    fout.close()
+
+
+def read_batch(genome, first, n, read_length, adapter_fraction, rng):
+    """
+    Generates `n` reads numbered from `first`.  Returns the FASTQ text and
+    a list of (name, chrom, strand, pos, insert length) for the SAM file.
+    """
+    chroms = sorted(genome)
+    which = rng.randint(0, len(chroms), n)
+    strands = rng.randint(0, 2, n)
+    inserts = np.where(
+            rng.random_sample(n) < adapter_fraction,
+            rng.randint(read_length // 2, read_length, n), read_length)
+    seqs = np.empty((n, read_length), dtype=np.uint8)
+    positions = np.empty(n, dtype=np.int64)
+    offsets = np.arange(read_length)
+    for i, chrom in enumerate(chroms):
+        mask = which == i
+        k = int(mask.sum())
+        if not k:
+            continue
+        seq = genome[chrom]
+        pos = rng.randint(0, len(seq) - read_length, k)
+        positions[mask] = pos
+        seqs[mask] = seq[pos[:, None] + offsets]
+
+    # Reads from the minus strand are the reverse complement of the genome;
+    # the insert is at the start of the read either way.
+    minus = strands == 1
+    for length in np.unique(inserts[minus]):
+        rows = minus & (inserts == length)
+        seqs[rows, :length] = COMPLEMENT[seqs[rows, :length][:, ::-1]]
+
+    # Fill the rest of short inserts with the adapter
+    adapter = np.frombuffer(
+            (ADAPTER * (read_length // len(ADAPTER) + 1))[:read_length],
+            dtype=np.uint8)
+    tail = offsets[None, :] >= inserts[:, None]
+    seqs[tail] = adapter[(offsets[None, :] - inserts[:, None])[tail]]
+
+    quals = QUALITIES[rng.randint(0, len(QUALITIES), (n, read_length))]
+
+    # Build fixed-width records: @rNNNNNNNNNN\nSEQ\n+\nQUAL\n
+    width = 10
+    ids = np.arange(first, first + n, dtype=np.int64)
+    digits = (ids[:, None] // 10 ** np.arange(width - 1, -1, -1)) % 10 + 48
+    nl = np.full((n, 1), ord('\n'), dtype=np.uint8)
+    records = np.hstack([
+        np.full((n, 2), [ord('@'), ord('r')], dtype=np.uint8),
+        digits.astype(np.uint8), nl, seqs, nl,
+        np.full((n, 1), ord('+'), dtype=np.uint8), nl, quals, nl])
+    truth = (ids, which, strands, positions, inserts)
+    return records.tostring(), truth
+
+
+def sam_lines(truth, genome, read_length):
+    """
+    SAM lines for the true alignments in `truth`, as returned by
+    read_batch().  Adapter sequence is soft-clipped.
+    """
+    chroms = sorted(genome)
+    lines = []
+    for name, which, strand, pos, insert in zip(*truth):
+        clipped = read_length - insert
+        if not clipped:
+            cigar = '%dM' % insert
+        elif strand:
+            # SAM is in reference orientation, so the clipped 3' end of
+            # a minus-strand read comes first
+            cigar = '%dS%dM' % (clipped, insert)
+        else:
+            cigar = '%dM%dS' % (insert, clipped)
+        lines.append('r%010d\t%d\t%s\t%d\t255\t%s\t*\t0\t0\t*\t*\tNH:i:1\n' % (
+            name, 16 * strand, chroms[which], pos + 1, cigar))
+    return ''.join(lines)
+
+
+def make_sample(fastq, genome, reads, read_length, adapter_fraction, rng,
+                sam=None, batch_size=500000):
+    """
+    Writes `reads` reads to `fastq` (and their true alignments to `sam`, if
+    given) in batches of `batch_size`.
+    """
+    fout = open(fastq, 'w')
+    if sam:
+        samout = open(sam, 'w')
+        for chrom in sorted(genome):
+            samout.write('@SQ\tSN:%s\tLN:%d\n' % (chrom, len(genome[chrom])))
+    for first in xrange(0, reads, batch_size):
+        n = min(batch_size, reads - first)
+        text, truth = read_batch(
+                genome, first, n, read_length, adapter_fraction, rng)
+        fout.write(text)
+        if sam:
+            samout.write(sam_lines(truth, genome, read_length))
+    fout.close()
+    if sam:
+        samout.close()
+
+
+def make_dataset(out, reads, samples, genome_size=1000000, chroms=4,
+                 read_length=36, adapter_fraction=0.3, sam=False, seed=0):
+    """
+    Writes a complete dataset to the directory `out` and returns its
+    description, which is also saved as "dataset.json" there.  If `out`
+    already has a dataset made with the same arguments, it is reused.
+    """
+    desc = dict(
+            reads=reads, samples=samples, genome_size=genome_size,
+            chroms=chroms, read_length=read_length,
+            adapter_fraction=adapter_fraction, sam=sam, seed=seed,
+            adapter=ADAPTER)
+    out = os.path.abspath(out)
+    descfn = os.path.join(out, 'dataset.json')
+    if os.path.exists(descfn):
+        existing = json.load(open(descfn))
+        if all(existing.get(k) == v for k, v in desc.items()):
+            return existing
+    if not os.path.exists(out):
+        os.makedirs(out)
+
+    rng = np.random.RandomState(seed)
+    fasta = os.path.join(out, 'genome.fasta')
+    genome = make_genome(fasta, chroms, genome_size // chroms, rng)
+    desc['gff'] = os.path.join(out, 'genes.gff')
+    desc['genes'] = make_gff(desc['gff'], genome, rng)
+    desc['filter bed'] = os.path.join(out, 'filter.bed')
+    make_bed(desc['filter bed'], genome, rng)
+    desc['index'] = os.path.join(out, 'genome')
+    try:
+        p = subprocess.Popen(
+                ['bowtie-build', fasta, desc['index']],
+                stdout=open(os.devnull, 'w'), stderr=subprocess.PIPE)
+        stdout, stderr = p.communicate()
+        if p.returncode:
+            raise RuntimeError('bowtie-build failed:\n%s' % stderr)
+    except OSError:
+        print >> sys.stderr, (
+                'bowtie-build not found; %s has no bowtie index' % out)
+
+    desc['fastq'] = []
+    for i in range(samples):
+        fastq = os.path.join(out, 'sample-%d.fastq' % (i + 1))
+        samfn = None
+        if sam:
+            samfn = os.path.join(out, 'sample-%d.sam' % (i + 1))
+        make_sample(
+                fastq, genome, reads, read_length, adapter_fraction, rng,
+                sam=samfn)
+        desc['fastq'].append(fastq)
+
+    fout = open(descfn, 'w')
+    json.dump(desc, fout, indent=2, sort_keys=True)
+    fout.close()
+    return desc
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--out', required=True,
+                        help='Directory for the dataset')
+    parser.add_argument('--reads', type=int, default=10000,
+                        help='Reads per sample (default %(default)s)')
+    parser.add_argument('--samples', type=int, default=2,
+                        help='Number of samples (default %(default)s)')
+    parser.add_argument('--genome-size', type=int, default=1000000,
+                        help='Total genome size (default %(default)s)')
+    parser.add_argument('--chroms', type=int, default=4,
+                        help='Number of chromosomes (default %(default)s)')
+    parser.add_argument('--read-length', type=int, default=36,
+                        help='Read length (default %(default)s)')
+    parser.add_argument('--adapter-fraction', type=float, default=0.3,
+                        help='Fraction of reads that run into the adapter '
+                             '(default %(default)s)')
+    parser.add_argument('--sam', action='store_true',
+                        help='Also write the true alignments as SAM')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    make_dataset(
+            args.out, args.reads, args.samples, genome_size=args.genome_size,
+            chroms=args.chroms, read_length=args.read_length,
+            adapter_fraction=args.adapter_fraction, sam=args.sam,
+            seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
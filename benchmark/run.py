@@ -0,0 +1,349 @@
+#!/usr/bin/python
+"""
+Benchmarks pipeline-1, pipeline-2 and pipeline-3 on synthetic datasets (see
+make_data.py) and appends the results to a JSONL file, one line per
+measurement, so that runs can be compared across commits and machines.
+
+Each pipeline can be run end to end (all tasks in one go, from a fresh
+output directory) and/or stage by stage (each task run on its own with
+"-t <task>" once its upstream tasks are done).  Every measurement records
+the wall time, reads/sec, CPU time, peak RSS of the largest process and
+bytes written to disk, together with the commit, host and dataset.
+
+Example::
+
+    ./run.py --reads 10000,1000000 --samples 4 --pipelines 2,3 \\
+        --set "count engine=inprocess"
+
+    ./run.py --summary
+"""
+import os
+import sys
+import json
+import time
+import errno
+import signal
+import socket
+import platform
+import subprocess
+import multiprocessing
+from argparse import ArgumentParser
+import yaml
+import make_data
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+
+# Tasks of each pipeline in the order they run
+STAGES = {
+    'pipeline-1': ['map', 'count'],
+    'pipeline-2': ['clip', 'map', 'count'],
+    'pipeline-3': ['clip', 'map', 'filter', 'count'],
+}
+
+
+def git(*args):
+    try:
+        p = subprocess.Popen(
+                ['git'] + list(args), cwd=REPO, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+        stdout, stderr = p.communicate()
+    except OSError:
+        return None
+    if p.returncode:
+        return None
+    return stdout.strip()
+
+
+def environment():
+    """
+    Describes the commit being benchmarked and the machine it runs on.
+    """
+    status = git('status', '--porcelain', '--untracked-files=no')
+    cpu = None
+    mem = None
+    try:
+        for line in open('/proc/cpuinfo'):
+            if line.startswith('model name'):
+                cpu = line.split(':', 1)[1].strip()
+                break
+        for line in open('/proc/meminfo'):
+            if line.startswith('MemTotal:'):
+                mem = int(line.split()[1]) * 1024
+                break
+    except IOError:
+        pass
+    return {
+        'commit': git('rev-parse', 'HEAD'),
+        'dirty': bool(status) if status is not None else None,
+        'host': socket.gethostname(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpus': multiprocessing.cpu_count(),
+        'cpu model': cpu,
+        'memory': mem,
+    }
+
+
+def disk_written():
+    """
+    Bytes this process and its reaped children have written to disk, or
+    None if the kernel doesn't say.
+    """
+    try:
+        for line in open('/proc/self/io'):
+            if line.startswith('write_bytes:'):
+                return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+def measure(cmds, cwd, log):
+    """
+    Runs `cmds` in `cwd` with its output appended to the file `log`, and
+    returns a dictionary of what it cost.  The rusage that wait4() returns
+    for a process includes the children it reaped, so the peak RSS is that
+    of the largest process in the whole tree.
+    """
+    written = disk_written()
+    t0 = time.time()
+    p = subprocess.Popen(
+            cmds, cwd=cwd, stdout=open(log, 'a'), stderr=subprocess.STDOUT)
+    while True:
+        try:
+            pid, sts, usage = os.wait4(p.pid, 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+    wall = time.time() - t0
+    p._handle_exitstatus(sts)
+    result = {
+        'returncode': p.returncode,
+        'wall': wall,
+        'user cpu': usage.ru_utime,
+        'system cpu': usage.ru_stime,
+        'peak rss': usage.ru_maxrss * 1024,
+        'disk written': None,
+    }
+    if written is not None:
+        result['disk written'] = disk_written() - written
+    return result
+
+
+def write_config(pipeline, dataset, workdir, overrides):
+    """
+    Writes a config file for running `pipeline` on `dataset` in `workdir`
+    and returns its filename.
+    """
+    config = yaml.load(open(os.path.join(REPO, pipeline, 'config.yaml')))
+    config.update({
+        'output dir': os.path.join(workdir, 'run'),
+        'gff': dataset['gff'],
+        'index': dataset['index'],
+        'samples': [
+            {'label': 'sample-%d' % (i + 1), 'fastq': fastq}
+            for i, fastq in enumerate(dataset['fastq'])],
+        'htseq params': '--idattr=ID -t gene -s no',
+    })
+    if 'adapter' in config:
+        config['adapter'] = dataset['adapter']
+    if 'filter bed' in config:
+        config['filter bed'] = dataset['filter bed']
+    config.update(overrides)
+    fn = os.path.join(workdir, 'config.yaml')
+    yaml.dump(config, open(fn, 'w'), default_flow_style=False)
+    return fn
+
+
+def start_workers(queue_dir, n, log):
+    """
+    Starts `n` pipeline-3 queue workers (see backends.py) on `queue_dir`.
+    """
+    return subprocess.Popen(
+            [sys.executable, os.path.join(REPO, 'pipeline-3', 'backends.py'),
+             'worker', queue_dir, '-n', str(n)],
+            stdout=open(log, 'a'), stderr=subprocess.STDOUT)
+
+
+def run_pipeline(pipeline, dataset, workdir, mode, overrides, jobs,
+                 queue_workers=None):
+    """
+    Runs `pipeline` on `dataset` in a fresh `workdir`, either end to end or
+    stage by stage (`mode`), and yields a measurement for each run.  If
+    `queue_workers` is given, pipeline-3 hands its tasks to that many queue
+    workers instead of running them itself.
+    """
+    if os.path.exists(workdir):
+        subprocess.check_call(['rm', '-rf', workdir])
+    os.makedirs(workdir)
+    config = write_config(pipeline, dataset, workdir, overrides)
+    log = os.path.join(workdir, 'pipeline.log')
+    cmds = [sys.executable, os.path.join(REPO, pipeline, 'pipeline.py'),
+            '--config', config, '-v', '-j', str(jobs)]
+    workers = None
+    if queue_workers and pipeline == 'pipeline-3':
+        queue_dir = os.path.join(workdir, 'queue')
+        cmds += ['--backend', 'queue', '--queue-dir', queue_dir,
+                 '--executor', 'threads', '-j', str(max(jobs, queue_workers))]
+        workers = start_workers(queue_dir, queue_workers, log)
+    try:
+        for result in _run_stages(
+                pipeline, dataset, workdir, mode, overrides, cmds, log):
+            result['queue workers'] = queue_workers if workers else None
+            yield result
+    finally:
+        if workers is not None:
+            workers.send_signal(signal.SIGINT)
+            workers.wait()
+
+
+def _run_stages(pipeline, dataset, workdir, mode, overrides, cmds, log):
+    if mode == 'end-to-end':
+        stages = [None]
+    elif overrides.get('streaming') and pipeline == 'pipeline-3':
+        stages = ['count']
+    else:
+        stages = STAGES[pipeline]
+        if pipeline == 'pipeline-3' and not overrides.get(
+                'filter bed', dataset['filter bed']):
+            stages = [s for s in stages if s != 'filter']
+    for stage in stages:
+        if stage is None:
+            result = measure(cmds, workdir, log)
+        else:
+            result = measure(cmds + ['-t', stage], workdir, log)
+        result['stage'] = stage
+        reads = dataset['reads'] * dataset['samples']
+        result['reads/sec'] = reads / result['wall'] if result['wall'] else None
+        yield result
+        if result['returncode']:
+            break
+
+
+def summarize(results_file):
+    """
+    Prints the median wall time and reads/sec of each kind of measurement in
+    `results_file`, per commit.
+    """
+    groups = {}
+    for line in open(results_file):
+        r = json.loads(line)
+        key = (r['env']['commit'] or '?')[:10], r['env']['host'], \
+            r['pipeline'], r['mode'], r['stage'] or '-', \
+            r['dataset']['reads'], r['dataset']['samples'], \
+            r.get('queue workers') or '-', \
+            json.dumps(r['overrides'], sort_keys=True)
+        groups.setdefault(key, []).append(r)
+    fmt = '%-10s %-12s %-10s %-10s %-6s %10s %7s %7s %9s %12s %10s  %s'
+    print fmt % ('commit', 'host', 'pipeline', 'mode', 'stage', 'reads',
+                 'samples', 'workers', 'wall', 'reads/sec', 'peak rss',
+                 'overrides')
+    for key in sorted(groups):
+        rs = [r for r in groups[key] if not r['returncode']]
+        if not rs:
+            continue
+        median = lambda xs: sorted(xs)[len(xs) // 2]
+        (commit, host, pipeline, mode, stage, reads, samples, workers,
+         overrides) = key
+        print fmt % (
+                commit, host[:12], pipeline, mode, stage, reads, samples,
+                workers,
+                '%.2fs' % median([r['wall'] for r in rs]),
+                '%.0f' % median([r['reads/sec'] for r in rs]),
+                '%.0fM' % (median([r['peak rss'] for r in rs]) / 1e6),
+                overrides)
+
+
+def main():
+    parser = ArgumentParser(
+            description=__doc__.split('\n\n')[0],
+            usage="\n\n    %(prog)s [arguments]")
+    parser.add_argument('--reads', default='10000',
+                        help='Comma-separated reads per sample to benchmark '
+                             '(default %(default)s)')
+    parser.add_argument('--samples', type=int, default=2,
+                        help='Number of samples (default %(default)s)')
+    parser.add_argument('--genome-size', type=int, default=1000000,
+                        help='Genome size (default %(default)s)')
+    parser.add_argument('--pipelines', default='1,2,3',
+                        help='Comma-separated pipelines to run (default '
+                             '%(default)s)')
+    parser.add_argument('--mode', choices=['end-to-end', 'stages', 'both'],
+                        default='both')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Number of times to run each benchmark')
+    parser.add_argument('--set', dest='overrides', action='append',
+                        default=[], metavar='KEY=VALUE',
+                        help='Override a config value (the value is parsed '
+                             'as YAML); can be given more than once')
+    parser.add_argument('-j', '--jobs', type=int, default=6,
+                        help='Jobs for each pipeline run (default '
+                             '%(default)s)')
+    parser.add_argument('--queue-workers', type=int, metavar='N',
+                        help='Run pipeline-3 with "--backend queue" and N '
+                             'local queue workers, to measure scaling '
+                             'across workers')
+    parser.add_argument('--data-dir', default=os.path.join(HERE, 'data'),
+                        help='Where datasets are generated and kept')
+    parser.add_argument('--work-dir', default=os.path.join(HERE, 'work'),
+                        help='Where pipelines are run')
+    parser.add_argument('--results', default=os.path.join(
+                            HERE, 'results.jsonl'),
+                        help='JSONL file results are appended to')
+    parser.add_argument('--summary', action='store_true',
+                        help="Don't run anything; summarize --results")
+    args = parser.parse_args()
+
+    if args.summary:
+        summarize(args.results)
+        return
+
+    overrides = {}
+    for item in args.overrides:
+        key, value = item.split('=', 1)
+        overrides[key] = yaml.load(value)
+    modes = ['end-to-end', 'stages'] if args.mode == 'both' else [args.mode]
+    env = environment()
+    fout = open(args.results, 'a')
+    for reads in [int(r) for r in args.reads.split(',')]:
+        dataset = make_data.make_dataset(
+                os.path.join(args.data_dir, '%d-x%d-g%d' % (
+                    reads, args.samples, args.genome_size)),
+                reads, args.samples, genome_size=args.genome_size)
+        for n in args.pipelines.split(','):
+            pipeline = 'pipeline-%s' % n
+            for mode in modes:
+                for repeat in range(args.repeat):
+                    workdir = os.path.join(args.work_dir, pipeline)
+                    for result in run_pipeline(
+                            pipeline, dataset, workdir, mode, overrides,
+                            args.jobs, args.queue_workers):
+                        result.update({
+                            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                            'env': env,
+                            'pipeline': pipeline,
+                            'mode': mode,
+                            'repeat': repeat,
+                            'jobs': args.jobs,
+                            'overrides': overrides,
+                            'dataset': dict(
+                                (k, dataset[k]) for k in (
+                                    'reads', 'samples', 'genome_size',
+                                    'read_length', 'adapter_fraction',
+                                    'seed')),
+                        })
+                        fout.write(json.dumps(result, sort_keys=True) + '\n')
+                        fout.flush()
+                        print '%s %s %s: %.2fs, %s reads/sec%s' % (
+                                pipeline, mode, result['stage'] or '',
+                                result['wall'], int(result['reads/sec'] or 0),
+                                ' (FAILED; see %s)' % os.path.join(
+                                    workdir, 'pipeline.log')
+                                if result['returncode'] else '')
+    fout.close()
+
+
+if __name__ == '__main__':
+    main()
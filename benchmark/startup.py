@@ -0,0 +1,178 @@
+#!/usr/bin/python
+"""
+Measures how long each pipeline takes to start up and print what it would
+do ("pipeline.py -n") as the number of samples grows, and appends the
+results to a JSONL file like run.py does.
+
+Each run gets a fresh config file and output directory, and is measured
+twice: "cold" is the first run after the config was written, and "warm"
+the second, when pipeline-3 can use its cached copy of the parsed config.
+All samples share one small FASTQ file, since nothing is actually run.
+With --sample-sheet, pipeline-3's samples are listed in a TSV sample sheet
+instead of the config file.
+
+Example::
+
+    ./startup.py --samples 100,1000,20000 --pipelines 3
+    ./startup.py --summary
+"""
+import os
+import sys
+import json
+import time
+import subprocess
+from argparse import ArgumentParser
+import yaml
+import run
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def write_config(pipeline, samples, workdir, sheet=False):
+    """
+    Writes a config file with `samples` samples for `pipeline` in `workdir`
+    and returns its filename.  If `sheet` is true, the samples are written
+    to a sample sheet that the config refers to.
+    """
+    fastq = os.path.join(workdir, 'reads.fastq')
+    fout = open(fastq, 'w')
+    fout.write('@r1\nACGTACGTACGTACGTACGTACGTACGTACGTACGT\n+\n%s\n' % ('I' * 36))
+    fout.close()
+    config = yaml.load(open(os.path.join(run.REPO, pipeline, 'config.yaml')))
+    config['output dir'] = os.path.join(workdir, 'run')
+    if sheet:
+        config['samples'] = None
+        config['sample sheet'] = os.path.join(workdir, 'samples.tsv')
+        fout = open(config['sample sheet'], 'w')
+        fout.write('label\tfastq\n')
+        for i in range(samples):
+            fout.write('sample-%d\t%s\n' % (i + 1, fastq))
+        fout.close()
+    else:
+        config['samples'] = [
+            {'label': 'sample-%d' % (i + 1), 'fastq': fastq}
+            for i in range(samples)]
+    fn = os.path.join(workdir, 'config.yaml')
+    yaml.dump(config, open(fn, 'w'), default_flow_style=False)
+    return fn
+
+
+def measure_startup(pipeline, samples, workdir, target=None, verbose=1,
+                    sheet=False):
+    """
+    Yields a cold and a warm measurement of "pipeline.py -n" for `pipeline`
+    with `samples` samples, limited to the `target` task if given.  See
+    write_config() for `sheet`.
+    """
+    if os.path.exists(workdir):
+        subprocess.check_call(['rm', '-rf', workdir])
+    os.makedirs(workdir)
+    config = write_config(pipeline, samples, workdir, sheet)
+    log = os.path.join(workdir, 'pipeline.log')
+    cmds = [sys.executable, os.path.join(run.REPO, pipeline, 'pipeline.py'),
+            '--config', config, '-n'] + ['-v'] * verbose
+    if target:
+        cmds += ['-t', target]
+    for phase in ('cold', 'warm'):
+        result = run.measure(cmds, workdir, log)
+        result['phase'] = phase
+        yield result
+        if result['returncode']:
+            break
+
+
+def summarize(results_file):
+    """
+    Prints the median startup time of each kind of measurement in
+    `results_file`, per commit.
+    """
+    groups = {}
+    for line in open(results_file):
+        r = json.loads(line)
+        key = (r['env']['commit'] or '?')[:10], r['env']['host'], \
+            r['pipeline'], r['samples'], r['target'] or '-', r['verbose'], \
+            'sheet' if r.get('sample sheet') else 'config', r['phase']
+        groups.setdefault(key, []).append(r)
+    fmt = '%-10s %-12s %-10s %8s %-8s %7s %-7s %-5s %9s %10s'
+    print fmt % ('commit', 'host', 'pipeline', 'samples', 'target',
+                 'verbose', 'source', 'phase', 'wall', 'peak rss')
+    for key in sorted(groups):
+        rs = [r for r in groups[key] if not r['returncode']]
+        if not rs:
+            continue
+        median = lambda xs: sorted(xs)[len(xs) // 2]
+        commit, host, pipeline, samples, target, verbose, source, phase = key
+        print fmt % (
+                commit, host[:12], pipeline, samples, target, verbose, source,
+                phase,
+                '%.2fs' % median([r['wall'] for r in rs]),
+                '%.0fM' % (median([r['peak rss'] for r in rs]) / 1e6))
+
+
+def main():
+    parser = ArgumentParser(
+            description=__doc__.split('\n\n')[0],
+            usage="\n\n    %(prog)s [arguments]")
+    parser.add_argument('--samples', default='100,1000,10000',
+                        help='Comma-separated numbers of samples (default '
+                             '%(default)s)')
+    parser.add_argument('--pipelines', default='1,2,3',
+                        help='Comma-separated pipelines to run (default '
+                             '%(default)s)')
+    parser.add_argument('-t', '--target',
+                        help='Only print the jobs needed for this task')
+    parser.add_argument('-v', '--verbose', type=int, default=1,
+                        help='Verbosity of the printout; 3 or more lists '
+                             'every job (default %(default)s)')
+    parser.add_argument('--sample-sheet', action='store_true',
+                        help='List the samples in a sample sheet rather '
+                             'than the config (pipeline-3 only)')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Number of times to run each benchmark')
+    parser.add_argument('--work-dir', default=os.path.join(
+                            HERE, 'work', 'startup'),
+                        help='Where pipelines are run')
+    parser.add_argument('--results', default=os.path.join(
+                            HERE, 'startup.jsonl'),
+                        help='JSONL file results are appended to')
+    parser.add_argument('--summary', action='store_true',
+                        help="Don't run anything; summarize --results")
+    args = parser.parse_args()
+
+    if args.summary:
+        summarize(args.results)
+        return
+
+    env = run.environment()
+    fout = open(args.results, 'a')
+    for samples in [int(n) for n in args.samples.split(',')]:
+        for n in args.pipelines.split(','):
+            pipeline = 'pipeline-%s' % n
+            sheet = args.sample_sheet and pipeline == 'pipeline-3'
+            for repeat in range(args.repeat):
+                workdir = os.path.join(args.work_dir, pipeline)
+                for result in measure_startup(
+                        pipeline, samples, workdir, args.target,
+                        args.verbose, sheet):
+                    result.update({
+                        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                        'env': env,
+                        'pipeline': pipeline,
+                        'samples': samples,
+                        'target': args.target,
+                        'verbose': args.verbose,
+                        'sample sheet': sheet,
+                        'repeat': repeat,
+                    })
+                    fout.write(json.dumps(result, sort_keys=True) + '\n')
+                    fout.flush()
+                    print '%s %d samples, %s: %.2fs%s' % (
+                            pipeline, samples, result['phase'],
+                            result['wall'], ' (FAILED; see %s)' % (
+                                os.path.join(workdir, 'pipeline.log'))
+                            if result['returncode'] else '')
+    fout.close()
+
+
+if __name__ == '__main__':
+    main()
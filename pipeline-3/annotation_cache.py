@@ -0,0 +1,165 @@
+"""
+Persistent on-disk cache of compiled feature indexes.
+
+The first time a GFF is counted against with a particular feature type,
+ID attribute and strandedness, the FeatureIndex built by counting.py is
+compiled into a few flat arrays and saved in the cache directory under a
+hash of the GFF's contents and those options.  Later runs memory-map the
+arrays instead of parsing the GFF again.
+
+Each cache entry is a directory containing:
+
+    `meta.json`: feature IDs and the rows of the arrays for each
+                 (chromosome, strand)
+    `starts.npy`, `ends.npy`: the half-open interval of each step that
+                 has at least one feature
+    `offsets.npy`, `members.npy`: the features in step i are
+                 members[offsets[i]:offsets[i + 1]], as indexes into the
+                 feature IDs
+    `last_used`: empty file whose mtime is used for LRU eviction
+"""
+import os
+import json
+import fcntl
+import hashlib
+import tempfile
+import numpy as np
+import counting
+import helpers
+
+FORMAT_VERSION = 1
+
+
+def cache_key(gff, params, cache_dir):
+    """
+    Returns the cache key for `gff` and the parsed htseq `params`.
+    """
+    opts = '%s\t%s\t%s\t%s' % (
+            FORMAT_VERSION, params['type'], params['idattr'],
+            params['stranded'] != 'no')
+    gff_hash = helpers.content_hash(gff, os.path.join(cache_dir, 'keys'))
+    return hashlib.sha1(opts + '\t' + gff_hash).hexdigest()
+
+
+def compile_index(index, outdir):
+    """
+    Saves the counting.FeatureIndex `index` as arrays in `outdir`.
+    """
+    ids = sorted(index.ids)
+    id_number = dict((feature_id, i) for i, feature_id in enumerate(ids))
+    starts, ends, offsets, members = [], [], [0], []
+    vectors = []
+    for chrom in sorted(index.features.chrom_vectors):
+        strands = index.features.chrom_vectors[chrom]
+        for strand in sorted(strands):
+            first = len(starts)
+            for iv, step in strands[strand].steps():
+                if not step:
+                    continue
+                starts.append(iv.start)
+                ends.append(iv.end)
+                members.extend(sorted(id_number[i] for i in step))
+                offsets.append(len(members))
+            vectors.append([chrom, strand, first, len(starts)])
+
+    np.save(os.path.join(outdir, 'starts.npy'),
+            np.array(starts, dtype=np.int64))
+    np.save(os.path.join(outdir, 'ends.npy'), np.array(ends, dtype=np.int64))
+    np.save(os.path.join(outdir, 'offsets.npy'),
+            np.array(offsets, dtype=np.int64))
+    np.save(os.path.join(outdir, 'members.npy'),
+            np.array(members, dtype=np.int32))
+    fout = open(os.path.join(outdir, 'meta.json'), 'w')
+    json.dump({'version': FORMAT_VERSION, 'stranded': index.stranded,
+               'ids': ids, 'vectors': vectors}, fout)
+    fout.close()
+    open(os.path.join(outdir, 'last_used'), 'w').close()
+
+
+class CompiledFeatureIndex(object):
+    def __init__(self, path):
+        """
+        Memory-maps the compiled index in the cache entry directory `path`.
+        Has the same `ids`, `stranded` and lookup() as counting.FeatureIndex.
+        """
+        meta = json.load(open(os.path.join(path, 'meta.json')))
+        self.path = path
+        self.stranded = meta['stranded']
+        self.id_names = meta['ids']
+        self.ids = set(self.id_names)
+        self.vectors = {}
+        for chrom, strand, first, last in meta['vectors']:
+            self.vectors[(chrom, strand)] = (first, last)
+        self.chroms = set(chrom for chrom, strand in self.vectors)
+        load = lambda name: np.load(
+                os.path.join(path, name), mmap_mode='r')
+        self.starts = load('starts.npy')
+        self.ends = load('ends.npy')
+        self.offsets = load('offsets.npy')
+        self.members = load('members.npy')
+
+    def lookup(self, chrom, strand, start, end):
+        """
+        Returns the set of feature IDs overlapping the half-open interval
+        [`start`, `end`) on `chrom` and `strand`.  Raises KeyError if the
+        chromosome is not in the annotation.
+        """
+        if not self.stranded:
+            strand = '.'
+        if chrom not in self.chroms:
+            raise KeyError(chrom)
+        try:
+            first, last = self.vectors[(chrom, strand)]
+        except KeyError:
+            return set()
+        # Steps don't overlap, so both starts and ends are sorted
+        i = first + int(np.searchsorted(
+                self.ends[first:last], start, side='right'))
+        j = first + int(np.searchsorted(
+                self.starts[first:last], end, side='left'))
+        found = set()
+        if i >= j:
+            return found
+        for m in self.members[self.offsets[i]:self.offsets[j]]:
+            found.add(self.id_names[m])
+        return found
+
+
+def load_index(gff, params, cache_dir, max_size=None):
+    """
+    Returns a CompiledFeatureIndex for `gff` and the parsed htseq `params`
+    from `cache_dir`, compiling and adding it first if needed.  If
+    `max_size` (bytes) is given, least recently used entries are evicted to
+    keep the cache under that size.
+
+    Several processes can call this at once; only one of them compiles
+    a missing entry while the others wait for it.
+    """
+    cache_dir = os.path.expanduser(cache_dir)
+    helpers.mkdir_p(cache_dir)
+    key = cache_key(gff, params, cache_dir)
+    path = os.path.join(cache_dir, key)
+
+    if not os.path.exists(path):
+        lock = open(os.path.join(cache_dir, 'keys', key + '.lock'), 'w')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if not os.path.exists(path):
+                tmp = tempfile.mkdtemp(dir=cache_dir, prefix='.build-')
+                index = counting.FeatureIndex(
+                        gff, feature_type=params['type'],
+                        idattr=params['idattr'], stranded=params['stranded'])
+                compile_index(index, tmp)
+                os.rename(tmp, path)
+                if max_size is not None:
+                    helpers.evict_lru(cache_dir, max_size, keep=key)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+    try:
+        os.utime(os.path.join(path, 'last_used'), None)
+        return CompiledFeatureIndex(path)
+    except (IOError, OSError):
+        # evicted by another process in the meantime; add it again
+        return load_index(gff, params, cache_dir, max_size)
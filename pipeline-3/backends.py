@@ -0,0 +1,377 @@
+#!/usr/bin/python
+"""
+Backends that run the pipeline's task functions (tasks.clip, tasks.bowtie,
+...) somewhere other than the ruffus job that calls them, so that one run
+isn't limited to one machine.
+
+ruffus still decides what needs to run, and in what order, in the head
+process.  Each job just hands its call to the backend, waits for the Result
+and reports it as usual.  Calls are pickled to a job file, so the function
+must be importable by name, and the job files and the pipeline's working
+directory must be on a filesystem that the workers share.
+
+    `local`: calls the function in the ruffus job itself (the default)
+    `queue`: a job queue in a directory, drained by worker daemons started
+             with "backends.py worker DIR"; a stand-in for a cluster that
+             works on one machine, or across machines sharing DIR
+    `sbatch`: submits each call to SLURM with "sbatch --wait"
+
+The queue directory contains:
+
+    `new/`: jobs waiting for a worker
+    `running/`: jobs claimed by a worker, which touches them while the job
+                runs; jobs whose worker has stopped touching them are put
+                back in `new/`
+    `done/`: the results of finished jobs, until the head collects them
+
+Each job file is named after the job ID and the claim it is for
+("<job ID>.<n>", n being the number of times it has been put back), so a
+worker that is given up on can't pass off its result, or remove the job
+file, of the claim that replaced it.
+"""
+import os
+import sys
+import time
+import uuid
+import pipes
+import shutil
+import socket
+import tempfile
+import traceback
+import subprocess
+import multiprocessing
+import cPickle
+from argparse import ArgumentParser
+import helpers
+
+# How often workers touch the jobs they are running, and how long the head
+# waits without seeing a new touch before giving a job to another worker
+HEARTBEAT = 5
+STALE = 60
+
+
+def write_pickle(obj, fn):
+    """
+    Atomically writes `obj` to the file `fn`.
+    """
+    fd, tmp = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(fn)), prefix='.tmp-')
+    fout = os.fdopen(fd, 'wb')
+    cPickle.dump(obj, fout, 2)
+    fout.close()
+    os.rename(tmp, fn)
+
+
+def read_pickle(fn):
+    fin = open(fn, 'rb')
+    obj = cPickle.load(fin)
+    fin.close()
+    return obj
+
+
+def new_job(func, args):
+    """
+    Returns an ID for a call to `func`, which sorts in submission order, and
+    the job to be pickled.
+    """
+    job_id = '%d-%s-%s' % (
+            time.time() * 1e6, func.__name__, uuid.uuid4().hex[:8])
+    job = {'func': func, 'args': args, 'cwd': os.getcwd()}
+    return job_id, job
+
+
+def run_job(jobfn, resultfn):
+    """
+    Runs the call in the job file `jobfn` and writes what it returned, or the
+    traceback if it raised, to `resultfn`.
+    """
+    out = {'host': socket.gethostname()}
+    try:
+        job = read_pickle(jobfn)
+        os.chdir(job['cwd'])
+        out['result'] = job['func'](*job['args'])
+    except Exception:
+        out['error'] = traceback.format_exc()
+    write_pickle(out, resultfn)
+
+
+def job_result(out, job_id):
+    """
+    Returns the Result from `out`, the output of run_job() for `job_id`, or
+    raises RuntimeError if the call failed.
+    """
+    if 'error' in out:
+        raise RuntimeError('Job %s failed on %s:\n%s' % (
+            job_id, out['host'], out['error']))
+    result = out['result']
+    result.stats['host'] = out['host']
+    return result
+
+
+def run_command(jobfn, resultfn):
+    """
+    Command that runs the job in `jobfn` in a new process.
+    """
+    return [sys.executable, os.path.abspath(__file__), 'run', jobfn, resultfn]
+
+
+def call_in_process(func, *args):
+    """
+    Returns func(*`args`), called in a new process by run_job(), or raises
+    RuntimeError if the call failed.  Unlike ruffus' daemonic workers and
+    its threads, the new process can start a multiprocessing pool.
+    """
+    job_id, job = new_job(func, args)
+    tmp = tempfile.mkdtemp(prefix='call-')
+    try:
+        jobfn = os.path.join(tmp, 'job')
+        resultfn = os.path.join(tmp, 'result')
+        write_pickle(job, jobfn)
+        p = helpers.popen(run_command(jobfn, resultfn))
+        helpers.wait(p)
+        if not os.path.exists(resultfn):
+            raise RuntimeError('Call %s exited with status %d' % (
+                job_id, p.returncode))
+        out = read_pickle(resultfn)
+    finally:
+        shutil.rmtree(tmp)
+    if 'error' in out:
+        raise RuntimeError('Call %s failed:\n%s' % (job_id, out['error']))
+    return out['result']
+
+
+class LocalBackend(object):
+    def call(self, func, *args):
+        """
+        Returns func(*`args`).
+        """
+        return func(*args)
+
+
+class QueueBackend(object):
+    def __init__(self, queue_dir, poll=0.2):
+        """
+        Runs calls through the job queue in `queue_dir`, checking for results
+        every `poll` seconds.
+        """
+        self.queue_dir = os.path.abspath(queue_dir)
+        self.poll = poll
+        for sub in ('new', 'running', 'done'):
+            helpers.mkdir_p(os.path.join(self.queue_dir, sub))
+
+    def path(self, sub, job_id, claim=0):
+        """
+        File of claim number `claim` of the job `job_id` in the `sub`
+        directory of the queue.
+        """
+        return os.path.join(self.queue_dir, sub, '%s.%d' % (job_id, claim))
+
+    def submit(self, func, args):
+        """
+        Queues the call func(*`args`) and returns its job ID.
+        """
+        job_id, job = new_job(func, args)
+        write_pickle(job, self.path('new', job_id))
+        return job_id
+
+    def wait(self, job_id):
+        """
+        Waits for the job `job_id` to finish and returns its Result.  If the
+        worker running it stops (its heartbeat hasn't changed for STALE
+        seconds), the job is queued again.
+
+        Heartbeats are only compared with earlier ones, and timed by this
+        host's clock, so workers' clocks needn't agree with it.  Only the
+        result of the latest claim is accepted.
+        """
+        requeued = 0
+        # (heartbeat mtime, when it was first seen here)
+        beat = None
+        while True:
+            done = self.path('done', job_id, requeued)
+            running = self.path('running', job_id, requeued)
+            if os.path.exists(done):
+                out = read_pickle(done)
+                os.unlink(done)
+                break
+            try:
+                mtime = os.path.getmtime(running)
+                now = time.time()
+                if beat is None or mtime != beat[0]:
+                    beat = (mtime, now)
+                elif now - beat[1] > STALE:
+                    os.rename(running,
+                              self.path('new', job_id, requeued + 1))
+                    requeued += 1
+                    beat = None
+            except OSError:
+                # not claimed yet, or just finished
+                beat = None
+            time.sleep(self.poll)
+        # Results of earlier claims that finished after all
+        for claim in range(requeued):
+            try:
+                os.unlink(self.path('done', job_id, claim))
+            except OSError:
+                pass
+        result = job_result(out, job_id)
+        if requeued:
+            result.stats['job requeues'] = requeued
+        return result
+
+    def call(self, func, *args):
+        """
+        Runs func(*`args`) on a worker and returns its Result.
+        """
+        return self.wait(self.submit(func, args))
+
+
+class SbatchBackend(object):
+    def __init__(self, job_dir, params=''):
+        """
+        Runs each call as a SLURM job, submitted with "sbatch --wait" plus the
+        options in `params`.  Job files, results and SLURM's output go in
+        `job_dir`.
+        """
+        self.job_dir = os.path.abspath(job_dir)
+        self.params = params or ''
+        helpers.mkdir_p(self.job_dir)
+
+    def call(self, func, *args):
+        """
+        Runs func(*`args`) as a SLURM job and returns its Result.
+        """
+        job_id, job = new_job(func, args)
+        base = os.path.join(self.job_dir, job_id)
+        jobfn, resultfn, log = base + '.job', base + '.result', base + '.out'
+        write_pickle(job, jobfn)
+        cmds = ['sbatch', '--wait', '--parsable', '--job-name',
+                func.__name__, '--output', log] + self.params.split() + [
+                '--wrap', ' '.join(
+                    pipes.quote(c) for c in run_command(jobfn, resultfn))]
+        p = helpers.popen(cmds, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = p.communicate()
+        os.unlink(jobfn)
+        if not os.path.exists(resultfn):
+            output = ''
+            if os.path.exists(log):
+                output = helpers.read_tail(open(log))
+            raise RuntimeError(
+                    'SLURM job %s (%s) failed with exit status %s:\n%s%s' % (
+                        stdout.strip(), job_id, p.returncode, stderr,
+                        output))
+        out = read_pickle(resultfn)
+        os.unlink(resultfn)
+        if 'error' not in out and os.path.exists(log):
+            os.unlink(log)
+        return job_result(out, job_id)
+
+
+def get_backend(options, config):
+    """
+    The backend chosen with --backend.
+    """
+    if options.backend == 'queue':
+        return QueueBackend(options.queue_dir)
+    if options.backend == 'sbatch':
+        return SbatchBackend(options.queue_dir, config.get('sbatch params'))
+    return LocalBackend()
+
+
+def worker(queue_dir, idle_exit=None, poll=0.2):
+    """
+    Runs jobs from the queue in `queue_dir` one at a time, each in a process
+    of its own, until there have been no jobs for `idle_exit` seconds (or
+    forever if it is None).
+    """
+    queue = QueueBackend(queue_dir)
+    idle_since = time.time()
+    new_dir = os.path.join(queue.queue_dir, 'new')
+    running_dir = os.path.join(queue.queue_dir, 'running')
+    while True:
+        claim = None
+        for name in sorted(os.listdir(new_dir)):
+            if name.startswith('.'):
+                continue
+            try:
+                os.rename(os.path.join(new_dir, name),
+                          os.path.join(running_dir, name))
+            except OSError:
+                # another worker got it first
+                continue
+            claim = name
+            break
+        if claim is None:
+            if idle_exit is not None and time.time() - idle_since > idle_exit:
+                return
+            time.sleep(poll)
+            continue
+
+        # The result is only moved to done/ by the worker, so that the head
+        # never sees a job that is still being written
+        running = os.path.join(running_dir, claim)
+        output = running + '.result'
+        p = subprocess.Popen(run_command(running, output))
+        last = time.time()
+        while p.poll() is None:
+            time.sleep(poll)
+            if time.time() - last > HEARTBEAT:
+                last = time.time()
+                try:
+                    os.utime(running, None)
+                except OSError:
+                    pass
+        if not os.path.exists(output):
+            write_pickle({
+                'host': socket.gethostname(),
+                'error': 'Job process exited with status %d\n' % p.returncode,
+            }, output)
+        if os.path.exists(running):
+            os.rename(output, os.path.join(queue.queue_dir, 'done', claim))
+            try:
+                os.unlink(running)
+            except OSError:
+                pass
+        else:
+            # The head gave up on this claim and requeued the job, and only
+            # takes the result of the claim that replaced it
+            os.unlink(output)
+        idle_since = time.time()
+
+
+def main():
+    parser = ArgumentParser(
+            description='Runs jobs submitted by pipeline.py --backend queue '
+                        'or sbatch.')
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('worker', help='Run jobs from a queue directory')
+    p.add_argument('queue_dir')
+    p.add_argument('-n', '--workers', type=int, default=1,
+                   help='Number of jobs to run at once (default '
+                        '%(default)s)')
+    p.add_argument('--idle-exit', type=float, metavar='SECONDS',
+                   help='Exit after this long without any jobs')
+    p = sub.add_parser('run', help='Run one job file')
+    p.add_argument('job')
+    p.add_argument('result')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        run_job(args.job, args.result)
+        return
+    workers = [
+        multiprocessing.Process(
+            target=worker, args=(args.queue_dir, args.idle_exit))
+        for i in range(args.workers)]
+    for w in workers:
+        w.start()
+    try:
+        for w in workers:
+            w.join()
+    except KeyboardInterrupt:
+        for w in workers:
+            w.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+"""
+Built-in adapter clipper, an alternative to fastx_clipper.
+
+Reads are processed in batches.  Within a batch, the sequences are packed
+into a 2D array and the adapter is searched for at each position across
+all reads at once with NumPy.  Batches can be spread over a pool of
+processes; output order is always the same as the input order.  If the
+input has an up-to-date index (see fastqindex.py), each worker reads its
+own batches from the file rather than being sent them.
+
+Matching is exact: a read is clipped at the leftmost position where either
+the whole adapter occurs, or the start of the adapter runs off the 3' end
+of the read for at least `min_overlap` bases.  Reads with Ns are kept, as
+with `fastx_clipper -n`.
+"""
+import itertools
+import subprocess
+import numpy as np
+import helpers
+import qc
+
+
+def read_batches(fastq, batch_size):
+    """
+    Yields lists of up to `batch_size` FASTQ records from the file `fastq`,
+    which may be compressed.  Each record is a tuple of its four lines,
+    without newlines.
+    """
+    f = helpers.open_fastq(fastq)
+    lines = (line.rstrip('\r\n') for line in f)
+    while True:
+        batch = []
+        for record in itertools.islice(
+                itertools.izip(lines, lines, lines, lines), batch_size):
+            batch.append(record)
+        if not batch:
+            break
+        yield batch
+    f.close()
+
+
+def find_adapter(seqs, adapter, min_overlap):
+    """
+    Returns an array with the position at which each sequence in `seqs`
+    should be clipped (its length if the adapter wasn't found), and a boolean
+    array of which ones contained the adapter.
+    """
+    n = len(seqs)
+    lengths = np.array([len(s) for s in seqs], dtype=np.int64)
+    clip_at = lengths.copy()
+    found = np.zeros(n, dtype=bool)
+    if n == 0:
+        return clip_at, found
+    width = int(lengths.max())
+    # Pad with zeros; a zero counts as a match so that a partial adapter at
+    # the 3' end of a read is found too.
+    arr = np.frombuffer(
+            ''.join(s.ljust(width, '\0') for s in seqs),
+            dtype=np.uint8).reshape(n, width)
+    ad = np.frombuffer(adapter, dtype=np.uint8)
+    k = len(ad)
+    for j in xrange(width):
+        m = min(k, width - j)
+        window = arr[:, j:j + m]
+        match = ((window == ad[:m]) | (window == 0)).all(axis=1)
+        overlap = np.minimum(lengths - j, k)
+        match &= (overlap >= min_overlap) & (overlap > 0) & ~found
+        clip_at[match] = j
+        found |= match
+    return clip_at, found
+
+
+def clip_batch(args):
+    """
+    Clips one batch of records.  `args` is a tuple of (records, adapter,
+    min_overlap, min_length, read_qc).  Returns the clipped records as FASTQ
+    text, a dictionary of counts for the clipping report, and, if `read_qc`
+    is true, a qc.ReadStats of the clipped reads (otherwise None).
+    """
+    records, adapter, min_overlap, min_length, read_qc = args
+    seqs = [r[1] for r in records]
+    clip_at, found = find_adapter(seqs, adapter, min_overlap)
+    stats = {'input': len(records), 'output': 0, 'too short': 0,
+             'adapter only': 0, 'clipped': int(found.sum())}
+    out = []
+    quals = []
+    for (name, seq, plus, qual), i in itertools.izip(records, clip_at):
+        if i == 0:
+            stats['adapter only'] += 1
+            continue
+        if i < min_length:
+            stats['too short'] += 1
+            continue
+        stats['output'] += 1
+        qual = qual[:i]
+        out.append('%s\n%s\n%s\n%s\n' % (name, seq[:i], plus, qual))
+        quals.append(qual)
+    read_stats = None
+    if read_qc:
+        read_stats = qc.ReadStats()
+        read_stats.add_qualities(quals)
+    return ''.join(out), stats, read_stats
+
+
+def clip_records(args):
+    """
+    Like clip_batch(), but `args` starts with (fastq, start, stop) rather
+    than records, and the batch is records `start` up to `stop` of the
+    indexed file `fastq`.
+    """
+    import fastqindex
+    fastq, start, stop = args[:3]
+    records = list(fastqindex.open_indexed(fastq).records(start, stop))
+    return clip_batch((records,) + args[3:])
+
+
+def clip(fastq, clipped_fastq, clipping_report, adapter, min_overlap=None,
+         min_length=5, batch_size=100000, processes=1, compress=False,
+         read_stats=None):
+    """
+    Clips `adapter` from the reads in `fastq`, writing them to
+    `clipped_fastq` and a fastx_clipper-style report to `clipping_report`.
+    Reads shorter than `min_length` after clipping are discarded.  By
+    default only full-length adapter matches count at the 3' end of a read;
+    set `min_overlap` to allow shorter ones.  If `compress` is True, the
+    clipped reads are gzip-compressed.  If `read_stats` (a qc.ReadStats) is
+    given, the clipped reads are added to it.
+
+    Batches are only spread over `processes` processes where
+    helpers.pool_map() can start them; the pipeline calls this through
+    tasks.pooled_call(), which sees to that.
+
+    Returns a dictionary of the counts that were reported.
+    """
+    if min_overlap is None:
+        min_overlap = len(adapter)
+    totals = {'input': 0, 'output': 0, 'too short': 0, 'adapter only': 0,
+              'clipped': 0}
+    import fastqindex
+    read_qc = read_stats is not None
+    options = (adapter, min_overlap, min_length, read_qc)
+    index = fastqindex.current_index(fastq)
+    if index is not None:
+        func = clip_records
+        jobs = ((fastq, start, start + batch_size) + options
+                for start in xrange(0, len(index), batch_size))
+    else:
+        func = clip_batch
+        jobs = ((batch,) + options
+                for batch in read_batches(fastq, batch_size))
+    # `clipped_fastq` may be a hard link to `fastq`; replace it instead of
+    # truncating both
+    helpers.unlink_output(clipped_fastq)
+    fout = open(clipped_fastq, 'w')
+    if compress:
+        gz = helpers.popen(
+                ['gzip', '-c', '-1'], stdin=subprocess.PIPE, stdout=fout)
+        out = gz.stdin
+    else:
+        out = fout
+    for text, stats, batch_stats in helpers.pool_map(func, jobs, processes):
+        out.write(text)
+        for key, value in stats.items():
+            totals[key] += value
+        if batch_stats is not None:
+            read_stats.merge(batch_stats)
+    if compress:
+        gz.stdin.close()
+        if gz.wait():
+            raise subprocess.CalledProcessError(gz.returncode, 'gzip -c -1')
+    fout.close()
+
+    fout = open(clipping_report, 'w')
+    fout.write('Clipping Adapter: %s\n' % adapter)
+    fout.write('Min. Length: %s\n' % min_length)
+    fout.write('Input: %s reads.\n' % totals['input'])
+    fout.write('Output: %s reads.\n' % totals['output'])
+    fout.write('discarded %s too-short reads.\n' % totals['too short'])
+    fout.write('discarded %s adapter-only reads.\n' % totals['adapter only'])
+    fout.close()
+    return totals
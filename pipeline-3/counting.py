@@ -0,0 +1,474 @@
+"""
+In-process replacement for htseq-count, built on HTSeq's Python API.
+
+The GFF is parsed into a FeatureIndex once per process and kept around, so
+counting many samples against the same annotation only pays for parsing it
+once.  Calling preload() before ruffus starts its worker processes means the
+workers inherit the already-built index.  Indexes can also be kept across
+runs with annotation_cache.py.
+
+A single large sample can also be counted by several processes at once:
+given a position-sorted, indexed BAM, the genome is split into regions
+with similar numbers of features, and each worker (this module, run as
+"counting.py regions ...") counts the reads that start in its regions.
+Every read starts in exactly one region, so the workers' counts add up to
+exactly what counting the whole file would give; "counting.py check"
+confirms this for a given file.  The workers memory-map an index compiled
+once by the parent rather than each parsing the GFF.
+"""
+import os
+import sys
+import json
+import math
+import gzip
+from argparse import ArgumentParser
+import HTSeq
+import helpers
+
+# Order in which htseq-count reports its special counters
+SPECIAL_COUNTERS = ['__no_feature', '__ambiguous', '__too_low_aQual',
+                    '__not_aligned', '__alignment_not_unique']
+
+# FeatureIndex objects that have already been built in this process, keyed
+# by index_key()
+_indexes = {}
+
+# Feature start positions already read in this process, keyed by
+# (index_key(), feature type)
+_starts = {}
+
+# Regions given to each worker process by region-parallel counting; having
+# more regions than workers evens out the load
+REGIONS_PER_PROCESS = 4
+
+
+def parse_htseq_params(params):
+    """
+    Parses the subset of htseq-count's command line options that affect
+    counting from the string `params` (e.g., config['htseq params']).
+    Returns a dictionary using htseq-count's defaults for missing options.
+    """
+    opts = {
+        'type': 'exon',
+        'idattr': 'gene_id',
+        'stranded': 'yes',
+        'mode': 'union',
+        'minaqual': 10,
+        'format': 'sam',
+    }
+    names = {
+        '-t': 'type', '--type': 'type',
+        '-i': 'idattr', '--idattr': 'idattr',
+        '-s': 'stranded', '--stranded': 'stranded',
+        '-m': 'mode', '--mode': 'mode',
+        '-a': 'minaqual', '--minaqual': 'minaqual',
+        '-f': 'format', '--format': 'format',
+    }
+    tokens = params.split()
+    while tokens:
+        token = tokens.pop(0)
+        if token in ('-q', '--quiet'):
+            continue
+        if '=' in token:
+            flag, value = token.split('=', 1)
+        else:
+            flag = token
+            value = None
+        if flag not in names:
+            raise ValueError(
+                    'Unsupported htseq-count option for the in-process '
+                    'counter: %s' % token)
+        if value is None:
+            value = tokens.pop(0)
+        opts[names[flag]] = value
+    opts['minaqual'] = int(opts['minaqual'])
+    if opts['mode'] != 'union':
+        raise ValueError(
+                'The in-process counter only supports "-m union", not "%s"'
+                % opts['mode'])
+    return opts
+
+
+class FeatureIndex(object):
+    def __init__(self, gff, feature_type='exon', idattr='gene_id',
+                 stranded='yes'):
+        """
+        Parses `gff` and indexes the features of type `feature_type` by their
+        `idattr` attribute, just like htseq-count does.
+        """
+        self.stranded = stranded != 'no'
+        self.features = HTSeq.GenomicArrayOfSets(
+                'auto', stranded=self.stranded)
+        self.ids = set()
+        for f in HTSeq.GFF_Reader(gff):
+            if f.type != feature_type:
+                continue
+            try:
+                feature_id = f.attr[idattr]
+            except KeyError:
+                raise ValueError(
+                        "Feature %s does not contain a '%s' attribute"
+                        % (f.name, idattr))
+            if self.stranded and f.iv.strand == '.':
+                raise ValueError(
+                        "Feature %s at %s does not have strand information "
+                        "but counting is stranded" % (f.name, f.iv))
+            self.features[f.iv] += feature_id
+            self.ids.add(feature_id)
+
+    def lookup(self, chrom, strand, start, end):
+        """
+        Returns the set of feature IDs overlapping the half-open interval
+        [`start`, `end`) on `chrom` and `strand`.  Raises KeyError if the
+        chromosome is not in the annotation.
+        """
+        if not self.stranded:
+            strand = '.'
+        iv = HTSeq.GenomicInterval(chrom, start, end, strand)
+        found = set()
+        for iv2, step in self.features[iv].steps():
+            found |= step
+        return found
+
+
+def index_key(gff, params):
+    """
+    Key identifying the FeatureIndex needed for counting against `gff` with
+    the parsed htseq `params`.
+    """
+    st = os.stat(gff)
+    return (os.path.abspath(gff), st.st_size, st.st_mtime,
+            params['type'], params['idattr'], params['stranded'] != 'no')
+
+
+def get_index(gff, params, cache_dir=None, max_size=None):
+    """
+    Returns a FeatureIndex for `gff` and the parsed htseq `params`, building
+    it only if it hasn't already been built in this process.
+
+    If `cache_dir` is given, the index is instead loaded from (or added to)
+    the persistent cache in that directory; see annotation_cache.py.
+    """
+    key = index_key(gff, params)
+    if key not in _indexes:
+        if cache_dir:
+            import annotation_cache
+            _indexes[key] = annotation_cache.load_index(
+                    gff, params, cache_dir, max_size)
+        else:
+            _indexes[key] = FeatureIndex(
+                    gff, feature_type=params['type'],
+                    idattr=params['idattr'], stranded=params['stranded'])
+    return _indexes[key]
+
+
+def get_config_index(config):
+    """
+    Returns the index for config['gff'] and config['htseq params'], using
+    the annotation cache if config['annotation cache dir'] is set.
+    """
+    params = parse_htseq_params(config['htseq params'])
+    max_size = config.get('annotation cache size')
+    if max_size is not None:
+        max_size = helpers.parse_size(max_size)
+    index = get_index(
+            config['gff'], params,
+            cache_dir=config.get('annotation cache dir'), max_size=max_size)
+    return index, params
+
+
+def preload(config):
+    """
+    Builds the FeatureIndex for the GFF in `config` so that processes forked
+    afterwards share it.
+    """
+    get_config_index(config)
+
+
+def count_alignments(index, alignments, params, counts=None):
+    """
+    Counts `alignments` (an iterable of HTSeq.SAM_Alignment objects) against
+    `index` in htseq-count's "union" mode.  Returns a dictionary of counts
+    for every feature ID plus the special counters.  If `counts` is given,
+    the alignments are added to it instead.
+    """
+    if counts is None:
+        counts = empty_counts(index)
+    minaqual = params['minaqual']
+    reverse = params['stranded'] == 'reverse'
+    flip = {'+': '-', '-': '+'}
+
+    for aln in alignments:
+        if not aln.aligned:
+            counts['__not_aligned'] += 1
+            continue
+        try:
+            nh = aln.optional_field('NH')
+        except KeyError:
+            nh = 1
+        if nh > 1:
+            counts['__alignment_not_unique'] += 1
+            continue
+        if aln.aQual < minaqual:
+            counts['__too_low_aQual'] += 1
+            continue
+
+        strand = aln.iv.strand
+        if reverse:
+            strand = flip.get(strand, strand)
+        found = set()
+        try:
+            for co in aln.cigar:
+                if co.type in ('M', '=', 'X') and co.size > 0:
+                    found |= index.lookup(
+                            co.ref_iv.chrom, strand, co.ref_iv.start,
+                            co.ref_iv.end)
+        except KeyError:
+            # chromosome not in the annotation
+            found = set()
+
+        if len(found) == 0:
+            counts['__no_feature'] += 1
+        elif len(found) > 1:
+            counts['__ambiguous'] += 1
+        else:
+            counts[list(found)[0]] += 1
+    return counts
+
+
+def empty_counts(index):
+    """
+    A count of zero for every feature ID in `index` and special counter.
+    """
+    counts = dict((feature_id, 0) for feature_id in index.ids)
+    for name in SPECIAL_COUNTERS:
+        counts[name] = 0
+    return counts
+
+
+def add_counts(counts, more):
+    """
+    Adds the counts in the dictionary `more` to `counts`.
+    """
+    for name, n in more.iteritems():
+        counts[name] = counts.get(name, 0) + n
+    return counts
+
+
+def write_counts(counts, countfile):
+    """
+    Writes `counts` to `countfile` in the same format as htseq-count.
+    """
+    fout = open(countfile, 'w')
+    for feature_id in sorted(k for k in counts if k not in SPECIAL_COUNTERS):
+        fout.write('%s\t%d\n' % (feature_id, counts[feature_id]))
+    for name in SPECIAL_COUNTERS:
+        fout.write('%s\t%d\n' % (name, counts[name]))
+    fout.close()
+
+
+def count(samfile, countfile, config):
+    """
+    Counts the reads in `samfile` (SAM or BAM) against config['gff'] using
+    the options in config['htseq params'], writing htseq-count-style output
+    to `countfile`.
+    Returns the counts.
+    """
+    index, params = get_config_index(config)
+    if params['format'] == 'bam' or helpers.is_gzipped(samfile):
+        alignments = HTSeq.BAM_Reader(samfile)
+    else:
+        alignments = HTSeq.SAM_Reader(samfile)
+    counts = count_alignments(index, alignments, params)
+    write_counts(counts, countfile)
+    return counts
+
+
+def feature_starts(gff, params):
+    """
+    Returns a dictionary of the sorted 0-based start positions of the
+    features counted with the parsed htseq `params`, on each chromosome of
+    `gff`.  Only the positions are needed, so the GFF is split by hand
+    rather than parsed by HTSeq.
+    """
+    key = index_key(gff, params), params['type']
+    if key not in _starts:
+        starts = {}
+        if helpers.is_gzipped(gff):
+            lines = gzip.open(gff)
+        else:
+            lines = open(gff)
+        for line in lines:
+            if line.startswith('#'):
+                continue
+            fields = line.split('\t')
+            if len(fields) < 9 or fields[2] != params['type']:
+                continue
+            starts.setdefault(fields[0], []).append(int(fields[3]) - 1)
+        for chrom_starts in starts.values():
+            chrom_starts.sort()
+        _starts[key] = starts
+    return _starts[key]
+
+
+def balanced_regions(starts, chrom_lengths, n):
+    """
+    Splits the chromosomes in `chrom_lengths`, a list of (name, length), into
+    about `n` regions with similar numbers of the features in `starts` (see
+    feature_starts()).  Returns a list of (chrom, start, end) half-open
+    intervals that cover every base exactly once.
+    """
+    total = sum(len(starts.get(chrom, [])) for chrom, length in chrom_lengths)
+    per_region = max(1, int(math.ceil(total / float(max(1, n)))))
+    regions = []
+    for chrom, length in chrom_lengths:
+        chrom_starts = starts.get(chrom, [])
+        begin = 0
+        for i in range(per_region, len(chrom_starts), per_region):
+            cut = min(chrom_starts[i], length)
+            if cut > begin:
+                regions.append((chrom, begin, cut))
+                begin = cut
+        regions.append((chrom, begin, length))
+    return regions
+
+
+def format_region(region):
+    return '%s:%d-%d' % region
+
+
+def parse_region(text):
+    chrom, span = text.rsplit(':', 1)
+    start, end = span.split('-')
+    return chrom, int(start), int(end)
+
+
+def count_regions(bamfile, regions, index, params, counts=None):
+    """
+    Counts the alignments in the indexed BAM `bamfile` that start in
+    `regions` (see balanced_regions()) against `index`, like
+    count_alignments().  Alignments that merely overlap a region are left
+    for the region they start in.
+    """
+    import pysam
+    sf = pysam.AlignmentFile(bamfile, 'rb')
+    for chrom, start, end in regions:
+        alignments = (
+            HTSeq.SAM_Alignment.from_pysam_AlignedSegment(read, sf)
+            for read in sf.fetch(chrom, start, end)
+            if start <= read.reference_start < end)
+        counts = count_alignments(index, alignments, params, counts)
+    sf.close()
+    if counts is None:
+        counts = empty_counts(index)
+    return counts
+
+
+def compile_config_index(config, outdir):
+    """
+    Returns the directory of a compiled copy of the index for `config` (see
+    annotation_cache.py), which other processes can memory-map instead of
+    parsing the GFF again: its entry in config['annotation cache dir'] if
+    that is set, and otherwise `outdir`, where it is compiled.
+    """
+    import annotation_cache
+    index, params = get_config_index(config)
+    if isinstance(index, annotation_cache.CompiledFeatureIndex):
+        return index.path
+    annotation_cache.compile_index(index, outdir)
+    return outdir
+
+
+def region_worker_cmds(bamfile, regions, config, index_dir):
+    """
+    Command that counts the reads of `bamfile` in `regions` against the
+    compiled index in `index_dir` (see compile_config_index()) with the
+    settings in `config`, in a new process, and prints the counts as JSON.
+    """
+    script = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+    cmds = [sys.executable, script, 'regions', bamfile,
+            '--index', index_dir, '--htseq-params', config['htseq params']]
+    return cmds + [format_region(region) for region in regions]
+
+
+def check(samfile, config):
+    """
+    Counts `samfile` with both the "inprocess" and "regions" count engines
+    (see tasks.count()) and returns a list of (name, inprocess count,
+    regions count) for every feature or special counter where they differ.
+    """
+    import shutil
+    import tempfile
+    import tasks
+    tmp = tempfile.mkdtemp(prefix='count-check-')
+    try:
+        counts = {}
+        for engine in ('inprocess', 'regions'):
+            countfile = os.path.join(tmp, engine + '.count')
+            result = tasks.count(
+                    samfile, countfile, dict(config, **{
+                        'count engine': engine, 'result cache dir': None}))
+            if result.failed:
+                raise RuntimeError(
+                        '%s counting failed: %s' % (engine, result.stderr))
+            counts[engine] = dict(
+                    (name, int(n)) for name, n in (
+                        line.rstrip('\n').split('\t')
+                        for line in open(countfile)))
+    finally:
+        shutil.rmtree(tmp)
+    names = set(counts['inprocess']) | set(counts['regions'])
+    return [(name, counts['inprocess'].get(name),
+             counts['regions'].get(name))
+            for name in sorted(names)
+            if counts['inprocess'].get(name) != counts['regions'].get(name)]
+
+
+def main():
+    parser = ArgumentParser(
+            description='Counts reads against a GFF like htseq-count.')
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser(
+            'regions',
+            help='Count the reads of an indexed BAM file that start in the '
+                 'given regions (chrom:start-end, 0-based, half-open) and '
+                 'print the counts as JSON')
+    p.add_argument('bam')
+    p.add_argument('regions', nargs='+')
+    p.add_argument('--index', required=True,
+                   help='Compiled feature index (see annotation_cache.py)')
+    p.add_argument('--htseq-params', required=True)
+    p = sub.add_parser(
+            'check',
+            help='Check that the "inprocess" and "regions" count engines '
+                 'give the same counts for a SAM or BAM file; exits with '
+                 'status 1 and lists the differences if not')
+    p.add_argument('samfile')
+    p.add_argument('--gff', required=True)
+    p.add_argument('--htseq-params', required=True)
+    p.add_argument('--processes', type=int, default=4)
+    args = parser.parse_args()
+
+    if args.command == 'check':
+        differences = check(args.samfile, {
+            'gff': args.gff,
+            'htseq params': args.htseq_params,
+            'count processes': args.processes,
+        })
+        for name, inprocess, regions in differences:
+            print '%s\tinprocess=%s\tregions=%s' % (name, inprocess, regions)
+        if differences:
+            sys.exit(1)
+        print 'counts match'
+        return
+
+    import annotation_cache
+    index = annotation_cache.CompiledFeatureIndex(args.index)
+    params = parse_htseq_params(args.htseq_params)
+    counts = count_regions(
+            args.bam, [parse_region(r) for r in args.regions], index, params)
+    json.dump(counts, sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,470 @@
+#!/usr/bin/python
+"""
+Index of the records in an uncompressed FASTQ file, for random access by
+record number or byte range without reading the file from the start.
+
+The index is kept next to the FASTQ, like a .fai next to a FASTA file, as
+`reads.fastq.fqi`.  It holds the byte offset of every `interval`th record
+(every 1000th by default), so finding record k is one lookup in the index
+and a scan over at most `interval` - 1 records of the memory-mapped file.
+
+An index file contains:
+
+    a header: "FQI1", the FASTQ's size (uint64) and mtime (float64) when it
+              was indexed, the interval (uint64) and the number of records
+              (uint64), all little-endian
+    the offsets: uint64 byte offset of records 0, interval, 2 * interval, ...
+
+The index is built in two passes over the file, each split into byte ranges
+that are processed in parallel: the first counts the lines in each range,
+so each range knows the number of its first record, and the second picks
+out the offsets.  Ranges start at a record boundary found by looking for a
+line starting with "@" followed two lines later by one starting with "+".
+Compressed files can't be indexed.
+
+Example::
+
+    ./fastqindex.py build reads.fastq --processes 4
+    ./fastqindex.py get reads.fastq 1000000
+"""
+import os
+import sys
+import mmap
+import struct
+import random
+import itertools
+import tempfile
+from argparse import ArgumentParser
+import numpy as np
+import helpers
+
+MAGIC = 'FQI1'
+HEADER = struct.Struct('<4sQdQQ')
+OFFSET_DTYPE = np.dtype('<u8')
+
+# Records between indexed offsets
+INTERVAL = 1000
+
+# Bytes read at a time when scanning the file
+BLOCK_SIZE = 1 << 24
+
+# Records split out of the file at a time by IndexedFastq.records()
+RECORDS_PER_BLOCK = 10000
+
+# Smallest byte range worth giving to its own worker
+MIN_RANGE = 1 << 24
+
+
+def index_file(fastq):
+    """
+    Filename of the index of `fastq`.
+    """
+    return fastq + '.fqi'
+
+
+def _map_file(path):
+    # Read-only memory map of `path`; empty files can't be mapped
+    f = open(path, 'rb')
+    try:
+        if not os.fstat(f.fileno()).st_size:
+            return ''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+
+def _sync(mm, pos):
+    # Offset of the first record that starts at or after `pos`, or the size
+    # of the file if there is none
+    size = len(mm)
+    if pos <= 0:
+        return 0
+    line = mm.find('\n', pos - 1) + 1
+    while 0 < line < size:
+        if mm[line] == '@':
+            name_end = mm.find('\n', line)
+            plus = mm.find('\n', name_end + 1) + 1
+            if name_end >= 0 and plus and mm[plus:plus + 1] == '+':
+                return line
+        line = mm.find('\n', line) + 1
+    return size
+
+
+def _count_lines(args):
+    # Number of newlines in the byte range [start, end) of a FASTQ
+    fastq, start, end = args
+    mm = _map_file(fastq)
+    lines = 0
+    for pos in xrange(start, end, BLOCK_SIZE):
+        lines += mm[pos:min(end, pos + BLOCK_SIZE)].count('\n')
+    return lines
+
+
+def _range_offsets(args):
+    # Offsets of the records in the byte range [start, end) of a FASTQ whose
+    # numbers are multiples of `interval`, given that the first record in
+    # the range is record number `first`
+    fastq, start, end, first, interval = args
+    mm = _map_file(fastq)
+    parts = []
+    if first % interval == 0 and start < end:
+        parts.append(np.array([start], dtype=OFFSET_DTYPE))
+    # A record starts after line number m (counting from 0 in the range) if
+    # m + 1 is a multiple of 4; it is indexed if its number is a multiple of
+    # `interval` too
+    period = 4 * interval
+    wanted = 4 * (-first % interval)
+    lines = 0
+    for pos in xrange(start, end, BLOCK_SIZE):
+        block = mm[pos:min(end, pos + BLOCK_SIZE)]
+        newlines = np.flatnonzero(
+                np.frombuffer(block, dtype=np.uint8) == ord('\n'))
+        m = np.arange(lines, lines + len(newlines), dtype=np.int64)
+        keep = (m + 1) % period == wanted
+        parts.append((newlines[keep] + pos + 1).astype(OFFSET_DTYPE))
+        lines += len(newlines)
+    offsets = np.concatenate(parts) if parts else np.zeros(0, OFFSET_DTYPE)
+    # A record can't start at the very end of the range
+    return offsets[offsets < end]
+
+
+def build_index(fastq, interval=INTERVAL, processes=1):
+    """
+    Indexes every `interval`th record of `fastq`, using up to `processes`
+    processes (where helpers.pool_map() can start them; see
+    tasks.pooled_call()), and writes the index to index_file(`fastq`).
+    Returns the FastqIndex.
+
+    Raises ValueError if `fastq` is compressed or its lines don't make up
+    four-line records.
+    """
+    if helpers.is_gzipped(fastq):
+        raise ValueError("%s is compressed and can't be indexed" % fastq)
+    st = os.stat(fastq)
+    size = st.st_size
+    mm = _map_file(fastq)
+    n = max(1, min(4 * processes, size // MIN_RANGE))
+    starts = sorted(set(_sync(mm, size * i // n) for i in range(n)))
+    ranges = [(fastq, start, end)
+              for start, end in zip(starts, starts[1:] + [size])
+              if start < end]
+    counts = list(helpers.pool_map(_count_lines, ranges, processes))
+
+    # Every range but the last ends where a record starts; the last may be
+    # missing its final newline
+    for (_, start, end), lines in zip(ranges[:-1], counts[:-1]):
+        if lines % 4:
+            raise ValueError(
+                    '%s: bytes %d-%d are not whole 4-line FASTQ records' % (
+                        fastq, start, end))
+    if ranges and size and mm[size - 1] != '\n':
+        counts[-1] += 1
+    total_lines = sum(counts)
+    if total_lines % 4:
+        raise ValueError(
+                '%s has %d lines, not a multiple of 4' % (fastq, total_lines))
+
+    jobs = []
+    first = 0
+    for (_, start, end), lines in zip(ranges, counts):
+        jobs.append((fastq, start, end, first, interval))
+        first += lines // 4
+    parts = list(helpers.pool_map(_range_offsets, jobs, processes))
+    offsets = np.concatenate(parts) if parts else np.zeros(0, OFFSET_DTYPE)
+    records = total_lines // 4
+    expected = (records + interval - 1) // interval
+    if len(offsets) != expected:
+        raise ValueError(
+                '%s: found %d indexed records, expected %d; is it a FASTQ '
+                'file?' % (fastq, len(offsets), expected))
+
+    fn = index_file(fastq)
+    fd, tmp = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(fn)), prefix='.tmp-')
+    # readable by whoever can read the FASTQ it sits next to
+    os.fchmod(fd, helpers.FILE_MODE)
+    fout = os.fdopen(fd, 'wb')
+    fout.write(HEADER.pack(MAGIC, size, st.st_mtime, interval, records))
+    fout.write(offsets.astype(OFFSET_DTYPE).tostring())
+    fout.close()
+    os.rename(tmp, fn)
+    return FastqIndex(fn)
+
+
+class FastqIndex(object):
+    def __init__(self, path):
+        """
+        Loads the index file `path`.  The offsets are memory-mapped rather
+        than read.
+        """
+        self.path = path
+        f = open(path, 'rb')
+        header = f.read(HEADER.size)
+        f.close()
+        if len(header) != HEADER.size or header[:4] != MAGIC:
+            raise ValueError('%s is not a FASTQ index' % path)
+        _, self.size, self.mtime, self.interval, self.records = \
+            HEADER.unpack(header)
+        n = (self.records + self.interval - 1) // self.interval
+        if n:
+            self.offsets = np.memmap(path, dtype=OFFSET_DTYPE, mode='r',
+                                     offset=HEADER.size, shape=(n,))
+        else:
+            self.offsets = np.zeros(0, dtype=OFFSET_DTYPE)
+
+    def __len__(self):
+        return self.records
+
+    def is_current(self, fastq, interval=None):
+        """
+        Whether this is the index of `fastq` as it is now, made with
+        `interval` if given.
+        """
+        st = os.stat(fastq)
+        return ((self.size, self.mtime) == (st.st_size, st.st_mtime)
+                and interval in (None, self.interval))
+
+
+def current_index(fastq, interval=None):
+    """
+    The FastqIndex of `fastq` if it has one that is up to date (and made
+    with `interval`, if given); otherwise None.
+    """
+    fn = index_file(fastq)
+    if not os.path.exists(fn):
+        return None
+    try:
+        index = FastqIndex(fn)
+    except ValueError:
+        return None
+    if not index.is_current(fastq, interval):
+        return None
+    return index
+
+
+class IndexedFastq(object):
+    def __init__(self, fastq, index=None):
+        """
+        Memory-maps the FASTQ file `fastq` for random access with its
+        FastqIndex `index`, which by default is loaded from
+        index_file(`fastq`).  Raises ValueError if the index is out of date.
+        """
+        self.fastq = fastq
+        if index is None:
+            index = FastqIndex(index_file(fastq))
+        if not index.is_current(fastq):
+            raise ValueError(
+                    '%s has changed since it was indexed; rebuild %s' % (
+                        fastq, index.path))
+        self.index = index
+        self._mm = _map_file(fastq)
+        self.size = len(self._mm)
+
+    def __len__(self):
+        return self.index.records
+
+    def offset(self, k):
+        """
+        Byte offset of record number `k` (from 0).  len(self) is allowed,
+        and gives the size of the file.
+        """
+        n = len(self)
+        if k < 0:
+            k += n
+        if k == n:
+            return self.size
+        if not 0 <= k < n:
+            raise IndexError('record %d of %d' % (k, n))
+        pos = int(self.index.offsets[k // self.index.interval])
+        find = self._mm.find
+        for i in xrange(4 * (k % self.index.interval)):
+            pos = find('\n', pos) + 1
+        return pos
+
+    def _read(self, pos, end):
+        # Yields the records starting at `pos` up to the one that starts at
+        # or after `end`
+        mm = self._mm
+        while pos < end:
+            lines = []
+            for i in range(4):
+                next_pos = mm.find('\n', pos)
+                if next_pos < 0:
+                    next_pos = self.size
+                lines.append(mm[pos:next_pos].rstrip('\r'))
+                pos = next_pos + 1
+            yield tuple(lines)
+
+    def record(self, k):
+        """
+        Record number `k` as a tuple of its four lines, without newlines.
+        """
+        pos = self.offset(k)
+        return next(self._read(pos, pos + 1))
+
+    def records(self, start=0, stop=None):
+        """
+        Yields records `start` up to (not including) `stop`, by default to
+        the end of the file.
+        """
+        if stop is None or stop > len(self):
+            stop = len(self)
+        # Records are split out of a block of text at a time; blocks end at
+        # indexed records so their ends are found without scanning
+        step = self.index.interval * max(1, RECORDS_PER_BLOCK //
+                                         self.index.interval)
+        k = start
+        pos = self.offset(start)
+        while k < stop:
+            next_k = min(stop, (k // step + 1) * step)
+            next_pos = self.offset(next_k)
+            text = self._mm[pos:next_pos]
+            lines = text.split('\n')
+            if len(lines) % 4:
+                # the text ended with a newline
+                lines.pop()
+            if '\r' in text:
+                lines = [line.rstrip('\r') for line in lines]
+            it = iter(lines)
+            for record in itertools.izip(it, it, it, it):
+                yield record
+            k, pos = next_k, next_pos
+
+    def text(self, start=0, stop=None):
+        """
+        FASTQ text of records `start` up to (not including) `stop`, copied
+        straight from the file.
+        """
+        if stop is None or stop > len(self):
+            stop = len(self)
+        if start >= stop:
+            return ''
+        return self._mm[self.offset(start):self.offset(stop)]
+
+    def blocks(self, start=0, stop=None, block_size=BLOCK_SIZE):
+        """
+        Yields the FASTQ text of records `start` up to (not including)
+        `stop`, as text() would give it, in pieces of whole records of about
+        `block_size` bytes (split at indexed records), so that a long range
+        needn't be held in memory at once.
+        """
+        if stop is None or stop > len(self):
+            stop = len(self)
+        if start >= stop:
+            return
+        pos, end = self.offset(start), self.offset(stop)
+        offsets = self.index.offsets
+        while pos < end:
+            i = int(np.searchsorted(offsets, pos + block_size))
+            next_pos = end
+            if i < len(offsets) and offsets[i] < end:
+                next_pos = int(offsets[i])
+            yield self._mm[pos:next_pos]
+            pos = next_pos
+
+    def find_record(self, pos):
+        """
+        Number and offset of the first record that starts at or after byte
+        `pos`; (len(self), size) if there is none.
+        """
+        if pos >= self.size or not len(self):
+            return len(self), self.size
+        offsets = self.index.offsets
+        block = max(0, int(np.searchsorted(offsets, pos, 'right')) - 1)
+        k = block * self.index.interval
+        offset = int(offsets[block])
+        find = self._mm.find
+        while offset < pos and k < len(self):
+            for i in range(4):
+                offset = find('\n', offset) + 1
+            k += 1
+        if k == len(self):
+            offset = self.size
+        return k, offset
+
+    def byte_range(self, start, end):
+        """
+        Yields the records that start within bytes [`start`, `end`), so that
+        consecutive ranges together yield each record exactly once.
+        """
+        return self.records(self.find_record(start)[0],
+                            self.find_record(end)[0])
+
+    def split(self, n):
+        """
+        Splits the records into `n` ranges of about the same number of
+        records.  Returns a list of (start, stop) record numbers, without
+        empty ranges.
+        """
+        bounds = [len(self) * i // n for i in range(n + 1)]
+        return [(a, b) for a, b in zip(bounds, bounds[1:]) if a < b]
+
+    def sample(self, n, seed=None):
+        """
+        Yields `n` records (or all of them, if there are fewer) chosen at
+        random without replacement, in file order.
+        """
+        n = min(n, len(self))
+        for k in sorted(random.Random(seed).sample(xrange(len(self)), n)):
+            yield self.record(k)
+
+    def close(self):
+        if not isinstance(self._mm, str):
+            self._mm.close()
+
+
+# The IndexedFastq that a worker process last read records from, kept open
+# for its next batch
+_last_opened = [None]
+
+
+def open_indexed(fastq):
+    """
+    IndexedFastq of `fastq`, reusing the one opened by the last call in this
+    process if it is for the same, unchanged file.
+    """
+    reads = _last_opened[0]
+    if (reads is None or reads.fastq != fastq
+            or not reads.index.is_current(fastq)):
+        if reads is not None:
+            reads.close()
+        reads = _last_opened[0] = IndexedFastq(fastq)
+    return reads
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0])
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('build', help='Index a FASTQ file')
+    p.add_argument('fastq')
+    p.add_argument('--interval', type=int, default=INTERVAL,
+                   help='Index every this many records (default '
+                        '%(default)s)')
+    p.add_argument('--processes', type=int, default=1,
+                   help='Number of processes (default %(default)s)')
+    p = sub.add_parser('get', help='Print records by number')
+    p.add_argument('fastq')
+    p.add_argument('start', type=int)
+    p.add_argument('stop', type=int, nargs='?',
+                   help='Print records up to this one (default: only START)')
+    p = sub.add_parser('sample', help='Print records chosen at random')
+    p.add_argument('fastq')
+    p.add_argument('n', type=int)
+    p.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        index = build_index(args.fastq, args.interval, args.processes)
+        print '%s: %d records' % (index.path, len(index))
+        return
+    reads = IndexedFastq(args.fastq)
+    if args.command == 'get':
+        stop = args.stop if args.stop is not None else args.start + 1
+        sys.stdout.write(reads.text(args.start, stop))
+    else:
+        for record in reads.sample(args.n, args.seed):
+            sys.stdout.write('\n'.join(record) + '\n')
+
+
+if __name__ == '__main__':
+    main()
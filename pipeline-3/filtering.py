@@ -0,0 +1,149 @@
+"""
+Single-pass read filter, an alternative to the SAM -> BAM -> intersectBed ->
+BAM -> SAM round trip in tasks.filter.
+
+The BED file is loaded once per process into an IntervalIndex.  Alignments
+are then streamed from the input to the output, dropping those whose
+reference span overlaps a BED interval (like `intersectBed -v`).  Header
+lines and unmapped reads are passed through unchanged, so the output can be
+counted just like the unfiltered file.
+"""
+import os
+import bisect
+import subprocess
+import helpers
+
+# IntervalIndex objects that have already been built in this process
+_indexes = {}
+
+# CIGAR operations that consume the reference
+REF_OPS = 'MDN=X'
+
+
+class IntervalIndex(object):
+    def __init__(self, bed):
+        """
+        Loads the intervals in the BED file `bed`, merging overlapping ones
+        so that each chromosome has a sorted list of disjoint intervals.
+        """
+        intervals = {}
+        for line in open(bed):
+            if line.startswith(('#', 'track', 'browser')) or not line.strip():
+                continue
+            fields = line.split('\t')
+            chrom, start, end = fields[0], int(fields[1]), int(fields[2])
+            intervals.setdefault(chrom, []).append((start, end))
+
+        self.starts = {}
+        self.ends = {}
+        for chrom, ivs in intervals.items():
+            starts, ends = [], []
+            for start, end in sorted(ivs):
+                if ends and start <= ends[-1]:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            self.starts[chrom] = starts
+            self.ends[chrom] = ends
+
+    def overlaps(self, chrom, start, end):
+        """
+        True if the half-open interval [`start`, `end`) on `chrom` overlaps
+        any interval in the index.
+        """
+        try:
+            starts = self.starts[chrom]
+        except KeyError:
+            return False
+        # last interval starting before `end`
+        i = bisect.bisect_left(starts, end) - 1
+        return i >= 0 and self.ends[chrom][i] > start
+
+
+def get_index(bed):
+    """
+    Returns an IntervalIndex for `bed`, only building it if it hasn't already
+    been built in this process.
+    """
+    st = os.stat(bed)
+    key = (os.path.abspath(bed), st.st_size, st.st_mtime)
+    if key not in _indexes:
+        _indexes[key] = IntervalIndex(bed)
+    return _indexes[key]
+
+
+def reference_span(pos, cigar):
+    """
+    Returns the 0-based, half-open reference interval covered by an alignment
+    with 1-based leftmost position `pos` and CIGAR string `cigar`.
+    """
+    start = pos - 1
+    length = 0
+    num = 0
+    for c in cigar:
+        if c.isdigit():
+            num = num * 10 + int(c)
+        else:
+            if c in REF_OPS:
+                length += num
+            num = 0
+    return start, start + length
+
+
+def filter_lines(lines, fout, index):
+    """
+    Writes the SAM `lines` to `fout`, dropping aligned reads that overlap
+    `index`.  Returns the number of reads kept and dropped.
+    """
+    kept = dropped = 0
+    for line in lines:
+        if line.startswith('@'):
+            fout.write(line)
+            continue
+        fields = line.split('\t', 6)
+        flag, chrom, cigar = int(fields[1]), fields[2], fields[5]
+        if not (flag & 4 or chrom == '*' or cigar == '*'):
+            start, end = reference_span(int(fields[3]), cigar)
+            if index.overlaps(chrom, start, end):
+                dropped += 1
+                continue
+        fout.write(line)
+        kept += 1
+    return kept, dropped
+
+
+def filter(infile, outfile, bed, bam_cmds=None):
+    """
+    Copies the alignments in `infile` (SAM or BAM) to `outfile` as SAM,
+    dropping reads that overlap intervals in `bed`.  If `bam_cmds` is given,
+    the output is piped through that command (e.g., "samtools view -S -b -")
+    to write a BAM file instead.
+
+    Returns the number of reads kept and dropped.
+    """
+    index = get_index(bed)
+    procs = []
+    fout = open(outfile, 'w')
+    if bam_cmds is not None:
+        p = helpers.popen(bam_cmds, stdin=subprocess.PIPE, stdout=fout)
+        procs.append((p, bam_cmds))
+        out = p.stdin
+    else:
+        out = fout
+    if helpers.is_gzipped(infile):
+        cmds = ['samtools', 'view', '-h', infile]
+        p = helpers.popen(cmds, stdout=subprocess.PIPE, bufsize=-1)
+        procs.append((p, cmds))
+        fin = p.stdout
+    else:
+        fin = open(infile)
+    kept, dropped = filter_lines(fin, out, index)
+    fin.close()
+    if out is not fout:
+        out.close()
+    for p, cmds in procs:
+        if p.wait():
+            raise subprocess.CalledProcessError(p.returncode, ' '.join(cmds))
+    fout.close()
+    return kept, dropped
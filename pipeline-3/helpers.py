@@ -1,18 +1,36 @@
 import os
 import sys
+import errno
+import glob
+import json
+import cPickle
+import fcntl
+import shutil
+import hashlib
+import gzip
+import resource
+import itertools
+import functools
+import threading
+import subprocess
+import collections
+import contextlib
+import tempfile
+import multiprocessing
 import time
 import datetime
 import logging
 import logging.handlers
 from argparse import ArgumentParser
 import StringIO
+import yaml
 from ruffus.proxy_logger import *
 from ruffus import *
 
 
 class Result(object):
     def __init__(self, infiles, outfiles, log=None, stdout=None, stderr=None,
-                 desc=None, failed=False, cmds=None):
+                 desc=None, failed=False, cmds=None, stages=None, stats=None):
         """
         A Result object encapsulates the information going to and from a task.
         Each task is responsible for determining the following arguments, based
@@ -31,6 +49,16 @@ class Result(object):
             `desc`: Optional description of the task
             `cmds`: Optional string of commands used by the task. Can be very
                     useful for debugging.
+            `stages`: Optional list of Result objects, one for each stage of
+                      a task that runs several commands at once (e.g., when
+                      they are connected with pipes).  Their elapsed times
+                      and commands are included in the report.
+            `stats`: Optional dictionary of numbers describing what the task
+                     did (e.g., reads kept), included in the report.  If it
+                     has a "reads" entry, the report includes reads/sec.
+
+        The @timeit decorator fills in `elapsed` and `usage`, a dictionary of
+        the resources the task used; see task_usage().
         """
         if isinstance(infiles, basestring):
             infiles = [infiles]
@@ -45,41 +73,91 @@ class Result(object):
         self.failed = failed
         self.desc = desc
         self.cmds = cmds
+        if stages is None:
+            stages = []
+        self.stages = stages
+        if stats is None:
+            stats = {}
+        self.stats = stats
+        self.usage = {}
 
-    def report(self, logger_proxy, logging_mutex):
+    def report(self, logger_proxy, logging_mutex, metrics=None):
         """
-        Prints a nice report
+        Prints a nice report, and adds the result to `metrics` (a
+        metrics.MetricsExport) if given.
+
+        If `logger_proxy` is a QueueLogger, the whole report is sent as one
+        message and `logging_mutex` isn't needed; otherwise the lines are
+        logged one at a time while holding it.
         """
-        with logging_mutex:
-            if not self.desc:
-                self.desc = ""
-            logger_proxy.info(' Task: %s' % self.desc)
-            logger_proxy.info('     Time: %s' % datetime.datetime.now())
-            if self.elapsed is not None:
-                logger_proxy.info('     Elapsed: %s' % nicetime(self.elapsed))
-            if self.cmds is not None:
-                logger_proxy.debug('     Commands: %s' % str(self.cmds))
-            for output_fn in self.outfiles:
-                output_fn = os.path.normpath(os.path.relpath(output_fn))
-                logger_proxy.info('     Output:   %s' % output_fn)
+        if metrics is not None:
+            metrics.record(self)
+        if not self.desc:
+            self.desc = ""
+        lines = []
+
+        def info(msg):
+            lines.append((logging.INFO, msg))
+
+        def debug(msg):
+            lines.append((logging.DEBUG, msg))
+
+        def error(msg):
+            lines.append((logging.ERROR, msg))
+
+        info(' Task: %s' % self.desc)
+        info('     Time: %s' % datetime.datetime.now())
+        if self.elapsed is not None:
+            info('     Elapsed: %s' % nicetime(self.elapsed))
+        for line in usage_lines(self):
+            info('     %s' % line)
+        for stage in self.stages:
+            details = []
+            if stage.elapsed is not None:
+                details.append(nicetime(stage.elapsed))
+            details.extend(usage_lines(stage, brief=True))
+            if details:
+                info('     Stage:   %s (%s)' % (
+                    stage.desc, ', '.join(details)))
+            else:
+                info('     Stage:   %s' % stage.desc)
+            if stage.cmds is not None:
+                debug('       Commands: %s' % str(stage.cmds))
+        if self.cmds is not None:
+            debug('     Commands: %s' % str(self.cmds))
+        for key in sorted(self.stats):
+            if self.stats[key] is not None:
+                info('     %s: %s' % (key, self.stats[key]))
+        for output_fn in self.outfiles:
+            output_fn = os.path.normpath(os.path.relpath(output_fn))
+            info('     Output:   %s' % output_fn)
+        if self.log is not None:
+            info('     Log:      %s' % self.log)
+        if self.failed:
+            error('=' * 80)
+            error('Error in %s' % self.desc)
+            if self.cmds:
+                error(str(self.cmds))
+            if self.stderr:
+                error('====STDERR====')
+                error(self.stderr)
+            if self.stdout:
+                error('====STDOUT====')
+                error(self.stdout)
             if self.log is not None:
-                logger_proxy.info('     Log:      %s' % self.log)
-            if self.failed:
-                logger_proxy.error('=' * 80)
-                logger_proxy.error('Error in %s' % self.desc)
-                if self.cmds:
-                    logger_proxy.error(str(self.cmds))
-                if self.stderr:
-                    logger_proxy.error('====STDERR====')
-                    logger_proxy.error(self.stderr)
-                if self.stdout:
-                    logger_proxy.error('====STDOUT====')
-                    logger_proxy.error(self.stdout)
-                if self.log is not None:
-                    logger_proxy.error('   Log: %s' % self.log)
-                logger_proxy.error('=' * 80)
-                sys.exit(1)
-            logger_proxy.info('')
+                error('   Log: %s' % self.log)
+            error('=' * 80)
+        else:
+            info('')
+
+        if isinstance(logger_proxy, QueueLogger):
+            logger_proxy.log_lines(lines)
+        else:
+            with logging_mutex:
+                for level, msg in lines:
+                    logger_proxy.log(level, msg)
+        if self.failed:
+            sys.exit(1)
 
 
 def nicetime(seconds):
@@ -90,19 +168,689 @@ def nicetime(seconds):
     return elapsed
 
 
+def nicesize(size):
+    """Convert bytes to a human-readable size"""
+    for unit in ['bytes', 'KB', 'MB', 'GB']:
+        if abs(size) < 1024:
+            break
+        size /= 1024.
+    else:
+        unit = 'TB'
+    if unit == 'bytes':
+        return '%d bytes' % size
+    return '%.1f %s' % (size, unit)
+
+
+def usage_lines(result, brief=False):
+    """
+    Lines describing the CPU time, memory, I/O and throughput in
+    `result.usage`, for Result.report.  With `brief`, only short items for
+    a stage's summary line are returned.
+    """
+    usage = result.usage
+    elapsed = result.elapsed
+    lines = []
+    if 'user CPU' in usage:
+        lines.append('CPU: %.2fs user, %.2fs system' % (
+            usage['user CPU'], usage['system CPU']))
+    if usage.get('peak RSS') is not None:
+        lines.append('Peak RSS: %s' % nicesize(usage['peak RSS']))
+    reads = result.stats.get('reads')
+    if brief:
+        if reads and elapsed:
+            lines.append('%.0f reads/sec' % (reads / elapsed))
+        return lines
+    if 'read bytes' in usage:
+        lines.append('I/O: %s read, %s written (disk: %s read, %s written)' % (
+            nicesize(usage['read bytes']), nicesize(usage['written bytes']),
+            nicesize(usage['disk read bytes']),
+            nicesize(usage['disk written bytes'])))
+    if 'input size' in usage:
+        lines.append('Sizes: %s in, %s out' % (
+            nicesize(usage['input size']), nicesize(usage['output size'])))
+    throughput = []
+    if reads and elapsed:
+        throughput.append('%.0f reads/sec' % (reads / elapsed))
+    if usage.get('input size') and elapsed:
+        throughput.append(
+                '%.2f MB/sec' % (usage['input size'] / elapsed / (1 << 20)))
+    if throughput:
+        lines.append('Throughput: %s' % ', '.join(throughput))
+    return lines
+
+
+def is_gzipped(path):
+    """
+    True if `path` is gzip-compressed.  This includes BGZF-compressed FASTQ
+    files as well as BAM files.
+    """
+    f = open(path, 'rb')
+    magic = f.read(2)
+    f.close()
+    return magic == '\x1f\x8b'
+
+
+def open_fastq(path):
+    """
+    Opens the FASTQ file `path` for reading, decompressing it on the fly if
+    it is gzip- or BGZF-compressed.
+    """
+    if is_gzipped(path):
+        return gzip.open(path)
+    return open(path)
+
+
+# ioctl request for cloning a file's extents (Linux; btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+# Permissions of a newly created file under this process's umask.  Files
+# made with tempfile.mkstemp() (to be renamed into place) are given these
+# rather than mkstemp's 0600.
+_umask = os.umask(0)
+os.umask(_umask)
+FILE_MODE = 0666 & ~_umask
+
+
+def link_or_copy(src, dst, hard_link=True):
+    """
+    Makes `dst` a file with the same contents as `src` while avoiding copying
+    the data if possible.  Tries a hard link (unless `hard_link` is False),
+    then a reflink (copy-on-write clone), and finally falls back to copying
+    in chunks so memory use stays constant.  Returns a string describing the
+    method that was used.
+
+    A hard link shares its data with `src`, so whatever later writes to
+    `dst` must unlink it first (see unlink_output()); pass `hard_link=False`
+    when that can't be guaranteed.
+    """
+    unlink_output(dst)
+    if hard_link:
+        try:
+            os.link(src, dst)
+            return 'hard link'
+        except OSError:
+            pass
+    fin = open(src, 'rb')
+    fout = open(dst, 'wb')
+    try:
+        try:
+            fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+            return 'reflink'
+        except (IOError, OSError):
+            shutil.copyfileobj(fin, fout, 1 << 20)
+            return 'copy'
+    finally:
+        fin.close()
+        fout.close()
+
+
+def unlink_output(path):
+    """
+    Removes the output file `path`, if it exists, before it is written
+    again.  It may be a hard link to another file (e.g., the input FASTQ,
+    after a run with no adapter to clip), which writing to it in place
+    would change too.
+    """
+    if os.path.lexists(path):
+        os.unlink(path)
+
+
+def can_fork_pool():
+    """
+    Whether pool_map() can start worker processes from here (see its
+    docstring).
+    """
+    return not (threaded or multiprocessing.current_process().daemon)
+
+
+def pool_map(func, items, processes):
+    """
+    Like itertools.imap(func, items), but spread across `processes` worker
+    processes.  Results are yielded in the same order as `items`, and only
+    a few items are in flight at once so that `items` can be a large lazy
+    iterator.
+
+    ruffus' own worker processes are daemonic and so can't start a pool of
+    their own, and forking a pool from one of many task threads could leak
+    other tasks' pipes into it; in those cases (or if `processes` is 1)
+    everything runs in this process instead.
+    """
+    if processes <= 1 or not can_fork_pool():
+        for item in items:
+            yield func(item)
+        return
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        pending = collections.deque()
+        for item in items:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= 2 * processes:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def mkdir_p(path):
+    """
+    Creates the directory `path` and any missing parents, like `mkdir -p`.
+    """
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def content_hash(path, memo_dir=None):
+    """
+    Returns the SHA1 hex digest of the contents of the file `path`.
+
+    Hashing a large file means reading all of it, so if `memo_dir` is given
+    the digest is remembered there in a small file named after the path,
+    size and mtime of `path`, and reused until the file changes.
+    """
+    memo = None
+    if memo_dir is not None:
+        st = os.stat(path)
+        memo = os.path.join(memo_dir, hashlib.sha1(
+            '%s\t%s\t%s' % (os.path.abspath(path), st.st_size, st.st_mtime)
+            ).hexdigest())
+        if os.path.exists(memo):
+            return open(memo).read().strip()
+
+    h = hashlib.sha1()
+    f = open(path, 'rb')
+    while True:
+        chunk = f.read(1 << 20)
+        if not chunk:
+            break
+        h.update(chunk)
+    f.close()
+    digest = h.hexdigest()
+
+    if memo is not None:
+        mkdir_p(memo_dir)
+        tmp = memo + '.%s' % os.getpid()
+        fout = open(tmp, 'w')
+        fout.write(digest)
+        fout.close()
+        os.rename(tmp, memo)
+    return digest
+
+
+def _dir_size(path):
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for fn in filenames:
+            total += os.path.getsize(os.path.join(dirpath, fn))
+    return total
+
+
+def evict_lru(cache_dir, max_size, keep=None):
+    """
+    Removes the least recently used entries from `cache_dir` until it uses
+    no more than `max_size` bytes.  Entries are the subdirectories that
+    contain a "last_used" file, whose mtime is the time they were last used;
+    names starting with "." are skipped.  The entry `keep` is never removed.
+    """
+    entries = []
+    total = 0
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        last_used = os.path.join(path, 'last_used')
+        if (name == keep or name.startswith('.')
+                or not os.path.exists(last_used)):
+            continue
+        size = _dir_size(path)
+        total += size
+        entries.append((os.path.getmtime(last_used), size, path))
+    if keep is not None:
+        total += _dir_size(os.path.join(cache_dir, keep))
+    for mtime, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        # Rename first so other processes never see a half-deleted entry;
+        # ones that already have its files open keep working.
+        doomed = tempfile.mkdtemp(dir=cache_dir, prefix='.evict-')
+        try:
+            os.rename(path, os.path.join(doomed, 'entry'))
+        except OSError:
+            # someone else got to it first
+            os.rmdir(doomed)
+            continue
+        shutil.rmtree(doomed)
+        total -= size
+
+
+def parse_size(size):
+    """
+    Converts a size such as 1024, "500M" or "2G" (as written in the config
+    file) to bytes.
+    """
+    if isinstance(size, (int, long)):
+        return size
+    size = size.strip().upper().rstrip('B')
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+# Set by run() when tasks run in threads of this process rather than in
+# worker processes of their own
+threaded = False
+
+# Held while starting a process, so that pipes being set up for it can't be
+# inherited by a process that another thread is starting
+_spawn_lock = threading.Lock()
+
+
+def popen(*args, **kwargs):
+    """
+    Like subprocess.Popen, but safe to use from several threads at once.
+    The ends of any pipes to the new process that are kept in this process
+    are marked close-on-exec, so processes started later by other threads
+    don't hold them open (which would stop a reader from seeing EOF).
+    """
+    with _spawn_lock:
+        p = subprocess.Popen(*args, **kwargs)
+        for f in (p.stdin, p.stdout, p.stderr):
+            if f is not None:
+                flags = fcntl.fcntl(f.fileno(), fcntl.F_GETFD)
+                fcntl.fcntl(
+                        f.fileno(), fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+    return p
+
+
+def read_tail(f, max_bytes=65536):
+    """
+    Returns at most the last `max_bytes` of the file object `f` (e.g.,
+    a temporary file that a process wrote its stderr to), so that a chatty
+    tool's output doesn't all end up in memory and in the report.
+    """
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(max(0, size - max_bytes))
+    text = f.read()
+    if size > max_bytes:
+        text = '[... %d bytes not shown ...]\n%s' % (size - max_bytes, text)
+    return text
+
+
+# The task whose processes the current thread is running (see timeit)
+_task = threading.local()
+_task_ids = itertools.count()
+
+# Resource usage of the child processes reaped with wait(), by task
+_reaped = {}
+
+
+def task_thread(target, args=()):
+    """
+    Returns a threading.Thread that runs `target`(*`args`) on behalf of the
+    current task, so that processes it waits for are accounted to the task.
+    """
+    task_id = getattr(_task, 'id', None)
+
+    def run():
+        _task.id = task_id
+        target(*args)
+    return threading.Thread(target=run)
+
+
+def wait(p):
+    """
+    Like `p`.wait() for the subprocess.Popen `p`, but also records the
+    resource usage of the process so that it can be attributed to the task
+    that ran it.  Returns the usage (a resource.struct_rusage), or None if
+    `p` had already been waited for.
+    """
+    if p.returncode is not None:
+        return None
+    while True:
+        try:
+            pid, sts, usage = os.wait4(p.pid, 0)
+            break
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno == errno.ECHILD:
+                # reaped elsewhere
+                p.wait()
+                return None
+            raise
+    p._handle_exitstatus(sts)
+    task_id = getattr(_task, 'id', None)
+    if task_id is not None:
+        _reaped.setdefault(task_id, []).append(usage)
+    return usage
+
+
+def usage_snapshot():
+    """
+    Current resource usage of this process and its reaped children, to be
+    compared with a later snapshot by task_usage().
+    """
+    io = {}
+    try:
+        for line in open('/proc/self/io'):
+            key, value = line.split(':')
+            io[key] = int(value)
+    except IOError:
+        # not Linux, or no I/O accounting
+        pass
+    return {
+        'self': resource.getrusage(resource.RUSAGE_SELF),
+        'children': resource.getrusage(resource.RUSAGE_CHILDREN),
+        'io': io,
+    }
+
+
+def _total_size(filenames):
+    total = 0
+    for fn in filenames:
+        if isinstance(fn, basestring) and os.path.isfile(fn):
+            total += os.path.getsize(fn)
+    return total
+
+
+def task_usage(before, after, result, reaped=()):
+    """
+    Resources used between the usage_snapshot()s `before` and `after` by the
+    task that returned `result`, whose processes reaped with wait() had the
+    resource usage `reaped`:
+
+        `user CPU`, `system CPU`: seconds, for this process and any child
+                                  processes it waited for
+        `peak RSS`: bytes; the largest resident set of a child reaped with
+                    wait() or of this process, if that grew during the task.
+                    None if unknown.
+        `read bytes`, `written bytes`: all I/O, including pipes
+        `disk read bytes`, `disk written bytes`: I/O that reached the disk
+        `input size`, `output size`: total size of the task's files
+
+    The kernel adds a child's CPU time and I/O to its parent's totals when
+    it is reaped, so these totals are only per task if the task runs in its
+    own process (as it does with ruffus' multiprocess=N).  When tasks run in
+    threads, the CPU time and peak RSS come from `reaped` alone and I/O is
+    not reported.
+    """
+    usage = {}
+    # ru_maxrss is in KB, and is a high-water mark over the whole life of the
+    # process (or all of its children), so it is only useful per Popen or if
+    # it grew while this task was running.
+    peaks = [u.ru_maxrss for u in reaped]
+    if threaded:
+        usage['user CPU'] = sum(u.ru_utime for u in reaped)
+        usage['system CPU'] = sum(u.ru_stime for u in reaped)
+    else:
+        for key, attr in [('user CPU', 'ru_utime'),
+                          ('system CPU', 'ru_stime')]:
+            usage[key] = sum(
+                    getattr(after[who], attr) - getattr(before[who], attr)
+                    for who in ('self', 'children'))
+        for who in ('self', 'children'):
+            if after[who].ru_maxrss > before[who].ru_maxrss:
+                peaks.append(after[who].ru_maxrss)
+    if peaks:
+        usage['peak RSS'] = max(peaks) * 1024
+    else:
+        usage['peak RSS'] = None
+
+    if after['io'] and before['io'] and not threaded:
+        for key, name in [('read bytes', 'rchar'),
+                          ('written bytes', 'wchar'),
+                          ('disk read bytes', 'read_bytes'),
+                          ('disk written bytes', 'write_bytes')]:
+            usage[key] = after['io'][name] - before['io'][name]
+
+    usage['input size'] = _total_size(result.infiles)
+    usage['output size'] = _total_size(result.outfiles)
+    return usage
+
+
+def stage_usage(usage):
+    """
+    Usage of a single process from its resource.struct_rusage `usage` (as
+    returned by wait()), in the same form as task_usage().
+    """
+    if usage is None:
+        return {}
+    return {'user CPU': usage.ru_utime, 'system CPU': usage.ru_stime,
+            'peak RSS': usage.ru_maxrss * 1024}
+
+
 def timeit(func):
-    """Decorator to time a single run of a task"""
+    """
+    Decorator to time a single run of a task and record the resources it
+    used; see task_usage().
+    """
+    @functools.wraps(func)
     def wrapper(*arg, **kw):
+        outer = getattr(_task, 'id', None)
+        task_id = _task.id = next(_task_ids)
+        before = usage_snapshot()
         t0 = time.time()
-        res = func(*arg, **kw)
+        try:
+            res = func(*arg, **kw)
+        finally:
+            _task.id = outer
         t1 = time.time()
         res.elapsed = (t1 - t0)
+        res.usage = task_usage(
+                before, usage_snapshot(), res, _reaped.pop(task_id, []))
         if not res.desc:
             res.desc = func.__name__
         return res
     return wrapper
 
 
+def side_file_stamp(path):
+    """
+    Identifies the version of the side file `path` (e.g., a GFF) by the size
+    and mtime of the file, or of every file starting with `path` if it isn't
+    a file itself (like a bowtie index).
+    """
+    if os.path.isfile(path):
+        fns = [path]
+    else:
+        fns = sorted(fn for fn in glob.glob(path + '*') if os.path.isfile(fn))
+    stamp = []
+    for fn in fns:
+        st = os.stat(fn)
+        stamp.append([os.path.basename(fn), st.st_size, st.st_mtime])
+    return stamp
+
+
+def fingerprint(config, task_funcs):
+    """
+    The config values and side file stamps that the tasks `task_funcs`
+    depend on, according to their `tracked_keys` and `tracked_files` (see
+    resultcache.cached), as a dictionary that survives a trip through JSON.
+    """
+    fp = {}
+    for func in task_funcs:
+        for key in getattr(func, 'tracked_keys', []):
+            fp[key] = config.get(key)
+        for key in getattr(func, 'tracked_files', []):
+            path = config.get(key)
+            fp[key] = [path, side_file_stamp(path) if path else None]
+    return json.loads(json.dumps(fp))
+
+
+def _filenames(files):
+    if isinstance(files, basestring):
+        return [files]
+    return list(files)
+
+
+def tracks(config, *task_funcs):
+    """
+    Decorator for pipeline functions that run `task_funcs`, so that their
+    jobs are rerun when the config values or side files those tasks depend
+    on change, and not otherwise.
+
+    After each job succeeds, a fingerprint of them is written next to its
+    first output file (with ".fingerprint" appended).  A job is out of date
+    if an output is missing or older than an input, as usual, or if its
+    fingerprint is missing or differs from the current one.  Use this
+    decorator below the ruffus ones.
+    """
+    def fingerprint_file(outfiles):
+        return _filenames(outfiles)[0] + '.fingerprint'
+
+    def needs_update(infiles, outfiles):
+        outfiles = _filenames(outfiles)
+        for fn in outfiles:
+            if not os.path.exists(fn):
+                return True, 'Missing file %s' % fn
+        oldest = min(os.path.getmtime(fn) for fn in outfiles)
+        for fn in _filenames(infiles):
+            if not os.path.exists(fn):
+                # an upstream job will make it
+                return True, 'Missing input %s' % fn
+            if os.path.getmtime(fn) > oldest:
+                return True, 'Input %s is newer than the output' % fn
+        try:
+            recorded = json.load(open(fingerprint_file(outfiles)))
+        except (IOError, ValueError):
+            return True, 'No fingerprint of the config and side files used'
+        current = fingerprint(config, task_funcs)
+        changed = sorted(
+                k for k in set(current) | set(recorded)
+                if current.get(k) != recorded.get(k))
+        if changed:
+            return True, 'Changed since the last run: %s' % ', '.join(changed)
+        return False, 'Up to date'
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(infiles, outfiles):
+            func(infiles, outfiles)
+            fn = fingerprint_file(outfiles)
+            tmp = fn + '.%s' % os.getpid()
+            fout = open(tmp, 'w')
+            json.dump(fingerprint(config, task_funcs), fout, sort_keys=True)
+            fout.close()
+            os.rename(tmp, fn)
+        return check_if_uptodate(needs_update)(wrapper)
+    return decorator
+
+
+class CoreBudget(object):
+    def __init__(self, total, memory=None):
+        """
+        Keeps track of how many of `total` CPU cores, and optionally how many
+        bytes of `memory`, are in use by tasks across all of the pipeline's
+        worker processes.  It must be created before the worker processes are
+        started so that they share it.
+        """
+        self.total = total
+        self.memory = memory
+        self._cond = multiprocessing.Condition()
+        self._free = multiprocessing.RawValue('i', total)
+        self._waiting = multiprocessing.RawValue('i', 0)
+        self._free_memory = multiprocessing.RawValue('l', memory or 0)
+
+    def _clamp_memory(self, memory):
+        # A job that needs more than the whole budget may still run alone
+        if self.memory is None:
+            return 0
+        return min(memory, self.memory)
+
+    def acquire(self, request, maximum=None, memory=0):
+        """
+        Blocks until `request` cores (and `memory` bytes, if there is
+        a memory budget) are free, then reserves them and returns the number
+        of cores granted.  If more cores are free than the tasks currently
+        waiting need, up to `maximum` are granted instead so they don't sit
+        idle.
+        """
+        request = max(1, min(request, self.total))
+        if maximum is None:
+            maximum = request
+        maximum = max(request, min(maximum, self.total))
+        memory = self._clamp_memory(memory)
+        with self._cond:
+            self._waiting.value += 1
+            while (self._free.value < request
+                   or self._free_memory.value < memory):
+                self._cond.wait()
+            self._waiting.value -= 1
+            # share what's left with anyone else who is waiting
+            spare = self._free.value // (self._waiting.value + 1)
+            granted = min(maximum, max(request, spare))
+            self._free.value -= granted
+            self._free_memory.value -= memory
+        return granted
+
+    def release(self, n, memory=0):
+        """
+        Returns `n` cores (and `memory` bytes) to the budget.
+        """
+        memory = self._clamp_memory(memory)
+        with self._cond:
+            self._free.value += n
+            self._free_memory.value += memory
+            self._cond.notify_all()
+
+
+# Set by run() so that tasks in all worker processes share one budget
+core_budget = None
+
+# Memory used by data that all jobs share, such as a bowtie index in the
+# page cache.  run() sets it aside from the memory budget once, rather than
+# once per job.
+shared_memory = {}
+
+
+def share_memory(name, size):
+    """
+    Records that `size` bytes of shared data called `name` will be in
+    memory for the whole run; see shared_memory.
+    """
+    shared_memory[name] = size
+
+
+def total_memory():
+    """
+    Physical memory in bytes, or None if unknown.
+    """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError):
+        return None
+
+
+@contextlib.contextmanager
+def cores(request, maximum=None, memory=0):
+    """
+    Context manager that reserves cores (and `memory` bytes) from the
+    pipeline's budget for the duration of the block, and gives the number
+    of cores granted.  If there is no budget (e.g., when tasks are called
+    directly, or run by a queue or sbatch worker that has its cores to
+    itself) `maximum` is granted right away, or `request` if no maximum was
+    given, but no more than the machine's cores (or `request`, if that is
+    more).
+    """
+    if core_budget is None:
+        if maximum is None:
+            yield request
+        else:
+            yield max(request, min(maximum, multiprocessing.cpu_count()))
+        return
+    granted = core_budget.acquire(request, maximum, memory)
+    try:
+        yield granted
+    finally:
+        core_budget.release(granted, memory)
+
+
 def run(options):
     """
     Run the pipeline according to the provided options (which were probably
@@ -121,11 +869,25 @@ def run(options):
                                 options.forced_tasks,
                                 no_key_legend=not options.key_legend_in_graph)
     else:
-        pipeline_run(options.target_tasks,
-                     options.forced_tasks,
-                     multiprocess=options.jobs,
-                     logger=stderr_logger,
-                     verbose=options.verbose)
+        global core_budget, threaded
+        memory = options.memory
+        if memory is not None:
+            memory = parse_size(memory) - sum(shared_memory.values())
+        core_budget = CoreBudget(options.cores, memory)
+        if options.executor == 'threads':
+            # One process; each job is a thread that supervises its tools
+            threaded = True
+            kwargs = dict(multithread=options.jobs)
+        else:
+            kwargs = dict(multiprocess=options.jobs)
+        try:
+            pipeline_run(options.target_tasks,
+                         options.forced_tasks,
+                         logger=stderr_logger,
+                         verbose=options.verbose,
+                         **kwargs)
+        finally:
+            stop_logging()
 
 
 def get_options():
@@ -154,6 +916,40 @@ def get_options():
                         type=int,
                         help="Allow N jobs (commands) to run "
                              "simultaneously.")
+    parser.add_argument("--executor", dest="executor",
+                        choices=["processes", "threads"],
+                        default="processes",
+                        help="Run jobs in worker processes (the default), "
+                             "or in threads of this process, which is "
+                             "cheaper when jobs mostly wait for external "
+                             "tools.")
+    parser.add_argument("--backend", dest="backend",
+                        choices=["local", "queue", "sbatch"],
+                        default="local",
+                        help="Where each job's work is done: in the job "
+                             "itself (the default), by workers draining the "
+                             "job queue in --queue-dir (started with "
+                             "backends.py worker), or as SLURM jobs.")
+    parser.add_argument("--queue-dir", dest="queue_dir",
+                        default=".pipeline-queue",
+                        metavar="DIR",
+                        help="Job queue for --backend queue, or job files "
+                             "for --backend sbatch (default: %(default)s).  "
+                             "Must be on a filesystem the workers share.")
+    parser.add_argument("--cores", dest="cores",
+                        default=multiprocessing.cpu_count(),
+                        metavar="N",
+                        type=int,
+                        help="Total number of CPU cores that running jobs "
+                             "may use.  Jobs wait until enough cores are "
+                             "free (default: all cores).")
+    parser.add_argument("--memory", dest="memory",
+                        default=total_memory(),
+                        metavar="SIZE",
+                        help="Memory that running jobs may use, e.g. 64G.  "
+                             "Jobs that say how much they need (e.g., "
+                             "bowtie) wait until it is free (default: all "
+                             "physical memory).")
     parser.add_argument("-n", "--just_print", dest="just_print",
                         action="store_true", default=False,
                         help="Don't actually run any commands; just print "
@@ -176,6 +972,22 @@ def get_options():
                         type=str,
                         help="Pipeline task(s) which will be included "
                              "even if they are up to date.")
+    parser.add_argument("--no-cache", dest="no_cache",
+                        action="store_true",
+                        default=False,
+                        help="Don't use or add to the result cache, even "
+                             "if the config file sets 'result cache dir'.")
+    parser.add_argument("--metrics", dest="metrics",
+                        metavar="FILE",
+                        type=str,
+                        help="Append a JSON line of metrics for each task "
+                             "to FILE as it finishes.")
+    parser.add_argument("--prom-metrics", dest="prom_metrics",
+                        metavar="FILE",
+                        type=str,
+                        help="Keep a snapshot of the run's task metrics in "
+                             "FILE, in the Prometheus text format (e.g., for "
+                             "node_exporter's textfile collector).")
     parser.add_argument('--config',
                         help='Meta YAML config')
 
@@ -207,6 +1019,51 @@ def get_options():
     return options
 
 
+# Parsed config files, kept so that big sample sheets are only parsed once
+CONFIG_CACHE_DIR = os.path.expanduser('~/.cache/pipeline-example/config')
+
+
+def load_config(path, cache_dir=CONFIG_CACHE_DIR):
+    """
+    Parses the YAML config file `path`, using libyaml if PyYAML was built
+    with it.
+
+    The parsed config is also pickled to `cache_dir` (if given), keyed by
+    the path, size and mtime of `path`, and loaded from there next time
+    until the file changes.  Problems with the cache are ignored.
+    """
+    st = os.stat(path)
+    stamp = [os.path.abspath(path), st.st_size, st.st_mtime, yaml.__version__]
+    cached = None
+    if cache_dir:
+        cached = os.path.join(
+                cache_dir, hashlib.sha1(stamp[0]).hexdigest() + '.pickle')
+        try:
+            fin = open(cached, 'rb')
+            found_stamp, config = cPickle.load(fin)
+            fin.close()
+            if found_stamp == stamp:
+                return config
+        except Exception:
+            # missing, stale or unreadable
+            pass
+
+    loader = getattr(yaml, 'CLoader', yaml.Loader)
+    config = yaml.load(open(path).read(), Loader=loader)
+
+    if cached:
+        try:
+            mkdir_p(cache_dir)
+            tmp = cached + '.%s' % os.getpid()
+            fout = open(tmp, 'wb')
+            cPickle.dump((stamp, config), fout, 2)
+            fout.close()
+            os.rename(tmp, cached)
+        except (IOError, OSError):
+            pass
+    return config
+
+
 def make_logger(options, file_name):
     """
     Sets up logging for the pipeline so that messages are synchronized across
@@ -269,13 +1126,97 @@ def make_logger(options, file_name):
     logger = logging.getLogger(logger_name)
     setup_std_logging(logger, options.log_file, options.verbose)
 
-    # Allow logging across Ruffus pipeline
-    def get_logger(logger_name, args):
-        return logger
-
-    (logger_proxy,
-     logging_mutex) = make_shared_logger_and_proxy(get_logger,
-                                                   logger_name,
-                                                   {})
+    # Allow logging across Ruffus pipeline: jobs in any process put their
+    # messages on a queue, and a thread in this process writes them out.
+    global _log_listener
+    queue = multiprocessing.Queue()
+    _log_listener = QueueListener(queue, logger)
+    _log_listener.start()
+    logger_proxy = QueueLogger(queue, logger_name)
+    logging_mutex = multiprocessing.Lock()
 
     return logger_proxy, logging_mutex
+
+
+class QueueLogger(object):
+    def __init__(self, queue, name):
+        """
+        Logger-like object that sends messages to a QueueListener through the
+        multiprocessing.Queue `queue`, so logging never waits for another
+        process.  Messages are formatted by the listener.
+        """
+        self.queue = queue
+        self.name = name
+
+    def log_lines(self, lines):
+        """
+        Sends `lines`, a list of (level, message) tuples, as one item so that
+        they come out together.
+        """
+        self.queue.put((self.name, time.time(), os.getpid(), lines))
+
+    def log(self, level, msg):
+        self.log_lines([(level, msg)])
+
+    def debug(self, msg):
+        self.log(logging.DEBUG, msg)
+
+    def info(self, msg):
+        self.log(logging.INFO, msg)
+
+    def warning(self, msg):
+        self.log(logging.WARNING, msg)
+
+    def error(self, msg):
+        self.log(logging.ERROR, msg)
+
+
+class QueueListener(object):
+    def __init__(self, queue, logger):
+        """
+        Writes the messages that QueueLoggers put on `queue` to the handlers
+        of `logger`, from a thread in this process.
+        """
+        self.queue = queue
+        self.logger = logger
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            name, created, pid, lines = item
+            for level, msg in lines:
+                record = self.logger.makeRecord(
+                        name, level, '(unknown file)', 0, msg, None, None)
+                record.created = created
+                record.msecs = (created - int(created)) * 1000
+                record.process = pid
+                self.logger.handle(record)
+
+    def stop(self):
+        """
+        Writes out any messages still on the queue and stops the thread.
+        """
+        if self._thread is not None:
+            self.queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+
+# Set by make_logger(); stopped by run() once the pipeline has finished
+_log_listener = None
+
+
+def stop_logging():
+    """
+    Waits for all queued log messages to be written.
+    """
+    if _log_listener is not None:
+        _log_listener.stop()
@@ -0,0 +1,289 @@
+#!/usr/bin/python
+"""
+Genes x samples count matrix, kept in a compact binary form that can be
+memory-mapped, so downstream analyses don't have to parse and join one text
+count file per sample.
+
+Each sample's counts are stored contiguously, so adding a sample only
+appends to the end of the data files, and reading one sample's counts reads
+one block.  A gene's counts across samples are a strided slice of the same
+memory map.  htseq-count's special counters (__no_feature, __ambiguous, ...)
+are kept apart from the genes, as QC rows.
+
+A matrix directory contains:
+
+    `genes.txt`: gene IDs, one per line, in row order
+    `qc.txt`: names of the QC rows, one per line
+    `samples.txt`: sample labels in column order, one per line, each with
+                   the size and mtime of the count file it came from.  A
+                   sample is only part of the matrix once it is listed here.
+    `counts.bin`: uint32 counts, one block of len(genes) per sample
+    `qc.bin`: uint64 QC counts, one block of len(qc) per sample
+    `lock`: locked while the matrix is being changed
+
+Example::
+
+    ./matrix.py add run1/counts.matrix run1/*/*.count
+    ./matrix.py export run1/counts.matrix > counts.tsv
+"""
+import os
+import sys
+import fcntl
+from argparse import ArgumentParser
+import numpy as np
+import counting
+import helpers
+
+COUNT_DTYPE = np.dtype('<u4')
+QC_DTYPE = np.dtype('<u8')
+
+
+def read_counts(countfile):
+    """
+    Reads an htseq-count style `countfile`.  Returns a dictionary of gene
+    counts and one of special counters.
+    """
+    genes = {}
+    qc = {}
+    for line in open(countfile):
+        name, n = line.rstrip('\n').split('\t')
+        if name.startswith('__'):
+            qc[name] = int(n)
+        else:
+            genes[name] = int(n)
+    return genes, qc
+
+
+def sample_label(countfile):
+    """
+    Label of the sample whose count file is `countfile`: the name of its
+    output directory.
+    """
+    return os.path.basename(os.path.dirname(os.path.abspath(countfile)))
+
+
+class CountMatrix(object):
+    def __init__(self, path):
+        """
+        Opens the count matrix in the directory `path`, which is created by
+        the first add().
+        """
+        self.path = path
+        self._load()
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _load(self):
+        if os.path.exists(self._file('genes.txt')):
+            self.genes = open(self._file('genes.txt')).read().splitlines()
+            self.qc_names = open(self._file('qc.txt')).read().splitlines()
+        else:
+            self.genes = None
+            self.qc_names = list(counting.SPECIAL_COUNTERS)
+        self.samples = []
+        self.stamps = {}
+        if os.path.exists(self._file('samples.txt')):
+            for line in open(self._file('samples.txt')):
+                label, size, mtime = line.rstrip('\n').split('\t')
+                self.samples.append(label)
+                self.stamps[label] = (int(size), float(mtime))
+        self.gene_index = dict(
+                (gene, i) for i, gene in enumerate(self.genes or []))
+        self.sample_index = dict(
+                (label, i) for i, label in enumerate(self.samples))
+
+    def _map(self, name, dtype, width, mode='r'):
+        shape = (len(self.samples), width)
+        if not shape[0] or not shape[1]:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(self._file(name), dtype=dtype, mode=mode,
+                         shape=shape)
+
+    @property
+    def counts(self):
+        """
+        Read-only memory map of the counts, indexed [sample, gene].  Use
+        `.T` for genes x samples.
+        """
+        return self._map('counts.bin', COUNT_DTYPE, len(self.genes or []))
+
+    @property
+    def qc(self):
+        """
+        Read-only memory map of the QC counts, indexed [sample, QC row].
+        """
+        return self._map('qc.bin', QC_DTYPE, len(self.qc_names))
+
+    def column(self, sample):
+        """
+        Counts of every gene in `sample`.
+        """
+        return self.counts[self.sample_index[sample]]
+
+    def row(self, gene):
+        """
+        Counts of `gene` in every sample.
+        """
+        return self.counts[:, self.gene_index[gene]]
+
+    def sample_qc(self, sample):
+        """
+        Dictionary of the special counters of `sample`.
+        """
+        values = self.qc[self.sample_index[sample]]
+        return dict(zip(self.qc_names, [int(v) for v in values]))
+
+    def is_current(self, countfile):
+        """
+        Whether the matrix already has the counts in `countfile`.
+        """
+        st = os.stat(countfile)
+        return self.stamps.get(sample_label(countfile)) == (
+                st.st_size, st.st_mtime)
+
+    def add(self, countfiles):
+        """
+        Adds the samples in `countfiles` that are new or whose count files
+        have changed since they were added.  New samples are appended; the
+        columns of changed ones are overwritten in place.  Returns the labels
+        of the samples added or updated.
+
+        Raises ValueError if a count file doesn't have the same genes as the
+        matrix (e.g., after changing the GFF), in which case the matrix has
+        to be rebuilt.
+        """
+        helpers.mkdir_p(self.path)
+        lock = open(self._file('lock'), 'w')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            # Another process may have changed it
+            self._load()
+            self._truncate()
+            changed = []
+            for countfile in countfiles:
+                if self.is_current(countfile):
+                    continue
+                self._add(countfile)
+                changed.append(sample_label(countfile))
+            return changed
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+    def _truncate(self):
+        # Drop anything a killed run appended after the last listed sample
+        n = len(self.samples)
+        for name, dtype, width in (
+                ('counts.bin', COUNT_DTYPE, len(self.genes or [])),
+                ('qc.bin', QC_DTYPE, len(self.qc_names))):
+            fn = self._file(name)
+            if os.path.exists(fn):
+                size = n * width * dtype.itemsize
+                if os.path.getsize(fn) > size:
+                    fout = open(fn, 'r+b')
+                    fout.truncate(size)
+                    fout.close()
+
+    def _add(self, countfile):
+        genes, qc = read_counts(countfile)
+        if self.genes is None:
+            self.genes = sorted(genes)
+            self.gene_index = dict(
+                    (gene, i) for i, gene in enumerate(self.genes))
+            _write_lines(self._file('genes.txt'), self.genes)
+            _write_lines(self._file('qc.txt'), self.qc_names)
+        elif len(genes) != len(self.genes) or any(
+                gene not in self.gene_index for gene in genes):
+            raise ValueError(
+                    '%s does not have the same genes as the count matrix '
+                    'in %s; remove the matrix to rebuild it' % (
+                        countfile, self.path))
+        column = np.zeros(len(self.genes), dtype=COUNT_DTYPE)
+        for gene, n in genes.iteritems():
+            column[self.gene_index[gene]] = n
+        qc_column = np.array(
+                [qc.get(name, 0) for name in self.qc_names], dtype=QC_DTYPE)
+
+        label = sample_label(countfile)
+        st = os.stat(countfile)
+        self.stamps[label] = (st.st_size, st.st_mtime)
+        if label in self.sample_index:
+            i = self.sample_index[label]
+            for name, values in (('counts.bin', column),
+                                 ('qc.bin', qc_column)):
+                fout = open(self._file(name), 'r+b')
+                fout.seek(i * values.nbytes)
+                fout.write(values.tostring())
+                fout.close()
+            # Rewrite the list so the new stamp is recorded
+            self._write_samples()
+        else:
+            for name, values in (('counts.bin', column),
+                                 ('qc.bin', qc_column)):
+                fout = open(self._file(name), 'ab')
+                fout.write(values.tostring())
+                fout.flush()
+                os.fsync(fout.fileno())
+                fout.close()
+            self.sample_index[label] = len(self.samples)
+            self.samples.append(label)
+            fout = open(self._file('samples.txt'), 'a')
+            fout.write(_sample_line(label, self.stamps[label]))
+            fout.close()
+
+    def _write_samples(self):
+        tmp = self._file('samples.txt.tmp')
+        fout = open(tmp, 'w')
+        for label in self.samples:
+            fout.write(_sample_line(label, self.stamps[label]))
+        fout.close()
+        os.rename(tmp, self._file('samples.txt'))
+
+    def export(self, out):
+        """
+        Writes the matrix to the file object `out` as tab-separated text,
+        one row per gene and then one per QC row, with a header of sample
+        labels.
+        """
+        counts = self.counts
+        qc = self.qc
+        out.write('\t'.join(['gene'] + self.samples) + '\n')
+        for j, gene in enumerate(self.genes or []):
+            out.write('\t'.join([gene] + [str(n) for n in counts[:, j]]) +
+                      '\n')
+        for j, name in enumerate(self.qc_names):
+            out.write('\t'.join([name] + [str(n) for n in qc[:, j]]) + '\n')
+
+
+def _sample_line(label, stamp):
+    return '%s\t%d\t%r\n' % (label, stamp[0], stamp[1])
+
+
+def _write_lines(fn, lines):
+    fout = open(fn, 'w')
+    for line in lines:
+        fout.write(line + '\n')
+    fout.close()
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0])
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('add', help='Add or update samples from count files')
+    p.add_argument('matrix')
+    p.add_argument('countfiles', nargs='+')
+    p = sub.add_parser('export', help='Print the matrix as TSV')
+    p.add_argument('matrix')
+    args = parser.parse_args()
+
+    matrix = CountMatrix(args.matrix)
+    if args.command == 'add':
+        for label in matrix.add(args.countfiles):
+            print label
+    else:
+        matrix.export(sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+"""
+Machine-readable metrics for each task, as an alternative to scraping the
+log.
+
+Every Result that is reported is appended to a JSONL file as one line, and
+a snapshot of the run so far is written in the Prometheus text format, for
+node_exporter's textfile collector.  Records are written as soon as each
+task finishes, and the snapshot at most every PROM_INTERVAL seconds and at
+the end of the run, so a long run can be watched while it is going.
+"""
+import os
+import glob
+import json
+import time
+import socket
+import tempfile
+import multiprocessing
+import samples
+
+# Shortest time between rewrites of the Prometheus snapshot
+PROM_INTERVAL = 5
+
+
+class MetricsExport(object):
+    def __init__(self, jsonl=None, prom=None, config=None):
+        """
+        Writes task metrics to the JSONL file `jsonl` (appended to, so one
+        file can hold many runs) and/or the Prometheus textfile `prom`.
+        Output filenames are matched against the samples in `config` to
+        label each task with its sample.
+
+        The records of this run are also kept in `prom`.<run ID>.jsonl, so
+        that the snapshot for `prom` covers the tasks of every worker
+        process; those of earlier runs are removed.  Each process reads the
+        records it hasn't seen yet from there when it writes the snapshot.
+
+        Create this before the pipeline starts so that all of the worker
+        processes share the same run ID.
+        """
+        self.jsonl = jsonl
+        self.prom = prom
+        self.lock = multiprocessing.Lock()
+        self.run_id = '%s-%s-%d' % (
+                time.strftime('%Y%m%dT%H%M%S'), socket.gethostname(),
+                os.getpid())
+        self.run_file = None
+        if prom:
+            for fn in glob.glob(prom + '.*.jsonl'):
+                os.unlink(fn)
+            self.run_file = '%s.%s.jsonl' % (prom, self.run_id)
+        # Latest record for each (task, sample), how many tasks finished
+        # and failed, as of `self.run_offset` in the run file
+        self.latest = {}
+        self.finished = 0
+        self.failed = 0
+        self.run_offset = 0
+        self.prom_written = 0
+        self.sample_dirs = {}
+        if config is not None:
+            for sample in samples.iter_samples(config):
+                outdir = os.path.join(config['output dir'], sample['label'])
+                self.sample_dirs[os.path.abspath(outdir)] = sample['label']
+
+    def sample(self, result):
+        """
+        Label of the sample whose output directory `result`'s outputs are in,
+        or None.
+        """
+        for fn in list(result.outfiles) + list(result.infiles):
+            d = os.path.dirname(os.path.abspath(fn))
+            if d in self.sample_dirs:
+                return self.sample_dirs[d]
+        return None
+
+    def record_dict(self, result):
+        """
+        The JSON-serializable record for `result`.
+        """
+        failed = result.failed
+        if not isinstance(failed, (bool, int, long)):
+            failed = bool(failed)
+        stages = []
+        for stage in result.stages:
+            stages.append({
+                'desc': stage.desc,
+                'elapsed': stage.elapsed,
+                'failed': stage.failed,
+                'cmds': stage.cmds,
+                'usage': stage.usage,
+            })
+        return {
+            'run': self.run_id,
+            'time': time.time(),
+            'task': result.desc,
+            'sample': self.sample(result),
+            'elapsed': result.elapsed,
+            'failed': failed,
+            'cmds': result.cmds,
+            'infiles': result.infiles,
+            'outfiles': result.outfiles,
+            'log': result.log,
+            'input size': result.usage.get('input size'),
+            'output size': result.usage.get('output size'),
+            'retries': result.stats.get('chunk retries', 0),
+            'usage': result.usage,
+            'stats': result.stats,
+            'stages': stages,
+        }
+
+    def record(self, result):
+        """
+        Adds `result` to the metrics files.
+        """
+        rec = self.record_dict(result)
+        with self.lock:
+            self._write(rec)
+
+    def _write(self, rec):
+        line = json.dumps(rec, sort_keys=True) + '\n'
+        for fn in (self.jsonl, self.run_file):
+            if fn:
+                fout = open(fn, 'a')
+                fout.write(line)
+                fout.close()
+        if self.prom and time.time() - self.prom_written >= PROM_INTERVAL:
+            self.write_prom()
+
+    def close(self):
+        """
+        Writes the final snapshot, including any tasks that finished since
+        the last one.
+        """
+        if self.prom:
+            with self.lock:
+                self.write_prom()
+
+    def read_run_records(self):
+        """
+        Adds the records that other processes (or this one) have added to
+        the run file since it was last read.  Only whole lines are read;
+        they are written under the lock, which the caller holds.
+        """
+        fin = open(self.run_file)
+        fin.seek(self.run_offset)
+        for line in fin:
+            if not line.endswith('\n'):
+                break
+            self.run_offset += len(line)
+            rec = json.loads(line)
+            self.latest[(rec['task'], rec['sample'])] = rec
+            self.finished += 1
+            if rec['failed']:
+                self.failed += 1
+        fin.close()
+
+    def write_prom(self):
+        """
+        Atomically replaces the Prometheus textfile with a snapshot of this
+        run's records; only the latest record for each task and sample is
+        kept.
+        """
+        self.read_run_records()
+        self.prom_written = time.time()
+        latest = self.latest
+
+        gauges = [
+            ('elapsed_seconds', 'Wall time of the task',
+             lambda r: r['elapsed']),
+            ('failed', 'Whether the task failed (its exit status if known)',
+             lambda r: int(r['failed'])),
+            ('user_cpu_seconds', 'User CPU time of the task',
+             lambda r: r['usage'].get('user CPU')),
+            ('system_cpu_seconds', 'System CPU time of the task',
+             lambda r: r['usage'].get('system CPU')),
+            ('peak_rss_bytes', 'Peak resident memory of the task',
+             lambda r: r['usage'].get('peak RSS')),
+            ('input_bytes', 'Total size of the input files',
+             lambda r: r['input size']),
+            ('output_bytes', 'Total size of the output files',
+             lambda r: r['output size']),
+            ('reads', 'Reads processed by the task',
+             lambda r: r['stats'].get('reads')),
+            ('retries', 'Retries of parts of the task',
+             lambda r: r['retries']),
+            ('finished_timestamp_seconds', 'When the task finished',
+             lambda r: r['time']),
+        ]
+        lines = []
+        for name, help, get in gauges:
+            name = 'pipeline_task_' + name
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s gauge' % name)
+            for (task, sample), rec in sorted(latest.items()):
+                value = get(rec)
+                if value is None:
+                    continue
+                lines.append('%s{run="%s",task="%s",sample="%s"} %s' % (
+                    name, self.run_id, escape(task), escape(sample or ''),
+                    value))
+
+        name = 'pipeline_tasks_finished_total'
+        lines.append('# HELP %s Tasks finished so far in this run' % name)
+        lines.append('# TYPE %s counter' % name)
+        for status, n in [('ok', self.finished - self.failed),
+                          ('failed', self.failed)]:
+            lines.append('%s{run="%s",status="%s"} %d' % (
+                name, self.run_id, status, n))
+
+        d = os.path.dirname(os.path.abspath(self.prom))
+        fd, tmp = tempfile.mkstemp(dir=d, prefix='.metrics-')
+        os.write(fd, '\n'.join(lines) + '\n')
+        os.close(fd)
+        os.chmod(tmp, 0644)
+        os.rename(tmp, self.prom)
+
+
+def escape(value):
+    """Escapes `value` for use as a Prometheus label value"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+            '\n', '\\n')
@@ -1,58 +1,166 @@
 #!/usr/bin/python
 
 from ruffus import *
-import yaml
 import os
 import tasks
 import helpers
+import metrics
+import backends
 
 # Config ---------------------------------------------------------------------
 # Set up command line option handling, logger creation, and load config file
 options = helpers.get_options()
 logger_proxy, logging_mutex = helpers.make_logger(options, __file__)
-config = yaml.load(open(options.config).read())
+config = helpers.load_config(options.config)
+if options.no_cache:
+    config['result cache dir'] = None
+run_metrics = None
+if options.metrics or options.prom_metrics:
+    run_metrics = metrics.MetricsExport(
+            options.metrics, options.prom_metrics, config)
+
+
+# Where tasks' work is done; dependencies are always tracked here
+backend = backends.get_backend(options, config)
 
 
 def report(result):
     """Wrapper around Result.report"""
-    result.report(logger_proxy, logging_mutex)
+    result.report(logger_proxy, logging_mutex, run_metrics)
 
 
 # Pipeline -------------------------------------------------------------------
-@files(list(tasks.fastq_to_other_files(config, extension='.clipped')))
-def clip(infile, outfile):
-    result = tasks.clip(infile, outfile, config)
-
-
-@transform(clip, suffix('.clipped'), '.clipped.bowtie.sam')
-def map(infile, outfile):
-    result = tasks.bowtie(infile, outfile, config)
-    report(result)
-
 try:
     filter_bed = config['filter bed']
 except KeyError:
     filter_bed = None
 
+# Alignments are kept as BAM between the map, filter and count stages if
+# requested; otherwise as SAM.  Streaming runs have no intermediates.
+if config.get('bam intermediates') and not config.get('streaming'):
+    map_suffix = '.clipped.bowtie.bam'
+else:
+    map_suffix = '.clipped.bowtie.sam'
+filtered_suffix = map_suffix + '.filtered'
+
 if filter_bed:
-    @transform(
-            map, suffix('.clipped.bowtie.sam'), '.clipped.bowtie.sam.filtered')
-    def filter(infile, outfile):
-        result = tasks.filter(infile, outfile, config)
+    result_suffix = filtered_suffix + '.count'
+else:
+    result_suffix = map_suffix + '.count'
+
+# FASTQ files are indexed first if requested, and again only when they
+# change; the index speeds up chunking, batching and the built-in clipper
+first_tasks = []
+if config.get('fastq index'):
+    @files(lambda: tasks.fastq_index_files(config))
+    @check_if_uptodate(
+        lambda fastq, index: tasks.fastq_index_needed(fastq, index, config))
+    def index(infile, outfile):
+        result = backend.call(tasks.index_fastq, infile, outfile, config)
+        report(result)
+    first_tasks.append(index)
+
+if config.get('streaming'):
+    # All stages for a sample run at once, connected by pipes; only the
+    # final counts (plus the clipping report and bowtie log) are written.
+    @follows(*first_tasks)
+    @files(lambda: tasks.fastq_to_other_files(
+        config,
+        extension=[result_suffix,
+                   '.clipped.clipping_report',
+                   '.clipped.bowtie.sam.log']))
+    @helpers.tracks(config, tasks.clip, tasks.bowtie, tasks.filter,
+                    tasks.count)
+    def count(infile, outfiles):
+        result = backend.call(tasks.stream, infile, outfiles, config)
         report(result)
-    parent_task = filter
-    parent_suffix = '.clipped.bowtie.sam.filtered'
-    result_suffix = '.clipped.bowtie.sam.filtered.count'
+
 else:
-    parent_task = map
-    parent_suffix = '.clipped.bowtie.sam'
-    result_suffix = '.clipped.bowtie.sam.count'
+    # Jobs are listed by functions, which ruffus only calls if the task is
+    # needed for the target tasks
+    @follows(*first_tasks)
+    @files(lambda: tasks.fastq_to_other_files(config, extension='.clipped'))
+    @helpers.tracks(config, tasks.clip)
+    def clip(infile, outfile):
+        result = backend.call(tasks.clip, infile, outfile, config)
+        report(result)
+
+    if config.get('map batch reads'):
+        # Map several samples with each bowtie run.  Each job makes the
+        # per-sample files for its batch, so the downstream tasks list those
+        # files themselves (see after_map) and are told to follow map.
+        @follows(clip)
+        @files(lambda: tasks.map_batches(config, map_suffix))
+        @helpers.tracks(config, tasks.bowtie)
+        def map(infiles, outfiles):
+            result = backend.call(
+                    tasks.bowtie_batch, infiles, outfiles, config)
+            report(result)
+
+        def after_map(output_suffix):
+            # One job per sample, for the files made by map's batch jobs;
+            # listed lazily, like clip's
+            def jobs():
+                for fastq, clipped in tasks.fastq_to_other_files(
+                        config, extension='.clipped'):
+                    mapped = clipped[:-len('.clipped')] + map_suffix
+                    yield mapped, mapped[:-len(map_suffix)] + output_suffix
+            return files(jobs)
+    else:
+        @transform(clip, suffix('.clipped'), map_suffix)
+        @helpers.tracks(config, tasks.bowtie)
+        def map(infile, outfile):
+            result = backend.call(tasks.bowtie, infile, outfile, config)
+            report(result)
+
+        def after_map(output_suffix):
+            return transform(map, suffix(map_suffix), output_suffix)
+
+    if filter_bed:
+        @follows(map)
+        @after_map(filtered_suffix)
+        @helpers.tracks(config, tasks.filter)
+        def filter(infile, outfile):
+            result = backend.call(tasks.filter, infile, outfile, config)
+            report(result)
+        count_jobs = transform(filter, suffix(filtered_suffix), result_suffix)
+    else:
+        count_jobs = after_map(result_suffix)
 
+    if (config.get('count engine') == 'inprocess'
+            and options.backend == 'local'
+            and not (options.just_print or options.flowchart)):
+        # Parse the GFF once, here, so every worker inherits the index
+        import counting
+        counting.preload(config)
 
-@transform(parent_task, suffix(parent_suffix), result_suffix)
-def count(infile, outfile):
-    result = tasks.count(infile, outfile, config)
-    report(result)
+    @follows(map)
+    @count_jobs
+    @helpers.tracks(config, tasks.count)
+    def count(infile, outfile):
+        result = backend.call(tasks.count, infile, outfile, config)
+        report(result)
+
+if config.get('count matrix'):
+    # Collect every sample's counts into one binary genes x samples matrix
+    @merge(count, os.path.join(config['count matrix'], 'samples.txt'))
+    def matrix(infiles, outfile):
+        result = backend.call(tasks.count_matrix, infiles, outfile, config)
+        report(result)
+
+if (config.get('bowtie shared index')
+        and options.backend == 'local'
+        and not (options.just_print or options.flowchart)):
+    # The index is counted once against the memory budget, and the first
+    # mapping job (if any) gets it into the page cache for the others.  Jobs
+    # run by the queue and sbatch backends are in processes of their own, on
+    # hosts this budget doesn't cover.
+    helpers.share_memory('bowtie index', tasks.index_size(config))
+    tasks.prefetch_pending.value = 1
 # ----------------------------------------------------------------------------
 
-helpers.run(options)
+try:
+    helpers.run(options)
+finally:
+    if run_metrics is not None:
+        run_metrics.close()
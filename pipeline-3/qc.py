@@ -0,0 +1,350 @@
+#!/usr/bin/python
+"""
+Read and alignment QC statistics, collected as the reads and alignments
+stream between the pipeline's tools instead of in another pass over the
+files.
+
+`qc.py fastq OUT` and `qc.py sam OUT` copy stdin to stdout unchanged, so
+they can be put anywhere in a pipe, and write what they saw to the JSON
+file OUT when the stream ends.  Data are parsed a chunk at a time, with
+NumPy doing the per-base work, so the tee costs little next to the tools
+on either side of it.
+
+    `fastq`: number of reads, read-length histogram and, for each position
+             in the reads, the mean base quality and the fraction of bases
+             below Q20
+    `sam`: number of reads, how many mapped, and the MAPQ histogram of the
+           mapped ones.  Secondary and supplementary alignments are not
+           counted.
+
+Example::
+
+    gzip -dc reads.fastq.gz | ./qc.py fastq reads.qc.json | bowtie ...
+"""
+import os
+import re
+import sys
+import json
+import errno
+import tempfile
+from argparse import ArgumentParser
+import numpy as np
+
+CHUNK_SIZE = 1 << 20
+
+# Bases below this quality are counted per position
+LOW_QUALITY = 20
+
+# Quality encodings that can be told apart
+PHRED_OFFSETS = (33, 64)
+
+# Permissions of a newly created file under this process's umask, for
+# summaries written through tempfile.mkstemp() (which makes them 0600)
+_umask = os.umask(0)
+os.umask(_umask)
+FILE_MODE = 0666 & ~_umask
+
+# FLAG and MAPQ of the SAM alignment lines after each newline
+ALIGNMENT_FIELDS = re.compile(
+        r'\n[^@\t][^\t]*\t(\d+)\t[^\t]*\t[^\t]*\t(\d+)\t')
+
+
+class ReadStats(object):
+    def __init__(self, phred_offset=None):
+        """
+        Accumulates statistics of FASTQ reads whose qualities are encoded
+        with `phred_offset`.  If it is None, it is guessed from the lowest
+        quality seen, like FastQC does: 64 if no quality is below "@", and
+        33 otherwise.
+        """
+        self.phred_offset = phred_offset
+        self.reads = 0
+        self.lowest = 255
+        # Indexed by read length
+        self.lengths = np.zeros(1, dtype=np.int64)
+        # Indexed by position in the read, and for low_quality also by which
+        # of PHRED_OFFSETS the qualities are below LOW_QUALITY with
+        self.quality_sums = np.zeros(0, dtype=np.int64)
+        self.low_quality = np.zeros((len(PHRED_OFFSETS), 0), dtype=np.int64)
+
+    def _grow(self, width):
+        # Makes room for reads of up to `width` bases
+        if len(self.quality_sums) < width:
+            n = len(self.quality_sums)
+            self.lengths = np.concatenate(
+                    [self.lengths, np.zeros(width - n, dtype=np.int64)])
+            self.quality_sums = np.concatenate(
+                    [self.quality_sums, np.zeros(width - n, dtype=np.int64)])
+            self.low_quality = np.hstack([
+                self.low_quality,
+                np.zeros((len(PHRED_OFFSETS), width - n), dtype=np.int64)])
+
+    def update(self, text):
+        """
+        Adds the FASTQ records in `text`, which must be whole records.
+        """
+        self.add_qualities(text.split('\n')[3::4])
+
+    def add_qualities(self, quals):
+        """
+        Adds reads with the quality strings `quals`.
+        """
+        n = len(quals)
+        if not n:
+            return
+        lengths = np.array(map(len, quals), dtype=np.int64)
+        width = int(lengths.max())
+        self._grow(width)
+        counts = np.bincount(lengths, minlength=width + 1)
+        self.reads += n
+        self.lengths[:width + 1] += counts
+        if not width:
+            return
+        sums = 0
+        if lengths.min() == width:
+            packed = ''.join(quals)
+        else:
+            # Positions past the end of a read are filled with character
+            # 255, which is taken back out of the sums and is never low
+            packed = ''.join([q.ljust(width, '\xff') for q in quals])
+            sums -= 255 * np.cumsum(counts)[:width]
+        arr = np.frombuffer(packed, dtype=np.uint8).reshape(n, width)
+        self.lowest = min(self.lowest, int(arr.min()))
+        sums += arr.sum(axis=0, dtype=np.int64)
+        self.quality_sums[:width] += sums
+        for i, offset in enumerate(PHRED_OFFSETS):
+            self.low_quality[i, :width] += (
+                    arr < offset + LOW_QUALITY).sum(axis=0)
+
+    def merge(self, other):
+        """
+        Adds the reads counted by the ReadStats `other`.
+        """
+        width = len(other.quality_sums)
+        self._grow(width)
+        self.reads += other.reads
+        self.lowest = min(self.lowest, other.lowest)
+        self.lengths[:width + 1] += other.lengths
+        self.quality_sums[:width] += other.quality_sums
+        self.low_quality[:, :width] += other.low_quality
+
+    def summary(self):
+        """
+        Dictionary of the statistics, for the JSON summary.
+        """
+        offset = self.phred_offset
+        if offset is None:
+            offset = 64 if self.lowest >= 64 else 33
+        width = len(self.quality_sums)
+        # Number of reads that reach each position
+        covered = self.reads - np.cumsum(self.lengths)[:width]
+        low = self.low_quality[PHRED_OFFSETS.index(offset)]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_quality = np.where(
+                    covered > 0,
+                    self.quality_sums / covered.astype(float) - offset, 0)
+            low = np.where(covered > 0, low / covered.astype(float), 0)
+        lengths = np.arange(len(self.lengths))
+        return {
+            'reads': self.reads,
+            'mean length': round(
+                float((lengths * self.lengths).sum()) / self.reads, 2)
+            if self.reads else 0,
+            'length histogram': dict(
+                (str(i), int(n)) for i, n in enumerate(self.lengths) if n),
+            'phred offset': offset,
+            'mean quality by position': [
+                round(float(q), 2) for q in mean_quality],
+            'fraction below Q%d by position' % LOW_QUALITY: [
+                round(float(f), 4) for f in low],
+        }
+
+
+class MappingStats(object):
+    def __init__(self):
+        """
+        Accumulates mapping statistics of SAM alignments.
+        """
+        self.reads = 0
+        self.mapped = 0
+        # Keyed by MAPQ, as a string
+        self.mapq = {}
+
+    def update(self, text):
+        """
+        Adds the SAM lines in `text`; header lines are ignored.
+        """
+        # There are only a few different (FLAG, MAPQ) pairs, so count those
+        # first
+        pairs = {}
+        for pair in ALIGNMENT_FIELDS.findall('\n' + text):
+            pairs[pair] = pairs.get(pair, 0) + 1
+        for (flag, mapq), n in pairs.iteritems():
+            flag = int(flag)
+            if flag & 0x900:
+                # secondary or supplementary
+                continue
+            self.reads += n
+            if not flag & 0x4:
+                self.mapped += n
+                self.mapq[mapq] = self.mapq.get(mapq, 0) + n
+
+    def merge(self, other):
+        """
+        Adds the alignments counted by the MappingStats `other`.
+        """
+        self.reads += other.reads
+        self.mapped += other.mapped
+        for mapq, n in other.mapq.items():
+            self.mapq[mapq] = self.mapq.get(mapq, 0) + n
+
+    def summary(self):
+        """
+        Dictionary of the statistics, for the JSON summary.
+        """
+        return {
+            'reads': self.reads,
+            'mapped': self.mapped,
+            'mapping rate': round(float(self.mapped) / self.reads, 4)
+            if self.reads else 0,
+            'mapq histogram': dict(self.mapq),
+        }
+
+    @classmethod
+    def from_summary(cls, summary):
+        """
+        MappingStats with the counts in `summary`, as made by summary().
+        """
+        stats = cls()
+        stats.reads = summary['reads']
+        stats.mapped = summary['mapped']
+        stats.mapq = dict(summary['mapq histogram'])
+        return stats
+
+
+def shorter_than_longest(summary):
+    """
+    Number of reads shorter than the longest one, from the summary() of
+    a ReadStats.
+    """
+    histogram = summary['length histogram']
+    if not histogram:
+        return 0
+    return summary['reads'] - histogram[max(histogram, key=int)]
+
+
+def adapter_summary(reads, with_adapter, estimated=False):
+    """
+    Summary of how many of `reads` reads had the adapter.  `estimated` says
+    whether `with_adapter` is an estimate.
+    """
+    return {
+        'reads': reads,
+        'reads with adapter': with_adapter,
+        'adapter rate': round(float(with_adapter) / reads, 4)
+        if reads else 0,
+        'estimated': estimated,
+    }
+
+
+def tee(fin, fout, stats, lines_per_record=1, chunk_size=CHUNK_SIZE):
+    """
+    Copies the file object `fin` to `fout` a chunk at a time, passing the
+    whole records of `lines_per_record` lines in each chunk to
+    stats.update() as text.
+    """
+    rest = ''
+    while True:
+        chunk = fin.read(chunk_size)
+        if not chunk:
+            break
+        fout.write(chunk)
+        text = rest + chunk
+        # Back up to the end of the last whole record
+        end = len(text)
+        for i in range(text.count('\n') % lines_per_record + 1):
+            end = text.rfind('\n', 0, end)
+            if end < 0:
+                break
+        end += 1
+        stats.update(text[:end])
+        rest = text[end:]
+    if rest and rest.count('\n') == lines_per_record - 1:
+        # no newline at the end of the last record
+        stats.update(rest + '\n')
+    fout.flush()
+
+
+def write_summary(fn, summary):
+    """
+    Atomically writes the dictionary `summary` to the JSON file `fn`.
+    """
+    fd, tmp = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(fn)), prefix='.tmp-')
+    os.fchmod(fd, FILE_MODE)
+    fout = os.fdopen(fd, 'w')
+    json.dump(summary, fout, sort_keys=True)
+    fout.write('\n')
+    fout.close()
+    os.rename(tmp, fn)
+
+
+def read_summary(fn):
+    return json.load(open(fn))
+
+
+def collect(outfile, parts):
+    """
+    Writes the summaries in the files of the dictionary `parts` to `outfile`,
+    as sections named by its keys, and removes the files.
+    """
+    summary = {}
+    for section, fn in parts.items():
+        summary[section] = read_summary(fn)
+        os.unlink(fn)
+    write_summary(outfile, summary)
+    return summary
+
+
+def tee_cmds(kind, outfile, infile=None):
+    """
+    Command that tees `kind` ("fastq" or "sam") data from stdin, or from
+    `infile` if given, to stdout and writes its statistics to `outfile`.
+    """
+    cmds = [sys.executable, os.path.abspath(__file__), kind, outfile]
+    if infile is not None:
+        cmds.append(infile)
+    return cmds
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('kind', choices=['fastq', 'sam'])
+    parser.add_argument('outfile', help='JSON file for the statistics')
+    parser.add_argument('infile', nargs='?',
+                        help='Read from this file instead of stdin')
+    parser.add_argument('--phred-offset', type=int,
+                        help='Quality encoding of FASTQ input (default: '
+                             'guessed from the qualities)')
+    args = parser.parse_args()
+
+    fin = sys.stdin
+    if args.infile:
+        fin = open(args.infile, 'rb')
+    try:
+        if args.kind == 'fastq':
+            stats = ReadStats(args.phred_offset)
+            tee(fin, sys.stdout, stats, lines_per_record=4)
+        else:
+            stats = MappingStats()
+            tee(fin, sys.stdout, stats)
+    except IOError as e:
+        # the next command exited early; it reports its own error
+        if e.errno != errno.EPIPE:
+            raise
+        sys.exit(1)
+    write_summary(args.outfile, stats.summary())
+
+
+if __name__ == '__main__':
+    main()
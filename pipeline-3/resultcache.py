@@ -0,0 +1,215 @@
+"""
+Content-addressed cache of task outputs, shared across runs and output
+directories.
+
+A task's cache key is a hash of the contents of its input files, the
+config values and side files (index, GFF, ...) it uses, and the versions of
+the tools it runs.  When a task is called with a key that is already in the
+cache, its outputs are reflinked (or copied) from the cache instead of
+running the task again.  Cached files are never hard linked to outputs,
+since tasks may later rewrite their outputs in place.
+
+The cache directory contains:
+
+    `objects/<key>/`: one entry per cached task result, with the output
+                      files, a "meta.json" describing them, and a
+                      "last_used" file used for LRU eviction
+    `hashes/`: remembered content hashes of input and side files
+"""
+import os
+import json
+import glob
+import shutil
+import hashlib
+import functools
+import tempfile
+import subprocess
+import helpers
+from helpers import Result
+
+# Tool versions that have already been looked up in this process
+_versions = {}
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def tool_version(tool):
+    """
+    Returns a string identifying the version of `tool`.  For a module of
+    this pipeline (e.g., "clipper.py"), this is a hash of its source;
+    otherwise it is whatever the tool prints when called with --version.
+    """
+    if tool not in _versions:
+        if tool.endswith('.py'):
+            _versions[tool] = helpers.content_hash(os.path.join(HERE, tool))
+        else:
+            try:
+                p = helpers.popen(
+                        [tool, '--version'], stdout=subprocess.PIPE,
+                        stderr=subprocess.STDOUT)
+                stdout, stderr = p.communicate()
+                _versions[tool] = stdout.strip()[:1000]
+            except OSError:
+                _versions[tool] = None
+    return _versions[tool]
+
+
+class ResultCache(object):
+    def __init__(self, cache_dir, max_size=None):
+        """
+        Cache of task results in `cache_dir`.  If `max_size` (bytes) is
+        given, least recently used results are removed when new ones are
+        added to keep the cache under that size.
+        """
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.objects = os.path.join(self.cache_dir, 'objects')
+        self.hashes = os.path.join(self.cache_dir, 'hashes')
+        self.max_size = max_size
+        helpers.mkdir_p(self.objects)
+
+    def file_hash(self, path):
+        """
+        Hash of the contents of `path`.  If `path` is not a file it is treated
+        as a prefix (like a bowtie index), and all files starting with it are
+        hashed.
+        """
+        if os.path.isfile(path):
+            return helpers.content_hash(path, self.hashes)
+        h = hashlib.sha1()
+        for fn in sorted(glob.glob(path + '*')):
+            if os.path.isfile(fn):
+                h.update('%s\t%s\n' % (
+                    os.path.basename(fn),
+                    helpers.content_hash(fn, self.hashes)))
+        return h.hexdigest()
+
+    def key(self, task, infiles, config, keys, files, tools):
+        """
+        Cache key for running `task` on `infiles` with `config`.  `keys` are
+        the config values the task depends on, `files` the config values that
+        name side files, and `tools` the tools it runs.
+        """
+        if isinstance(infiles, basestring):
+            infiles = [infiles]
+        desc = {
+            'task': task,
+            'inputs': [self.file_hash(fn) for fn in infiles],
+            'config': dict((k, config.get(k)) for k in keys),
+            'files': dict(
+                (k, self.file_hash(config[k])) for k in files
+                if config.get(k)),
+            'tools': dict((t, tool_version(t)) for t in tools),
+        }
+        return hashlib.sha1(json.dumps(desc, sort_keys=True)).hexdigest()
+
+    def fetch(self, key, primary):
+        """
+        If `key` is in the cache, recreates its outputs next to the output
+        file `primary` and returns the (outfiles, log) they were stored with.
+        Otherwise returns None.
+        """
+        path = os.path.join(self.objects, key)
+        try:
+            meta = json.load(open(os.path.join(path, 'meta.json')))
+            os.utime(os.path.join(path, 'last_used'), None)
+            for i, suffix in enumerate(meta['suffixes']):
+                dst = primary + str(suffix)
+                helpers.link_or_copy(
+                        os.path.join(path, str(i)), dst, hard_link=False)
+                # Make the output newer than its inputs as far as ruffus is
+                # concerned
+                os.utime(dst, None)
+        except (IOError, OSError):
+            # not cached, or evicted while we were looking
+            return None
+        outfiles = [primary + str(suffix) for suffix in meta['outfiles']]
+        log = None
+        if meta['log'] is not None:
+            log = primary + str(meta['log'])
+        return outfiles, log
+
+    def store(self, key, primary, outfiles, log=None):
+        """
+        Adds the `outfiles` and `log` of a task to the cache under `key`.
+        Only files whose names start with `primary` (the task's main output)
+        can be stored, since they are recreated relative to it.
+        """
+        files = list(outfiles)
+        if log is not None:
+            files.append(log)
+        if not all(fn.startswith(primary) for fn in files):
+            return
+        suffix = lambda fn: fn[len(primary):]
+        path = os.path.join(self.objects, key)
+        if os.path.exists(path):
+            return
+        tmp = tempfile.mkdtemp(dir=self.objects, prefix='.store-')
+        for i, fn in enumerate(files):
+            helpers.link_or_copy(
+                    fn, os.path.join(tmp, str(i)), hard_link=False)
+        fout = open(os.path.join(tmp, 'meta.json'), 'w')
+        json.dump({'suffixes': [suffix(fn) for fn in files],
+                   'outfiles': [suffix(fn) for fn in outfiles],
+                   'log': suffix(log) if log is not None else None}, fout)
+        fout.close()
+        open(os.path.join(tmp, 'last_used'), 'w').close()
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # another process stored the same result first
+            shutil.rmtree(tmp)
+            return
+        if self.max_size is not None:
+            helpers.evict_lru(self.objects, self.max_size, keep=key)
+
+
+def cached(keys=(), files=(), tools=(), skip_if=None):
+    """
+    Decorator for tasks called as func(infiles, outfiles, config) that
+    return a Result.  If config['result cache dir'] is set, the task's
+    outputs are looked up in, and added to, the ResultCache there.
+
+    `keys` are the config values the task's output depends on, `files` are
+    config values naming side files it reads, and `tools` are the programs
+    (or pipeline modules) it runs.  `keys` and `files` are also kept as the
+    task's `tracked_keys` and `tracked_files` attributes, so that
+    helpers.tracks() can rerun it when they change.
+
+    If `skip_if`(config) is true, the task is run without the cache, e.g.,
+    when it only links its outputs to its inputs, which would be stored (and
+    fetched) as full copies.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(infiles, outfiles, config):
+            cache_dir = config.get('result cache dir')
+            if not cache_dir or (skip_if is not None and skip_if(config)):
+                return func(infiles, outfiles, config)
+            max_size = config.get('result cache size')
+            if max_size is not None:
+                max_size = helpers.parse_size(max_size)
+            cache = ResultCache(cache_dir, max_size)
+            if isinstance(outfiles, basestring):
+                primary = outfiles
+            else:
+                primary = outfiles[0]
+
+            key = cache.key(
+                    func.__name__, infiles, config, keys, files, tools)
+            found = cache.fetch(key, primary)
+            if found is not None:
+                hit_outfiles, log = found
+                return Result(
+                        infiles, hit_outfiles, log=log,
+                        cmds='result cache hit: %s' % key,
+                        stats={'result cache': 'hit'})
+
+            result = func(infiles, outfiles, config)
+            if not result.failed:
+                cache.store(key, primary, result.outfiles, result.log)
+                result.stats['result cache'] = 'miss'
+            return result
+        wrapper.tracked_keys = list(keys)
+        wrapper.tracked_files = list(files)
+        return wrapper
+    return decorator
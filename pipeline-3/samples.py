@@ -0,0 +1,127 @@
+"""
+Where the samples to run come from.
+
+Samples can be listed in the config file itself (`samples`), read from
+a TSV or CSV file with one row per sample (`sample sheet`), or found with
+a glob pattern (`sample glob`).  If more than one is given, the samples
+from all of them are used, in that order.  Samples are streamed one at
+a time rather than all parsed up front, so a sheet of tens of thousands of
+samples starts as quickly as a short list.
+
+Every sample is a dictionary with at least a "label" (which names its
+output directory) and a "fastq".  Any other columns of a sample sheet are
+kept in it too, as metadata.
+"""
+import os
+import csv
+import glob
+import errno
+import helpers
+
+# Extensions removed from FASTQ filenames to label the samples found with
+# `sample glob`
+FASTQ_EXTENSIONS = ['.gz', '.bgz', '.bz2', '.fastq', '.fq', '.txt']
+
+
+def read_sheet(path):
+    """
+    Yields a dictionary for each row of the sample sheet `path`, keyed by the
+    column names in its first line.  Columns are separated by tabs, or by
+    commas if the filename ends with ".csv".  Blank lines and lines starting
+    with "#" are skipped.
+    """
+    delimiter = ',' if path.lower().endswith('.csv') else '\t'
+    lines = (line for line in open(path)
+             if line.strip() and not line.startswith('#'))
+    reader = csv.reader(lines, delimiter=delimiter)
+    try:
+        header = [name.strip() for name in next(reader)]
+    except StopIteration:
+        return
+    for row in reader:
+        if len(row) != len(header):
+            raise ValueError(
+                    '%s, line %d: expected %d columns, found %d' % (
+                        path, reader.line_num, len(header), len(row)))
+        yield dict(zip(header, [value.strip() for value in row]))
+
+
+def sample_label(fastq):
+    """
+    Label for the sample in the FASTQ file `fastq`: its name without the
+    directory or FASTQ extensions.
+    """
+    label = os.path.basename(fastq)
+    while True:
+        root, ext = os.path.splitext(label)
+        if ext.lower() not in FASTQ_EXTENSIONS:
+            return label
+        label = root
+
+
+def glob_samples(pattern):
+    """
+    Yields a sample for each file matching `pattern`, in sorted order.
+    """
+    for fastq in sorted(glob.glob(pattern)):
+        yield {'label': sample_label(fastq), 'fastq': fastq}
+
+
+def iter_samples(config):
+    """
+    Yields each sample in `config`.  Raises ValueError if a sample has no
+    label or FASTQ, or if two samples have the same label.
+    """
+    sources = []
+    if config.get('samples'):
+        sources.append(('samples', config['samples']))
+    if config.get('sample sheet'):
+        sources.append(('sample sheet', read_sheet(config['sample sheet'])))
+    if config.get('sample glob'):
+        sources.append(('sample glob', glob_samples(config['sample glob'])))
+
+    seen = set()
+    for source, samples in sources:
+        for i, sample in enumerate(samples):
+            for key in ('label', 'fastq'):
+                if not sample.get(key):
+                    raise ValueError(
+                            'Sample %d from %s has no %s' % (
+                                i + 1, source, key))
+            if sample['label'] in seen:
+                raise ValueError(
+                        'More than one sample is labeled %s' % sample['label'])
+            seen.add(sample['label'])
+            yield sample
+
+
+class OutputDirs(object):
+    def __init__(self, output_dir):
+        """
+        Makes the output directories of samples under `output_dir`.  The
+        directories that already exist are listed once, so that only missing
+        ones cost a system call.
+        """
+        self.output_dir = output_dir
+        self._existing = None
+
+    def make(self, label):
+        """
+        Makes the output directory for the sample labeled `label` if it
+        doesn't exist, and returns it.
+        """
+        if self._existing is None:
+            helpers.mkdir_p(self.output_dir)
+            self._existing = set(os.listdir(self.output_dir))
+        path = os.path.join(self.output_dir, label)
+        if label not in self._existing:
+            if os.sep in label:
+                helpers.mkdir_p(path)
+            else:
+                try:
+                    os.mkdir(path)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            self._existing.add(label)
+        return path
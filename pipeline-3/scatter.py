@@ -0,0 +1,216 @@
+"""
+Splitting FASTQ files into chunks and merging the SAM files mapped from
+them, so that one large sample can be mapped by several bowtie jobs at once;
+and the reverse, tagging the reads of several small samples so that they
+can be mapped by one bowtie job and split up again afterwards.
+"""
+import os
+import gzip
+import shutil
+import itertools
+import subprocess
+import helpers
+
+# Records copied at a time when splitting a FASTQ without an index
+BATCH_READS = 100000
+
+
+def split_fastq(fastq, chunk_dir, chunk_reads, settings='', read_qc=False):
+    """
+    Splits `fastq` (which may be compressed) into files of `chunk_reads`
+    records each in `chunk_dir`, and returns their filenames in order.
+
+    A "chunks" file listing the chunks is written last, so if `chunk_dir`
+    already has one for the same `fastq` and `settings` (a string describing
+    how the chunks will be processed, e.g., the mapping options) the
+    existing chunks, and whatever was made from them, are reused (e.g.,
+    after a run where one of the chunks failed to map).  Otherwise
+    `chunk_dir` is emptied first, so nothing made from older chunks is
+    mistaken for a result of the new ones.
+
+    Chunks are copied a batch of records at a time, so they needn't fit in
+    memory.  If `fastq` has an up-to-date index (see fastqindex.py), the
+    batches are copied from the file as blocks instead of line by line.
+
+    If `read_qc` is set, QC statistics of all of the reads (see qc.py) are
+    collected while splitting and written to reads_qc_file(`chunk_dir`).
+    """
+    import fastqindex
+    import qc
+    st = os.stat(fastq)
+    source = '%s\t%s\t%s\t%s\t%s' % (
+            os.path.abspath(fastq), st.st_size, st.st_mtime, chunk_reads,
+            settings)
+    listing = os.path.join(chunk_dir, 'chunks')
+    if os.path.exists(listing):
+        lines = open(listing).read().splitlines()
+        if lines and lines[0] == source:
+            return lines[1:]
+    if os.path.exists(chunk_dir):
+        shutil.rmtree(chunk_dir)
+    os.makedirs(chunk_dir)
+
+    chunks = []
+    read_stats = qc.ReadStats() if read_qc else None
+    if fastqindex.current_index(fastq) is not None:
+        reads = fastqindex.IndexedFastq(fastq)
+        for start in xrange(0, len(reads), chunk_reads):
+            fn = os.path.join(chunk_dir, 'chunk%06d.fastq' % len(chunks))
+            fout = open(fn, 'w')
+            for text in reads.blocks(start, start + chunk_reads):
+                fout.write(text)
+                if read_stats is not None:
+                    read_stats.update(text)
+            fout.close()
+            chunks.append(fn)
+        reads.close()
+    else:
+        fin = helpers.open_fastq(fastq)
+        while True:
+            fout = None
+            left = chunk_reads
+            while left:
+                lines = list(itertools.islice(
+                    fin, 4 * min(left, BATCH_READS)))
+                if not lines:
+                    break
+                if fout is None:
+                    fn = os.path.join(
+                            chunk_dir, 'chunk%06d.fastq' % len(chunks))
+                    fout = open(fn, 'w')
+                    chunks.append(fn)
+                fout.writelines(lines)
+                if read_stats is not None:
+                    read_stats.add_qualities(
+                            [line.rstrip('\n') for line in lines[3::4]])
+                left -= len(lines) // 4
+            if fout is None:
+                break
+            fout.close()
+        fin.close()
+    if read_stats is not None:
+        qc.write_summary(reads_qc_file(chunk_dir), read_stats.summary())
+
+    fout = open(listing, 'w')
+    fout.write('\n'.join([source] + chunks) + '\n')
+    fout.close()
+    return chunks
+
+
+def reads_qc_file(chunk_dir):
+    """
+    QC summary of the reads split into `chunk_dir` by split_fastq().
+    """
+    return os.path.join(chunk_dir, 'reads.qc.json')
+
+
+def merge_sam(sams, outfile, bam_cmds=None):
+    """
+    Concatenates the SAM files `sams` into `outfile`, keeping the header
+    from the first one only.  If `bam_cmds` is given, the merged SAM is
+    piped through that command (e.g., "samtools view -S -b -") to write
+    a BAM file instead.
+    """
+    fout = open(outfile, 'w')
+    p = None
+    if bam_cmds is not None:
+        p = helpers.popen(bam_cmds, stdin=subprocess.PIPE, stdout=fout)
+        out = p.stdin
+    else:
+        out = fout
+    for i, sam in enumerate(sams):
+        for line in open(sam):
+            if line.startswith('@') and i > 0:
+                continue
+            out.write(line)
+    if p is not None:
+        p.stdin.close()
+        if p.wait():
+            raise subprocess.CalledProcessError(
+                    p.returncode, ' '.join(bam_cmds))
+    fout.close()
+
+
+# Separates the sample number from the original read name in tagged reads
+TAG_SEP = '|'
+
+
+def estimate_reads(fastq, sample_bytes=1 << 22):
+    """
+    Estimates the number of reads in `fastq` (which may be compressed) from
+    the records in its first `sample_bytes` bytes.  Small files, and files
+    with an up-to-date index (see fastqindex.py), are counted exactly.
+    """
+    import fastqindex
+    index = fastqindex.current_index(fastq)
+    if index is not None:
+        return len(index)
+    size = os.path.getsize(fastq)
+    if helpers.is_gzipped(fastq):
+        raw = open(fastq, 'rb')
+        fin = gzip.GzipFile(fileobj=raw)
+    else:
+        raw = fin = open(fastq)
+    lines = 0
+    for line in fin:
+        lines += 1
+        if raw.tell() >= sample_bytes:
+            break
+    consumed = raw.tell()
+    fin.close()
+    raw.close()
+    reads = lines // 4
+    if consumed >= size or not consumed:
+        return reads
+    return int(reads * float(size) / consumed)
+
+
+def tag_reads(fastqs, fout, read_stats=None, batch_size=100000):
+    """
+    Writes the reads from each of the FASTQ files `fastqs` (which may be
+    compressed) to the file object `fout`, with the sample's index in
+    `fastqs` added to the start of each read name.
+
+    If `read_stats` is given, it is a list of one qc.ReadStats per sample,
+    to which each sample's reads are added, `batch_size` at a time.
+    """
+    for i, fastq in enumerate(fastqs):
+        prefix = '@%d%s' % (i, TAG_SEP)
+        quals = []
+        fin = helpers.open_fastq(fastq)
+        for j, line in enumerate(fin):
+            if j % 4 == 0:
+                line = prefix + line[1:]
+            elif j % 4 == 3 and read_stats is not None:
+                quals.append(line.rstrip('\n'))
+                if len(quals) == batch_size:
+                    read_stats[i].add_qualities(quals)
+                    quals = []
+            fout.write(line)
+        fin.close()
+        if quals:
+            read_stats[i].add_qualities(quals)
+
+
+def demux_sam(lines, outs, mapping=None):
+    """
+    Splits the SAM `lines` for reads tagged by tag_reads() between the file
+    objects `outs`, one per sample, removing the tags.  Header lines go to
+    every output.  Returns the number of alignment lines for each sample.
+
+    If `mapping` is given, it is a list of one qc.MappingStats per sample,
+    to which each sample's alignments are added.
+    """
+    counts = [0] * len(outs)
+    for line in lines:
+        if line.startswith('@'):
+            for out in outs:
+                out.write(line)
+            continue
+        tag, line = line.split(TAG_SEP, 1)
+        i = int(tag)
+        outs[i].write(line)
+        counts[i] += 1
+        if mapping is not None:
+            mapping[i].update(line)
+    return counts
@@ -2,10 +2,21 @@ import time
 import datetime
 import os
 import sys
+import json
 import subprocess
 import yaml
+import shutil
 import tempfile
-from helpers import Result, timeit
+import glob
+import Queue
+import functools
+import multiprocessing
+import helpers
+import samples
+from helpers import (
+    Result, timeit, link_or_copy, unlink_output, cores, is_gzipped, wait,
+    stage_usage, popen, read_tail, task_thread, parse_size)
+from resultcache import cached
 
 
 def fastq_to_other_files(config, extension):
@@ -18,14 +29,15 @@ def fastq_to_other_files(config, extension):
 
     extension can be a list
 
+    Samples are streamed from the config, sample sheet or glob; see
+    samples.py.
     """
     if isinstance(extension, basestring):
         extension = [extension]
-    for sample in config['samples']:
+    outdirs = samples.OutputDirs(config['output dir'])
+    for sample in samples.iter_samples(config):
         infile = sample['fastq']
-        outdir = os.path.join(config['output dir'], sample['label'])
-        if not os.path.exists(outdir):
-            os.system('mkdir -p %s' % outdir)
+        outdir = outdirs.make(sample['label'])
         stub = os.path.join(outdir, sample['label'])
         outfiles = []
         for ext in extension:
@@ -38,85 +50,1065 @@ def fastq_to_other_files(config, extension):
         yield infile, outfiles
 
 
+def fastq_index_files(config):
+    """
+    Yields (FASTQ, index) for each uncompressed FASTQ in `config`, once per
+    file, for indexing (see fastqindex.py).  Compressed FASTQs can't be
+    indexed and are skipped.
+    """
+    import fastqindex
+    seen = set()
+    for sample in samples.iter_samples(config):
+        fastq = sample['fastq']
+        if fastq in seen or is_gzipped(fastq):
+            continue
+        seen.add(fastq)
+        yield fastq, fastqindex.index_file(fastq)
+
+
+def fastq_index_needed(fastq, index, config):
+    """
+    Whether `index` has to be (re)built for `fastq`: it is missing, or was
+    made for another version of `fastq` or with another config['fastq index
+    interval'].  Returns (needed, reason) for ruffus' @check_if_uptodate.
+    """
+    import fastqindex
+    if not os.path.exists(index):
+        return True, 'Missing file %s' % index
+    interval = config.get('fastq index interval', fastqindex.INTERVAL)
+    if fastqindex.current_index(fastq, interval) is None:
+        return True, '%s has changed since it was indexed' % fastq
+    return False, 'Up to date'
+
+
+def pooled_call(processes, func, *args):
+    """
+    Returns func(*`args`, processes=n), where func spreads its work over n
+    processes with helpers.pool_map() and n is as many of `processes` as
+    there are free cores.  Where pool_map() can't start a pool (in ruffus'
+    daemonic workers or threads), the call is made in a new process of its
+    own, so that the cores set aside for it are the ones it uses.
+    """
+    with cores(1, processes) as n:
+        if n > 1 and not helpers.can_fork_pool():
+            import backends
+            return backends.call_in_process(func, *(args + (n,)))
+        return func(*(args + (n,)))
+
+
 @timeit
-def bowtie(fastq, outfile, config):
+def index_fastq(fastq, index, config):
     """
-    Use bowtie to map `fastq`, saving the SAM file as `outfile`.  Ensures that
-    '--sam' is in the parameters.
+    Builds the index `index` of `fastq`, every config['fastq index
+    interval'] records, with up to config['fastq index processes'] (default
+    4) processes.
+    """
+    import fastqindex
+    interval = config.get('fastq index interval', fastqindex.INTERVAL)
+    processes = config.get('fastq index processes', 4)
+    cmds = 'fastqindex.build_index(%s, %s, processes=%s)' % (
+            fastq, interval, processes)
+    try:
+        built = pooled_call(
+                processes, fastqindex.build_index, fastq, interval)
+    except (ValueError, RuntimeError) as e:
+        return Result(fastq, index, stderr=str(e), failed=True, cmds=cmds)
+    return Result(
+            fastq, index, cmds=cmds,
+            stats={'reads': len(built), 'index entries': len(built.offsets)})
+
+
+def bowtie_threads(config):
+    """
+    Number of threads requested with -p/--threads in config['bowtie params'],
+    or 1 if not specified.
+    """
+    params = config['bowtie params'].split()
+    for i, param in enumerate(params):
+        if param in ('-p', '--threads'):
+            return int(params[i + 1])
+        if param.startswith('--threads='):
+            return int(param.split('=', 1)[1])
+        if param.startswith('-p') and param[2:].isdigit():
+            return int(param[2:])
+    return 1
+
+
+def bowtie_max_threads(config):
+    """
+    Number of threads a bowtie job may grow to when cores are idle:
+    config['bowtie max threads'], or twice the requested number.
+    """
+    return config.get('bowtie max threads', 2 * bowtie_threads(config))
+
+
+def bowtie_cmds(fastq, config, threads=None):
+    """
+    Builds the bowtie command line for mapping `fastq` (which can be '-' for
+    stdin).  Ensures that '--sam' is in the parameters.  If `threads` is
+    given it replaces any -p/--threads in config['bowtie params'].
     """
     index = config['index']
     params = config['bowtie params'].split()
+    if threads is not None:
+        kept = []
+        skip = False
+        for param in params:
+            if skip:
+                skip = False
+                continue
+            if param in ('-p', '--threads'):
+                skip = True
+                continue
+            if param.startswith('--threads=') or (
+                    param.startswith('-p') and param[2:].isdigit()):
+                continue
+            kept.append(param)
+        params = kept + ['-p', str(threads)]
     if ('--sam' not in params) and ('-S' not in params):
         params.append('-S')
+    if config.get('bowtie shared index'):
+        # Memory-map the index so concurrent jobs share the page cache, and
+        # report index loading and searching times separately.
+        for param in ('--mm', '-t'):
+            if param not in params:
+                params.append(param)
 
     cmds = ['bowtie']
     cmds.extend(params)
     cmds.append(index)
     cmds.append(fastq)
+    return cmds
+
+
+def index_files(config):
+    """
+    The files that make up the bowtie index config['index'].
+    """
+    return sorted(glob.glob(config['index'] + '.*.ebwt*'))
+
+
+def bowtie_memory(config):
+    """
+    Memory to reserve for one bowtie job: config['bowtie job memory']
+    (default 256M) for the job itself, plus the size of the index unless it
+    is shared between jobs (config['bowtie shared index']), in which case
+    pipeline.py sets it aside once for the whole run.
+    """
+    memory = parse_size(config.get('bowtie job memory', '256M'))
+    if not config.get('bowtie shared index'):
+        memory += sum(os.path.getsize(fn) for fn in index_files(config))
+    return memory
+
+
+def index_size(config):
+    """
+    Total size of the files of the bowtie index config['index'].
+    """
+    return sum(os.path.getsize(fn) for fn in index_files(config))
+
+
+@timeit
+def prefetch_index(config, chunk_size=1 << 22):
+    """
+    Reads the bowtie index into the page cache so that the bowtie jobs,
+    which memory-map it with --mm, don't all wait for it to come off the
+    disk.
+    """
+    files = index_files(config)
+    total = 0
+    for fn in files:
+        f = open(fn, 'rb')
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            total += len(chunk)
+        f.close()
+    return Result(
+            files, [], desc='prefetch bowtie index',
+            cmds='read %s' % ' '.join(files),
+            stats={'index size': helpers.nicesize(total)})
+
+
+# Set by pipeline.py when the first job that maps should prefetch the index
+# (see prefetches_index); shared with the worker processes forked afterwards
+prefetch_pending = multiprocessing.Value('b', 0)
+
+
+def prefetches_index(func):
+    """
+    Decorator for tasks that run bowtie, called as func(infiles, outfiles,
+    config).  If prefetch_pending is set, the first such job runs
+    prefetch_index() before it starts (the others wait for it), and adds its
+    Result to the job's stages.  Runs in which nothing is mapped, such as
+    those with everything up to date or with cache hits, don't read the
+    index at all.
+    """
+    @functools.wraps(func)
+    def wrapper(infiles, outfiles, config):
+        prefetched = None
+        with prefetch_pending.get_lock():
+            if prefetch_pending.value:
+                prefetched = prefetch_index(config)
+                prefetch_pending.value = 0
+        result = func(infiles, outfiles, config)
+        if prefetched is not None:
+            result.stages = [prefetched] + list(result.stages or [])
+        return result
+    return wrapper
+
+
+def bowtie_times(logfn):
+    """
+    Parses the timings that bowtie -t writes to `logfn`, summed over all of
+    the runs in it (e.g., chunks).  Returns a dictionary with the seconds
+    spent loading the index and searching, or an empty one if there are no
+    timings.
+    """
+    times = {}
+    try:
+        lines = open(logfn).readlines()
+    except IOError:
+        return times
+    for line in lines:
+        if ':' not in line:
+            continue
+        label, value = line.split(':', 1)
+        try:
+            h, m, sec = [int(x) for x in value.strip().split(':')]
+        except ValueError:
+            continue
+        seconds = 3600 * h + 60 * m + sec
+        if label.startswith('Time loading'):
+            key = 'index load time'
+        elif label == 'Time searching':
+            key = 'search time'
+        else:
+            continue
+        times[key] = times.get(key, 0) + seconds
+    return times
+
+
+def htseq_cmds(samfile, config):
+    """
+    Builds the htseq-count command line for counting `samfile` (which can be
+    '-' for stdin).  Adds "-f bam" if `samfile` is a BAM file and no format
+    was given in config['htseq params'].
+    """
+    cmds = ['htseq-count']
+    params = config['htseq params'].split()
+    cmds += params
+    if samfile != '-' and is_gzipped(samfile) and not any(
+            p in ('-f', '--format') or p.startswith(('-f=', '--format='))
+            for p in params):
+        cmds += ['-f', 'bam']
+    cmds += [samfile,
+            config['gff']]
+    return cmds
+
+
+def decompress_cmds(fastq):
+    """
+    If `fastq` is compressed, returns a list containing the command that
+    decompresses it to stdout, and '-' as the filename for the next command
+    to read from.  Otherwise returns an empty list and `fastq`.
+    """
+    if is_gzipped(fastq):
+        return [['gzip', '-dc', fastq]], '-'
+    return [], fastq
+
+
+def samtools_bam_cmds(config):
+    """
+    Command that converts SAM on stdin to BAM on stdout, using
+    config['samtools threads'] compression threads if set.
+    """
+    cmds = ['samtools', 'view', '-S', '-b']
+    if config.get('samtools threads'):
+        cmds += ['-@', str(config['samtools threads'])]
+    cmds.append('-')
+    return cmds
+
+
+def _run_piped(cmd_lists, stdout, stderr):
+    """
+    Runs the commands in `cmd_lists`, each one's stdout piped into the next
+    one's stdin.  The last one writes to the file `stdout`, and all of them
+    write to the file `stderr`, or to their own file if `stderr` is a list
+    with one per command.  Returns the command line and the first non-zero
+    return code (or 0).
+    """
+    if not isinstance(stderr, list):
+        stderr = [stderr] * len(cmd_lists)
+    procs = []
+    upstream = None
+    for i, cmds in enumerate(cmd_lists):
+        if i == len(cmd_lists) - 1:
+            out = stdout
+        else:
+            out = subprocess.PIPE
+        p = popen(cmds, stdin=upstream, stdout=out, stderr=stderr[i])
+        if upstream is not None:
+            upstream.close()
+        upstream = p.stdout
+        procs.append(p)
+    returncode = 0
+    for p in procs:
+        wait(p)
+        returncode = returncode or p.returncode
+    return ' | '.join(' '.join(cmds) for cmds in cmd_lists), returncode
+
+
+def _run(cmds, stdout):
+    """
+    Runs `cmds` with stdout going to the file `stdout`.  stderr is spooled
+    to a temporary file rather than kept in memory.  Returns the return
+    code and the end of stderr.
+    """
+    errfile = tempfile.TemporaryFile()
+    p = popen(cmds, stdout=stdout, stderr=errfile)
+    wait(p)
+    stderr = read_tail(errfile)
+    errfile.close()
+    return p.returncode, stderr
+
+
+def reads_in_log(fn, prefix):
+    """
+    Number of reads reported in the log or report `fn` on lines starting
+    with `prefix` (e.g., "# reads processed:"), summed over all such lines.
+    Returns None if there are none.
+    """
+    total = None
+    try:
+        for line in open(fn):
+            if line.startswith(prefix):
+                total = (total or 0) + int(line[len(prefix):].split()[0])
+    except (IOError, ValueError, IndexError):
+        return None
+    return total
+
+
+def reads_in_counts(countfile):
+    """
+    Number of reads in the htseq-count-style `countfile`, including the
+    special counters.
+    """
+    total = 0
+    for line in open(countfile):
+        total += int(line.rsplit('\t', 1)[1])
+    return total
+
+
+def qc_file(fn):
+    """
+    QC summary written alongside `fn` when config['qc stats'] is set; see
+    qc.py.
+    """
+    return fn + '.qc.json'
+
+
+def fastx_adapter_qc(clipping_report, read_summary):
+    """
+    Estimates how many reads fastx_clipper found the adapter in, from its
+    `clipping_report` and the qc.py summary of the reads it kept.  Kept
+    reads count if they are shorter than the longest one, so this assumes
+    the reads all had the same length before clipping.
+    """
+    import qc
+    discarded = 0
+    for line in open(clipping_report):
+        if line.startswith('discarded') and (
+                'too-short' in line or 'adapter-only' in line):
+            discarded += int(line.split()[1])
+    return qc.adapter_summary(
+            reads_in_log(clipping_report, 'Input:') or 0,
+            discarded + qc.shorter_than_longest(read_summary),
+            estimated=True)
+
+
+def _run_bowtie(fastq, outfile, logfn, config, qcfile=None, read_qc=False):
+    """
+    Maps `fastq` (which may be compressed) to `outfile` with stderr in
+    `logfn`, using as many threads as are granted from the core budget.
+    The output is BAM if config['bam intermediates'] is set, SAM otherwise.
+    Returns the command line and the return code.
+
+    If `qcfile` is given, the alignments are teed through qc.py on their way
+    out of bowtie and the mapping statistics are written to it, plus those
+    of the reads on their way in if `read_qc` is set.
+    """
+    import qc
+    pre, reads = decompress_cmds(fastq)
+    post = []
+    parts = {}
+    if qcfile:
+        parts['mapping'] = qcfile + '.mapping'
+        post.append(qc.tee_cmds('sam', parts['mapping']))
+        if read_qc:
+            parts['reads'] = qcfile + '.reads'
+            pre.append(qc.tee_cmds(
+                'fastq', parts['reads'], None if reads == '-' else reads))
+            reads = '-'
+    if config.get('bam intermediates'):
+        post.append(samtools_bam_cmds(config))
+    with cores(bowtie_threads(config), bowtie_max_threads(config),
+               memory=bowtie_memory(config)) as n:
+        cmds = pre + [bowtie_cmds(reads, config, threads=n)] + post
+        cmds, returncode = _run_piped(
+                cmds, open(outfile, 'w'), open(logfn, 'w'))
+    if parts and not returncode:
+        qc.collect(qcfile, parts)
+    return cmds, returncode
+
+
+@timeit
+@cached(keys=['bowtie params', 'bam intermediates', 'qc stats', 'adapter'],
+        files=['index'], tools=['bowtie', 'samtools', 'qc.py'])
+@prefetches_index
+def bowtie(fastq, outfile, config):
+    """
+    Use bowtie to map `fastq`, saving the SAM file as `outfile`.  Ensures that
+    '--sam' is in the parameters.  `fastq` may be gzip-compressed, and if
+    config['bam intermediates'] is set `outfile` is a BAM file instead.
+
+    If config['map chunk reads'] is set, `fastq` is mapped in chunks of that
+    many reads instead; see _bowtie_scatter().
+
+    If config['qc stats'] is set, mapping statistics are written to
+    qc_file(`outfile`), along with those of the reads if there was no
+    adapter to clip (so clip() didn't collect them).
+    """
+    if config.get('map chunk reads'):
+        return _bowtie_scatter(fastq, outfile, config)
     print outfile
     logfn = outfile + '.log'
-    p = subprocess.Popen(
-            cmds, stdout=open(outfile, 'w'), stderr=open(logfn, 'w'),
-            bufsize=1)
-    stdout, stderr = p.communicate()
+    outfiles = outfile
+    qcfile = None
+    if config.get('qc stats'):
+        qcfile = qc_file(outfile)
+        outfiles = (outfile, qcfile)
+    cmds, returncode = _run_bowtie(
+            fastq, outfile, logfn, config, qcfile,
+            read_qc=config['adapter'] is None)
+    stats = {'reads': reads_in_log(logfn, '# reads processed:')}
+    stats.update(bowtie_times(logfn))
+    if qcfile and not returncode:
+        stats.update(_qc_stats(qcfile))
+    return Result(
+            infiles=fastq, outfiles=outfiles, cmds=cmds, log=logfn,
+            failed=returncode, stats=stats)
+
+
+def _qc_stats(qcfile):
+    """
+    The rates in the QC summary `qcfile`, for the report.
+    """
+    import qc
+    summary = qc.read_summary(qcfile)
+    stats = {}
+    if 'mapping' in summary:
+        stats['mapping rate'] = summary['mapping']['mapping rate']
+    if 'adapter' in summary:
+        stats['adapter rate'] = summary['adapter']['adapter rate']
+    return stats
+
+
+def map_batches(config, map_suffix):
+    """
+    Groups the samples in `config` into batches of about config['map batch
+    reads'] reads, based on the estimated number of reads in each FASTQ.
+    Yields (clipped FASTQs, SAM files) for each batch, where the SAM files
+    are named with `map_suffix` like the ones map() makes for each sample.
+    """
+    import scatter
+    target = config['map batch reads']
+    clipped, sams = [], []
+    total = 0
+    for fastq, clipped_fastq in fastq_to_other_files(config, '.clipped'):
+        reads = scatter.estimate_reads(fastq)
+        if clipped and total + reads > target:
+            yield clipped, sams
+            clipped, sams = [], []
+            total = 0
+        clipped.append(clipped_fastq)
+        sams.append(clipped_fastq[:-len('.clipped')] + map_suffix)
+        total += reads
+    if clipped:
+        yield clipped, sams
+
+
+@timeit
+@prefetches_index
+def bowtie_batch(fastqs, outfiles, config):
+    """
+    Maps the reads of several samples with one bowtie run, so that the index
+    is only loaded once.  Reads from `fastqs` are tagged with their sample
+    as they are fed to bowtie, and the alignments are split up again into
+    `outfiles` (one per sample, BAM if config['bam intermediates'] is set).
+
+    Each output gets a log with the batch's bowtie output and the number of
+    reads from that sample, and with config['qc stats'], a QC summary of its
+    alignments, plus one of its reads if there was no adapter to clip, as
+    bowtie() does.
+    """
+    import scatter
+    import qc
+    mapping = None
+    read_stats = None
+    if config.get('qc stats'):
+        mapping = [qc.MappingStats() for outfile in outfiles]
+        if config['adapter'] is None:
+            read_stats = [qc.ReadStats() for outfile in outfiles]
+    errfile = tempfile.TemporaryFile()
+    procs = []
+    outs = []
+    for outfile in outfiles:
+        fout = open(outfile, 'w')
+        if config.get('bam intermediates'):
+            p = popen(
+                    samtools_bam_cmds(config), stdin=subprocess.PIPE,
+                    stdout=fout)
+            procs.append(p)
+            outs.append(p.stdin)
+            fout.close()
+        else:
+            outs.append(fout)
+
+    with cores(bowtie_threads(config), bowtie_max_threads(config),
+               memory=bowtie_memory(config)) as n:
+        cmds = bowtie_cmds('-', config, threads=n)
+        p = popen(
+                cmds, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=errfile)
+        errors = []
+
+        def feed():
+            try:
+                scatter.tag_reads(fastqs, p.stdin, read_stats)
+            except Exception as e:
+                # e.g., bowtie exited early
+                errors.append('%s: %s' % (type(e).__name__, e))
+            finally:
+                p.stdin.close()
+
+        t = task_thread(feed)
+        t.start()
+        counts = scatter.demux_sam(p.stdout, outs, mapping)
+        t.join()
+        wait(p)
+
+    for out in outs:
+        out.close()
+    failed = p.returncode or bool(errors)
+    for proc in procs:
+        wait(proc)
+        failed = failed or proc.returncode
+
+    stderr = read_tail(errfile)
+    errfile.seek(0)
+    bowtie_log = errfile.read()
+    errfile.close()
+    for outfile, fastq, count in zip(outfiles, fastqs, counts):
+        fout = open(outfile + '.log', 'w')
+        fout.write('# mapped in one batch with %d samples: %s\n' % (
+            len(fastqs), ' '.join(fastqs)))
+        fout.write('# alignments for this sample: %d\n' % count)
+        fout.write(bowtie_log)
+        fout.close()
+    if mapping and not failed:
+        for i, outfile in enumerate(outfiles):
+            summary = {'mapping': mapping[i].summary()}
+            if read_stats:
+                summary['reads'] = read_stats[i].summary()
+            qc.write_summary(qc_file(outfile), summary)
+
+    stats = {'samples': len(fastqs), 'reads': sum(counts)}
+    stats.update(bowtie_times(outfiles[0] + '.log'))
+    return Result(
+            fastqs, outfiles, cmds='tag reads | %s | demultiplex' % (
+                ' '.join(cmds)),
+            stderr='\n'.join([stderr] + errors), failed=failed, stats=stats)
+
+
+# Config values that change how _bowtie_scatter() maps each chunk
+CHUNK_MAP_KEYS = ['index', 'bowtie params', 'qc stats', 'adapter']
+
+
+def _bowtie_scatter(fastq, outfile, config):
+    """
+    Splits `fastq` into chunks of config['map chunk reads'] reads, maps up to
+    config['map chunk jobs'] (default 2) of them at once, and merges the
+    SAM files in order into `outfile`.
+
+    A chunk that fails is retried on its own, up to config['map chunk
+    retries'] (default 2) times.  The chunks are kept until they have all
+    been merged, so if the task is run again after a failure, chunks that
+    were already mapped are not mapped again, unless the FASTQ or the
+    CHUNK_MAP_KEYS settings have changed since.
+
+    With config['qc stats'], the mapping statistics of the chunks are
+    summed into qc_file(`outfile`), along with the statistics of the reads,
+    collected while splitting, if there was no adapter to clip.
+    """
+    import scatter
+    import qc
+    chunk_dir = outfile + '.chunks'
+    logfn = outfile + '.log'
+    qcfile = None
+    if config.get('qc stats'):
+        qcfile = qc_file(outfile)
+    # Chunks mapped by an earlier run are only reused if they were mapped
+    # the same way
+    settings = json.dumps(
+            dict((key, config.get(key)) for key in CHUNK_MAP_KEYS),
+            sort_keys=True)
+    read_qc = bool(qcfile) and config['adapter'] is None
+    chunks = scatter.split_fastq(
+            fastq, chunk_dir, config['map chunk reads'], settings, read_qc)
+    # chunks are always mapped to SAM; the merged file is converted if needed
+    chunk_config = dict(config)
+    chunk_config['bam intermediates'] = False
+    retries = config.get('map chunk retries', 2)
+    todo = Queue.Queue()
+    for i in range(len(chunks)):
+        todo.put(i)
+    stages = [None] * len(chunks)
+
+    def worker():
+        while True:
+            try:
+                i = todo.get_nowait()
+            except Queue.Empty:
+                return
+            chunk = chunks[i]
+            sam = chunk + '.sam'
+            if os.path.exists(sam + '.done') and not (
+                    qcfile and not os.path.exists(qc_file(sam))):
+                stages[i] = Result(
+                        chunk, sam, desc='chunk %d (already mapped)' % i)
+                continue
+            t0 = time.time()
+            try:
+                for attempt in range(retries + 1):
+                    cmds, returncode = _run_bowtie(
+                            chunk, sam, sam + '.log', chunk_config,
+                            qcfile and qc_file(sam))
+                    if not returncode:
+                        open(sam + '.done', 'w').close()
+                        break
+                res = Result(
+                        chunk, sam, log=sam + '.log', desc='chunk %d' % i,
+                        failed=returncode, cmds=cmds,
+                        stats={'attempts': attempt + 1})
+            except Exception as e:
+                # Reported along with any other failed chunks
+                res = Result(
+                        chunk, sam, desc='chunk %d' % i, failed=True,
+                        stderr='%s: %s' % (type(e).__name__, e))
+            res.elapsed = time.time() - t0
+            stages[i] = res
+
+    threads = []
+    for j in range(min(config.get('map chunk jobs', 2), len(chunks))):
+        t = task_thread(worker)
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+
+    failed = any(res.failed for res in stages)
+    stderr = None
+    if failed:
+        errors = []
+        for res in stages:
+            if res.stderr:
+                errors.append('%s:\n%s' % (res.desc, res.stderr))
+            elif res.failed:
+                errors.append('%s:\n%s' % (res.log, open(res.log).read()))
+        stderr = '\n'.join(errors)
+    else:
+        bam_cmds = None
+        if config.get('bam intermediates'):
+            bam_cmds = samtools_bam_cmds(config)
+        scatter.merge_sam(
+                [res.outfiles[0] for res in stages], outfile, bam_cmds)
+        fout = open(logfn, 'w')
+        for i, chunk in enumerate(chunks):
+            fout.write('# chunk %d\n' % i)
+            fout.write(open(chunk + '.sam.log').read())
+        fout.close()
+        if qcfile:
+            mapping = qc.MappingStats()
+            for chunk in chunks:
+                mapping.merge(qc.MappingStats.from_summary(
+                    qc.read_summary(qc_file(chunk + '.sam'))['mapping']))
+            summary = {'mapping': mapping.summary()}
+            if read_qc:
+                summary['reads'] = qc.read_summary(
+                        scatter.reads_qc_file(chunk_dir))
+            qc.write_summary(qcfile, summary)
+        shutil.rmtree(chunk_dir)
+
+    stats = {
+        'reads': reads_in_log(logfn, '# reads processed:'),
+        'chunks': len(chunks),
+        'chunk retries': sum(
+            res.stats.get('attempts', 1) - 1 for res in stages),
+    }
+    outfiles = outfile
+    if not failed:
+        stats.update(bowtie_times(logfn))
+        if qcfile:
+            stats.update(_qc_stats(qcfile))
+            outfiles = (outfile, qcfile)
     return Result(
-            infiles=fastq, outfiles=outfile, cmds=' '.join(cmds), log=logfn)
+            fastq, outfiles, log=logfn, failed=failed, stderr=stderr,
+            cmds='\n'.join(res.cmds for res in stages if res.cmds),
+            stages=stages, stats=stats)
 
 
 @timeit
+@cached(keys=['htseq params', 'count engine'], files=['gff'],
+        tools=['htseq-count', 'counting.py'])
 def count(samfile, countfile, config):
-    cmds = ['htseq-count']
-    cmds += config['htseq params'].split()
-    cmds += [samfile,
-            config['gff']]
-    p = subprocess.Popen(
-            cmds, stdout=open(countfile, 'w'),
-            stderr=subprocess.PIPE, bufsize=1)
-    stdout, stderr = p.communicate()
-    failed = p.returncode
+    """
+    Counts reads in `samfile` per feature in config['gff'], saving the counts
+    as `countfile`.  Uses htseq-count unless config['count engine'] is
+    'inprocess', in which case counting.py does the work without starting
+    a new process or re-parsing the GFF for every sample, or 'regions', in
+    which case config['count processes'] processes count different regions
+    of the genome at once.
+    """
+    engine = config.get('count engine', 'htseq-count')
+    if engine == 'inprocess':
+        return _count_inprocess(samfile, countfile, config)
+    if engine == 'regions':
+        return _count_regions(samfile, countfile, config)
+    cmds = htseq_cmds(samfile, config)
+    with cores(1):
+        failed, stderr = _run(cmds, open(countfile, 'w'))
+    stats = {}
+    if not failed:
+        stats['reads'] = reads_in_counts(countfile)
     return Result(
             infiles=samfile,
             outfiles=countfile,
             stderr=stderr,
             failed=failed,
-            cmds=' '.join(cmds))
+            cmds=' '.join(cmds),
+            stats=stats)
+
+
+def _count_inprocess(samfile, countfile, config):
+    import counting
+    cmds = 'counting.count(%s, %s) [gff=%s, htseq params=%s]' % (
+            samfile, countfile, config['gff'], config['htseq params'])
+    try:
+        with cores(1):
+            counts = counting.count(samfile, countfile, config)
+    except Exception as e:
+        return Result(
+                samfile, countfile, stderr='%s: %s' % (type(e).__name__, e),
+                failed=True, cmds=cmds)
+    return Result(
+            samfile, countfile, cmds=cmds,
+            stats={'reads': sum(counts.values())})
+
+
+@timeit
+def count_matrix(countfiles, outfile, config):
+    """
+    Adds the samples in `countfiles` that are new or have changed to the
+    count matrix in config['count matrix'] (see matrix.py), whose sample
+    list is `outfile`.  `countfiles` may include other files, which are
+    ignored.
+    """
+    import matrix
+    flat = []
+    for fn in countfiles:
+        if isinstance(fn, basestring):
+            flat.append(fn)
+        else:
+            flat.extend(fn)
+    countfiles = [fn for fn in flat if fn.endswith('.count')]
+    store = matrix.CountMatrix(config['count matrix'])
+    cmds = 'matrix.CountMatrix(%s).add(<%d count files>)' % (
+            config['count matrix'], len(countfiles))
+    try:
+        changed = store.add(countfiles)
+    except ValueError as e:
+        return Result(countfiles, outfile, stderr=str(e), failed=True,
+                      cmds=cmds)
+    # Let ruffus see the matrix as up to date even if nothing changed
+    if os.path.exists(outfile):
+        os.utime(outfile, None)
+    return Result(
+            countfiles, outfile, cmds=cmds,
+            stats={'samples added or updated': len(changed),
+                   'samples': len(store.samples),
+                   'genes': len(store.genes)})
+
+
+def is_indexed_bam(samfile):
+    """
+    Whether `samfile` is a position-sorted BAM file with a ".bai" index.
+    """
+    if not is_gzipped(samfile) or not os.path.exists(samfile + '.bai'):
+        return False
+    import pysam
+    sf = pysam.AlignmentFile(samfile, 'rb')
+    sort_order = sf.header.to_dict().get('HD', {}).get('SO')
+    sf.close()
+    return sort_order == 'coordinate'
+
+
+def _count_regions(samfile, countfile, config):
+    import pysam
+    import counting
+    params = counting.parse_htseq_params(config['htseq params'])
+    processes = int(config.get('count processes', 4))
+    temporary = []
+    temporary_dirs = []
+    cmds = []
+    stats = {}
+    try:
+        with cores(processes) as granted:
+            # Sort and index a copy unless the input already is
+            bam = samfile
+            if not is_indexed_bam(samfile):
+                bam = countfile + '.sorted.bam'
+                temporary += [bam, bam + '.bai']
+                for step in (
+                        ['samtools', 'sort', '-@', str(granted), '-o', bam,
+                         samfile],
+                        ['samtools', 'index', bam]):
+                    cmds.append(' '.join(step))
+                    failed, stderr = _run(step, None)
+                    if failed:
+                        return Result(
+                                samfile, countfile, stderr=stderr,
+                                failed=failed, cmds='; '.join(cmds))
+
+            sf = pysam.AlignmentFile(bam, 'rb')
+            chrom_lengths = zip(sf.references, sf.lengths)
+            unplaced = sf.nocoordinate
+            sf.close()
+            regions = counting.balanced_regions(
+                    counting.feature_starts(config['gff'], params),
+                    chrom_lengths, granted * counting.REGIONS_PER_PROCESS)
+
+            # The GFF is parsed here, once, and compiled for the workers to
+            # memory-map
+            index_dir = tempfile.mkdtemp(
+                    dir=os.path.dirname(os.path.abspath(countfile)),
+                    prefix='.features-')
+            temporary_dirs.append(index_dir)
+            index_dir = counting.compile_config_index(config, index_dir)
+
+            # Deal the regions out to the workers, and add up their counts
+            procs = []
+            for i in range(min(granted, len(regions))):
+                worker_cmds = counting.region_worker_cmds(
+                        bam, regions[i::granted], config, index_dir)
+                outfile = tempfile.TemporaryFile()
+                errfile = tempfile.TemporaryFile()
+                p = popen(worker_cmds, stdout=outfile, stderr=errfile)
+                procs.append((p, outfile, errfile))
+            cmds.append('%d x counting.py regions %s <%d regions>' % (
+                len(procs), bam, len(regions)))
+            counts = {}
+            failed = 0
+            stderr = []
+            for p, outfile, errfile in procs:
+                wait(p)
+                if p.returncode:
+                    failed = p.returncode
+                    stderr.append(read_tail(errfile))
+                else:
+                    outfile.seek(0)
+                    counting.add_counts(counts, json.load(outfile))
+                outfile.close()
+                errfile.close()
+            if failed:
+                return Result(
+                        samfile, countfile, stderr='\n'.join(stderr),
+                        failed=failed, cmds='; '.join(cmds))
+
+        # Reads with no position aren't in any region
+        counts['__not_aligned'] += unplaced
+        counting.write_counts(counts, countfile)
+        stats = {
+            'reads': sum(counts.values()),
+            'count processes': len(procs),
+            'regions': len(regions),
+        }
+    except Exception as e:
+        return Result(
+                samfile, countfile, stderr='%s: %s' % (type(e).__name__, e),
+                failed=True, cmds='; '.join(cmds))
+    finally:
+        for fn in temporary:
+            if os.path.exists(fn):
+                os.unlink(fn)
+        for d in temporary_dirs:
+            shutil.rmtree(d, ignore_errors=True)
+    return Result(samfile, countfile, cmds='; '.join(cmds), stats=stats)
 
 
 @timeit
+@cached(keys=['adapter', 'clipper', 'clipper min overlap',
+              'compress intermediates', 'qc stats'],
+        tools=['fastx_clipper', 'clipper.py', 'qc.py'],
+        skip_if=lambda config: config['adapter'] is None)
 def clip(fastq, clipped_fastq, config):
+    """
+    Clips config['adapter'] from the reads in `fastq`, writing them to
+    `clipped_fastq` and a report to `clipped_fastq`.clipping_report.
+
+    If config['qc stats'] is set, statistics of the clipped reads and how
+    many had the adapter are written to qc_file(`clipped_fastq`) in the same
+    pass.
+    """
     adapter = config['adapter']
     clipping_report = clipped_fastq + '.clipping_report'
     if adapter is None:
-        fout = open(clipped_fastq, 'w')
-        fout.write(open(fastq).read())
-        fout.close()
+        # Nothing to clip, so avoid reading and re-writing the whole file
+        method = link_or_copy(fastq, clipped_fastq)
+        if method == 'hard link':
+            # Same file, so the same index (if any) still applies
+            import fastqindex
+            if fastqindex.current_index(fastq) is not None:
+                link_or_copy(fastqindex.index_file(fastq),
+                             fastqindex.index_file(clipped_fastq),
+                             hard_link=False)
 
         fout = open(clipping_report, 'w')
         fout.write(
-                'No adapter specified; %s is a copy of %s' % (
-                    clipped_fastq, fastq))
+                'No adapter specified; %s is a %s of %s' % (
+                    clipped_fastq, method, fastq))
         fout.close()
         return Result(
-                fastq, (clipped_fastq, clipping_report))
-
-    cmds = ['fastx_clipper',
-            '-i', fastq,
-            '-o', clipped_fastq,
-            '-n',  # *keep* Ns
-            '-a', adapter,
-            '-v',  # report to stdout
-            ]
-    p = subprocess.Popen(
-            cmds, stdout=open(clipping_report, 'w'), stderr=subprocess.PIPE,
-            bufsize=1)
-    stdout, stderr = p.communicate()
+                fastq, (clipped_fastq, clipping_report),
+                cmds='link_or_copy(%s, %s) [%s]' % (
+                    fastq, clipped_fastq, method))
+
+    # The clipped FASTQ may be a hard link to `fastq` from a run with no
+    # adapter, so it is replaced rather than written through
+    import fastqindex
+    for fn in (clipped_fastq, fastqindex.index_file(clipped_fastq)):
+        unlink_output(fn)
+
+    if config.get('clipper', 'fastx_clipper') == 'builtin':
+        return _clip_builtin(fastq, clipped_fastq, clipping_report, config)
+
+    # fastx_clipper can't read compressed files, but can read from stdin
+    pre, reads = decompress_cmds(fastq)
+    cmds = ['fastx_clipper']
+    if reads != '-':
+        cmds += ['-i', fastq]
+    errfile = tempfile.TemporaryFile()
+    qcfile = None
+    if config.get('qc stats'):
+        # With no -o, fastx_clipper writes reads to stdout and the -v report
+        # to stderr, so the reads can be teed through qc.py on their way to
+        # the file.
+        import qc
+        qcfile = qc_file(clipped_fastq)
+        cmds += ['-n',  # *keep* Ns
+                 '-a', adapter,
+                 '-v',
+                 ]
+        cmd_lists = pre + [cmds, qc.tee_cmds('fastq', qcfile)]
+        if config.get('compress intermediates'):
+            cmd_lists.append(['gzip', '-c', '-1'])
+        stdout = open(clipped_fastq, 'w')
+        stderr = [errfile] * len(cmd_lists)
+        stderr[len(pre)] = open(clipping_report, 'w')
+    else:
+        cmds += ['-o', clipped_fastq,
+                 '-n',  # *keep* Ns
+                 '-a', adapter,
+                 '-v',  # report to stdout
+                 ]
+        if config.get('compress intermediates'):
+            cmds.append('-z')
+        cmd_lists = pre + [cmds]
+        stdout = open(clipping_report, 'w')
+        stderr = errfile
+    with cores(1):
+        cmds, returncode = _run_piped(cmd_lists, stdout, stderr)
+    stderr = read_tail(errfile)
+    errfile.close()
     failed = False
-    if p.returncode or not os.path.exists(clipped_fastq):
+    if returncode or not os.path.exists(clipped_fastq):
         failed = True
+        if qcfile:
+            # fastx_clipper's stderr, with any errors, went to the report
+            stderr = read_tail(open(clipping_report)) + stderr
 
+    outfiles = (clipped_fastq, clipping_report)
+    stats = {'reads': reads_in_log(clipping_report, 'Input:')}
+    if qcfile and not failed:
+        read_summary = qc.read_summary(qcfile)
+        qc.write_summary(qcfile, {
+            'reads': read_summary,
+            'adapter': fastx_adapter_qc(clipping_report, read_summary)})
+        outfiles += (qcfile,)
+        stats.update(_qc_stats(qcfile))
     return Result(
-            fastq, (clipped_fastq, clipping_report), stdout=stdout,
-            stderr=stderr, failed=failed, cmds=' '.join(cmds))
+            fastq, outfiles, stderr=stderr, failed=failed, cmds=cmds,
+            stats=stats)
+
+
+def _clip_reads(fastq, clipped_fastq, clipping_report, adapter, read_stats,
+                kwargs, processes):
+    """
+    clipper.clip(), returning its counts and `read_stats` with the clipped
+    reads added, so that it can be called in another process.
+    """
+    import clipper
+    totals = clipper.clip(
+            fastq, clipped_fastq, clipping_report, adapter,
+            processes=processes, read_stats=read_stats, **kwargs)
+    return totals, read_stats
+
+
+def _clip_builtin(fastq, clipped_fastq, clipping_report, config):
+    import clipper
+    import qc
+    read_stats = None
+    if config.get('qc stats'):
+        read_stats = qc.ReadStats()
+    kwargs = dict(
+            min_overlap=config.get('clipper min overlap'),
+            batch_size=config.get('clipper batch size', 100000),
+            compress=bool(config.get('compress intermediates')))
+    processes = config.get('clipper processes', 1)
+    cmds = 'clipper.clip(%s, %s, %s, %s, %s, processes=%s)' % (
+            fastq, clipped_fastq, clipping_report, config['adapter'],
+            ', '.join('%s=%s' % i for i in sorted(kwargs.items())),
+            processes)
+    try:
+        totals, read_stats = pooled_call(
+                processes, _clip_reads, fastq, clipped_fastq,
+                clipping_report, config['adapter'], read_stats, kwargs)
+    except Exception as e:
+        return Result(
+                fastq, (clipped_fastq, clipping_report),
+                stderr='%s: %s' % (type(e).__name__, e), failed=True,
+                cmds=cmds)
+    outfiles = (clipped_fastq, clipping_report)
+    stats = {'reads': totals['input']}
+    if read_stats is not None:
+        qcfile = qc_file(clipped_fastq)
+        qc.write_summary(qcfile, {
+            'reads': read_stats.summary(),
+            'adapter': qc.adapter_summary(totals['input'], totals['clipped'])})
+        outfiles += (qcfile,)
+        stats.update(_qc_stats(qcfile))
+    return Result(fastq, outfiles, cmds=cmds, stats=stats)
 
 
 def sam2bam(sam, bam):
@@ -124,43 +1116,274 @@ def sam2bam(sam, bam):
             'view',
             '-S', '-b',
             sam]
-    p = subprocess.Popen(
-            cmds, stdout=open(bam, 'w'), stderr=subprocess.PIPE, bufsize=1)
-    stdout, stderr = p.communicate()
-    return Result(sam, bam, stderr=stderr, cmds=' '.join(cmds))
+    returncode, stderr = _run(cmds, open(bam, 'w'))
+    return Result(
+            sam, bam, stderr=stderr, failed=returncode, cmds=' '.join(cmds))
 
 
 def bam2sam(bam, sam):
     cmds = ['samtools',
             'view', '-h',
             bam]
-    p = subprocess.Popen(
-            cmds, stdout=open(sam, 'w'), stderr=subprocess.PIPE, bufsize=1)
-    stdout, stderr = p.communicate()
-    return Result(sam, bam, stderr=stderr, cmds=' '.join(cmds))
+    returncode, stderr = _run(cmds, open(sam, 'w'))
+    return Result(
+            sam, bam, stderr=stderr, failed=returncode, cmds=' '.join(cmds))
 
 
 @timeit
+@cached(keys=['filter engine', 'bam intermediates'], files=['filter bed'],
+        tools=['samtools', 'intersectBed', 'filtering.py'])
 def filter(sam, outfile, config):
-    bam = tempfile.mktemp()
-    filtered_bam = tempfile.mktemp()
+    """
+    Removes reads in `sam` that overlap config['filter bed'], saving the rest
+    as `outfile`.  Uses samtools and intersectBed unless config['filter
+    engine'] is 'builtin', in which case filtering.py does it in one pass.
+    """
+    if config.get('filter engine', 'bedtools') == 'builtin':
+        return _filter_builtin(sam, outfile, config)
 
-    result0 = sam2bam(sam, bam)
+    # BAM input can go straight to intersectBed, and BAM output can be
+    # kept as is.
+    bam_in = is_gzipped(sam)
+    bam_out = config.get('bam intermediates')
+    if bam_in:
+        bam = sam
+    else:
+        bam = tempfile.mktemp()
+    if bam_out:
+        filtered_bam = outfile
+    else:
+        filtered_bam = tempfile.mktemp()
 
     cmds1 = ['intersectBed',
             '-abam', bam,
             '-b', config['filter bed'],
             '-v']
 
-    p = subprocess.Popen(
-            cmds1, stdout=open(filtered_bam, 'w'),
-            stderr=subprocess.PIPE, bufsize=1)
-    stdout1, stderr1 = p.communicate()
-    result2 = bam2sam(filtered_bam, outfile)
+    results = []
+    with cores(1):
+        if not bam_in:
+            results.append(sam2bam(sam, bam))
+        returncode, stderr1 = _run(cmds1, open(filtered_bam, 'w'))
+        results.append(Result(bam, filtered_bam, stderr=stderr1,
+                              failed=returncode, cmds=' '.join(cmds1)))
+        if not bam_out:
+            results.append(bam2sam(filtered_bam, outfile))
     #os.unlink(bam)
     #os.unlink(filtered_bam)
-    failed = p.returncode
-    cmds = '\n'.join([result0.cmds, ' '.join(cmds1), result2.cmds])
-    stderr = '\n'.join([result0.stderr, stderr1, result2.stderr])
+    failed = any(res.failed for res in results)
+    cmds = '\n'.join([res.cmds for res in results])
+    stderr = '\n'.join([res.stderr for res in results])
     return Result(
             sam, outfile, failed=failed, cmds=cmds, stderr=stderr)
+
+
+def _wait_for_stages(procs):
+    """
+    Waits for all processes in `procs` and returns the time at which each one
+    finished and its resource usage, in the same order.
+    """
+    finished = [None] * len(procs)
+    usages = [None] * len(procs)
+
+    def waiter(i, p):
+        usages[i] = wait(p)
+        finished[i] = time.time()
+
+    threads = []
+    for i, p in enumerate(procs):
+        t = task_thread(waiter, args=(i, p))
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    return finished, usages
+
+
+@timeit
+@prefetches_index
+def stream(fastq, outfiles, config):
+    """
+    Runs clip, bowtie, filter (if configured) and count on `fastq` with all
+    the stages connected by pipes, so they run concurrently and none of the
+    intermediate FASTQ or SAM files are written to disk.
+
+    `outfiles` is a list of (countfile, clipping_report, bowtie_log).  Each
+    stage is reported separately in the `stages` of the returned Result.
+
+    With config['qc stats'], the reads and alignments are teed through
+    qc.py between stages, and the summaries are written to the same files
+    as clip() and bowtie() write them to.
+    """
+    # bowtie gets all but one of the reserved cores; the other stages share
+    # the remaining one.  The request is clamped to the budget, so with
+    # --cores 1 bowtie still gets one thread.
+    with cores(bowtie_threads(config) + 1,
+               bowtie_max_threads(config) + 1,
+               memory=bowtie_memory(config)) as n:
+        return _stream(fastq, outfiles, config, threads=max(1, n - 1))
+
+
+def _stream(fastq, outfiles, config, threads):
+    countfile, clipping_report, logfn = outfiles
+
+    # Each item is (desc, cmds, stdout, stderr).  A stdout of None means the
+    # stage's output is piped into the next stage; a stderr of None means it
+    # is captured for the report.
+    stages = []
+    pre, reads = decompress_cmds(fastq)
+    for cmds in pre:
+        stages.append(('decompress', cmds, None, None))
+    adapter = config['adapter']
+    clip_qcfile = qc_file(clipping_report[:-len('.clipping_report')])
+    map_qcfile = qc_file(logfn[:-len('.log')])
+    parts = {}
+    if config.get('qc stats'):
+        import qc
+        parts['reads'] = clip_qcfile + '.reads'
+        parts['mapping'] = map_qcfile + '.mapping'
+    if adapter is None:
+        fout = open(clipping_report, 'w')
+        fout.write(
+                'No adapter specified; reads streamed directly from %s'
+                % fastq)
+        fout.close()
+    else:
+        # With no -o, fastx_clipper writes reads to stdout and the -v report
+        # to stderr.
+        cmds = ['fastx_clipper']
+        if reads != '-':
+            cmds += ['-i', fastq]
+        cmds += ['-n',  # *keep* Ns
+                 '-a', adapter,
+                 '-v',
+                 ]
+        stages.append(('clip', cmds, None, open(clipping_report, 'w')))
+        reads = '-'
+    if parts:
+        stages.append(
+                ('qc reads', qc.tee_cmds(
+                    'fastq', parts['reads'], None if reads == '-' else reads),
+                 None, None))
+        reads = '-'
+
+    stages.append(
+            ('bowtie', bowtie_cmds(reads, config, threads=threads), None,
+             open(logfn, 'w')))
+    if parts:
+        stages.append(
+                ('qc mapping', qc.tee_cmds('sam', parts['mapping']), None,
+                 None))
+
+    try:
+        filter_bed = config['filter bed']
+    except KeyError:
+        filter_bed = None
+    if filter_bed:
+        stages.append(
+                ('sam2bam', ['samtools', 'view', '-S', '-b', '-'], None, None))
+        stages.append(
+                ('filter', ['intersectBed', '-abam', 'stdin', '-b',
+                            filter_bed, '-v'], None, None))
+        stages.append(
+                ('bam2sam', ['samtools', 'view', '-h', '-'], None, None))
+
+    stages.append(
+            ('count', htseq_cmds('-', config), open(countfile, 'w'), None))
+
+    procs = []
+    captured = []
+    started = []
+    upstream = None
+    for desc, cmds, stdout, stderr in stages:
+        if stdout is None:
+            stdout = subprocess.PIPE
+        if stderr is None:
+            stderr = tempfile.TemporaryFile()
+            captured.append(stderr)
+        else:
+            captured.append(None)
+        p = popen(cmds, stdin=upstream, stdout=stdout, stderr=stderr)
+        started.append(time.time())
+        for f in (stdout, stderr):
+            if isinstance(f, file) and f is not captured[-1]:
+                f.close()
+        # Close our copy of the upstream pipe so that the upstream process
+        # gets SIGPIPE if this one exits early.
+        if upstream is not None:
+            upstream.close()
+        upstream = p.stdout
+        procs.append(p)
+
+    finished, usages = _wait_for_stages(procs)
+
+    # Every stage sees (about) the same reads
+    reads = None
+    if adapter is not None:
+        reads = reads_in_log(clipping_report, 'Input:')
+    if reads is None:
+        reads = reads_in_log(logfn, '# reads processed:')
+
+    results = []
+    for (desc, cmds, stdout, stderr), p, errfile, t0, t1, usage in zip(
+            stages, procs, captured, started, finished, usages):
+        stderr_text = None
+        if errfile is not None:
+            stderr_text = read_tail(errfile)
+            errfile.close()
+        log = None
+        if desc == 'bowtie':
+            log = logfn
+        res = Result(
+                fastq, [], log=log, stderr=stderr_text, desc=desc,
+                failed=p.returncode, cmds=' '.join(cmds),
+                stats={'reads': reads})
+        res.elapsed = t1 - t0
+        res.usage = stage_usage(usage)
+        results.append(res)
+
+    failed = any(res.failed for res in results)
+    outfiles = (countfile, clipping_report)
+    stats = {'reads': reads}
+    if parts and not failed:
+        if adapter is None:
+            # as with bowtie(), the reads are summarized with the mapping
+            qc.collect(map_qcfile, parts)
+            outfiles += (map_qcfile,)
+        else:
+            reads_part = parts.pop('reads')
+            read_summary = qc.read_summary(reads_part)
+            os.unlink(reads_part)
+            qc.write_summary(clip_qcfile, {
+                'reads': read_summary,
+                'adapter': fastx_adapter_qc(clipping_report, read_summary)})
+            qc.collect(map_qcfile, parts)
+            outfiles += (clip_qcfile, map_qcfile)
+            stats.update(_qc_stats(clip_qcfile))
+        stats.update(_qc_stats(map_qcfile))
+    cmds = ' |\n'.join(res.cmds for res in results)
+    stderr = '\n'.join(res.stderr for res in results if res.stderr)
+    return Result(
+            fastq, outfiles, log=logfn, stderr=stderr, failed=failed,
+            cmds=cmds, stages=results, stats=stats)
+
+
+def _filter_builtin(sam, outfile, config):
+    import filtering
+    cmds = 'filtering.filter(%s, %s, %s)' % (
+            sam, outfile, config['filter bed'])
+    bam_cmds = None
+    if config.get('bam intermediates'):
+        bam_cmds = samtools_bam_cmds(config)
+    try:
+        with cores(1):
+            kept, dropped = filtering.filter(
+                    sam, outfile, config['filter bed'], bam_cmds)
+    except Exception as e:
+        return Result(
+                sam, outfile, stderr='%s: %s' % (type(e).__name__, e),
+                failed=True, cmds=cmds)
+    return Result(
+            sam, outfile, cmds=cmds,
+            stats={'reads': kept + dropped, 'reads kept': kept,
+                   'reads dropped': dropped})